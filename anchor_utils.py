@@ -0,0 +1,154 @@
+import os
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+from utils.anno_utils import open_annotation_store
+
+
+def box_sizes(anno_path, img_size=None, letterbox_resize=True):
+    '''
+    The width and height of all the boxes of an annotation file or store, see `anno_utils`.
+    param:
+        img_size: [width, height], the sizes of the boxes in the images resized to img_size like `data_utils.parse_data`,
+            the original sizes if None. The image sizes missing in the keras annotation lines are read from the image headers.
+        letterbox_resize: whether the images keep their aspect ratio in the resize.
+    return: [G, 2] float64, the empty boxes are dropped
+    '''
+    store = open_annotation_store(anno_path)
+    wh = (store.boxes[:, 2:4] - store.boxes[:, 0:2]).astype(np.float64)
+    if img_size is not None:
+        img_sizes = store.img_sizes.astype(np.float64)
+        for i in np.flatnonzero(img_sizes[:, 0] < 0):
+            path = store.paths[i].decode('utf-8')
+            if not os.path.exists(path):
+                raise ValueError('The size of {} is not in the annotations and the image is missing, use the original box sizes!'.format(path))
+            img_sizes[i] = Image.open(path).size
+        ratio = np.asarray(img_size, np.float64) / img_sizes
+        if letterbox_resize:
+            ratio[:] = ratio.min(axis=1, keepdims=True)
+        wh *= np.repeat(ratio, np.diff(store.offsets), axis=0)
+    return wh[np.all(wh > 0, axis=1)]
+
+
+def wh_iou(wh, anchors):
+    '''
+    IoU of the boxes [N, 2] and the anchors [K, 2] put on the same center, the matching of `data_utils.process_box`.
+    return: [N, K]
+    '''
+    inter = np.minimum(wh[:, None, 0], anchors[:, 0]) * np.minimum(wh[:, None, 1], anchors[:, 1])
+    return inter / (wh[:, None, 0] * wh[:, None, 1] + anchors[:, 0] * anchors[:, 1] - inter)
+
+
+def avg_best_iou(wh, anchors, weights=None):
+    '''
+    The average IoU of every box with its best anchor.
+    '''
+    return np.average(wh_iou(wh, anchors).max(axis=1), weights=weights)
+
+
+def iou_kmeans(wh, k, weights=None, max_iter=300, seed=None):
+    '''
+    One run of k-means with the distance 1 - IoU, see `wh_iou`: k-means++ init, then the centers are the weighted means
+    of their boxes until the assignments don't change.
+    param:
+        wh: [N, 2] box sizes
+        weights: [N], the count of every box size, 1 by default
+    return: the [k, 2] anchors and their average best IoU
+    '''
+    rng = np.random.RandomState(seed)
+    if weights is None:
+        weights = np.ones(len(wh))
+
+    # k-means++: the next center is drawn with a probability proportional to the squared distance to the closest one
+    anchors = wh[[rng.choice(len(wh), p=weights / weights.sum())]]
+    dist = 1. - wh_iou(wh, anchors)[:, 0]
+    for _ in range(1, k):
+        p = weights * dist ** 2
+        anchors = np.concatenate([anchors, wh[[rng.choice(len(wh), p=p / p.sum())]]])
+        dist = np.minimum(dist, 1. - wh_iou(wh, anchors[-1:])[:, 0])
+
+    assign = None
+    for _ in range(max_iter):
+        new_assign = wh_iou(wh, anchors).argmax(axis=1)
+        if assign is not None and np.array_equal(new_assign, assign):
+            break
+        assign = new_assign
+        count = np.bincount(assign, weights, minlength=k)
+        # the clusters which lost all their boxes keep their center
+        used = count > 0
+        anchors[used, 0] = np.bincount(assign, weights * wh[:, 0], minlength=k)[used] / count[used]
+        anchors[used, 1] = np.bincount(assign, weights * wh[:, 1], minlength=k)[used] / count[used]
+    return anchors, avg_best_iou(wh, anchors, weights)
+
+
+def _kmeans_run(params):
+    return iou_kmeans(*params)
+
+
+def cluster_anchors(wh, k=9, restarts=10, max_iter=300, seed=None, workers=0):
+    '''
+    The best of several runs of `iou_kmeans` over the box sizes wh [N, 2]. The identical sizes are clustered once
+    with their count as weight.
+    param:
+        seed: the seed of the first run, the run r uses seed + r. Random if None.
+        workers: number of processes for the runs, 0 to run them in this process.
+    return: the [k, 2] anchors sorted by area, and their average best IoU
+    '''
+    wh, counts = np.unique(np.asarray(wh, np.float64), axis=0, return_counts=True)
+    if len(wh) < k:
+        raise ValueError('{} anchors from only {} different box sizes!'.format(k, len(wh)))
+    seeds = [None if seed is None else seed + r for r in range(restarts)]
+    params = [(wh, k, counts.astype(np.float64), max_iter, s) for s in seeds]
+    if workers > 0:
+        with Pool(workers) as pool:
+            runs = pool.map(_kmeans_run, params)
+    else:
+        runs = [_kmeans_run(p) for p in params]
+    anchors, iou = max(runs, key=lambda run: run[1])
+    return anchors[np.argsort(anchors.prod(axis=1))], iou
+
+
+def write_anchors(anchors, anchor_path):
+    '''
+    Write the anchors in the format of `misc_utils.parse_anchors`: w1,h1, w2,h2, ... rounded to integers.
+    '''
+    with open(anchor_path, 'w') as f:
+        f.write(', '.join('{},{}'.format(int(round(w)), int(round(h))) for w, h in anchors))
+
+
+if __name__ == '__main__':
+    from utils.misc_utils import parse_anchors
+
+    parser = argparse.ArgumentParser(description='Cluster the box sizes of annotation files into anchors.')
+    parser.add_argument('anno_paths', nargs='+', help='Path to the annotation txt files or stores.')
+    parser.add_argument('--anchor_path', type=str, default='./data/yolo_anchors.txt',
+                        help='The anchor file to write. With several img_sizes, one file per size, e.g. yolo_anchors_320.txt.')
+    parser.add_argument('--img_sizes', type=int, nargs='*', default=[416],
+                        help='Square input sizes to cluster the resized boxes at. Nothing to cluster the original box sizes.')
+    parser.add_argument('--letterbox_resize', type=lambda x: (str(x).lower() == 'true'), default=True,
+                        help='Whether to use the letterbox resize.')
+    parser.add_argument('--num', type=int, default=9, help='The number of anchors.')
+    parser.add_argument('--restarts', type=int, default=10, help='The number of k-means runs.')
+    parser.add_argument('--seed', type=int, default=0, help='The seed of the first k-means run.')
+    parser.add_argument('--workers', type=int, default=0, help='Number of processes for the k-means runs.')
+    args = parser.parse_args()
+
+    img_sizes = [[x, x] for x in args.img_sizes] or [None]
+    current_anchors = parse_anchors(args.anchor_path) if os.path.exists(args.anchor_path) else None
+    for img_size in img_sizes:
+        wh = np.concatenate([box_sizes(anno_path, img_size, args.letterbox_resize) for anno_path in args.anno_paths])
+        name = 'original sizes' if img_size is None else '{}x{}'.format(*img_size)
+        if current_anchors is not None:
+            print('{}: current anchors of {}, avg best IoU: {:.4f}'.format(name, args.anchor_path, avg_best_iou(wh, current_anchors)))
+
+        anchors, iou = cluster_anchors(wh, args.num, args.restarts, seed=args.seed, workers=args.workers)
+        anchor_path = args.anchor_path
+        if len(img_sizes) > 1:
+            root, ext = os.path.splitext(args.anchor_path)
+            anchor_path = '{}_{}{}'.format(root, img_size[0], ext)
+        write_anchors(anchors, anchor_path)
+        print('{}: {} boxes, {} anchors written to {}, avg best IoU: {:.4f}'.format(
+            name, len(wh), len(anchors), anchor_path, avg_best_iou(wh, np.round(anchors))))
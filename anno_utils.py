@@ -0,0 +1,146 @@
+import os
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+
+def compile_annotation(anno_path, store_dir=None):
+    '''
+    Compile an annotation txt file into a columnar binary store, so that the data pipelines don't
+    have to parse the text again. Two line formats are supported:
+        line_index img_path img_width img_height label x_min y_min x_max y_max ...  (the tensorflow pipeline)
+        img_path x_min,y_min,x_max,y_max,label ...                                 (the keras pipeline)
+    The store is a directory of .npy files which can be memory-mapped:
+        offsets: [I + 1], the objects of the image i are boxes[offsets[i]: offsets[i + 1]]
+        boxes: [G, 4] float32, x_min, y_min, x_max, y_max
+        labels: [G] int64
+        img_sizes: [I, 2] int32, width and height, -1 if not given in the line
+        line_idx: [I] int64, the line_index of the line, or the line number
+        paths: [I] bytes, utf-8 encoded img_path
+    The files are written into a temporary directory next to store_dir, which then replaces store_dir at once,
+    so that a reader never sees a partially written store, even when several processes compile the same file.
+    return: the store directory, anno_path + '.store' by default
+    '''
+    if store_dir is None:
+        store_dir = anno_path + '.store'
+
+    line_idx, paths, img_sizes, boxes_list, labels_list = [], [], [], [], []
+    with open(anno_path, 'r') as f:
+        for i, line in enumerate(f):
+            s = line.strip().split()
+            if len(s) == 0:
+                continue
+            if s[0].isdigit():
+                assert len(s) > 8, 'Annotation error! Please check your annotation file. Make sure there is at least one target object in each image.'
+                assert len(s[4:]) % 5 == 0, 'Annotation error! Please check your annotation file. Maybe partially missing some coordinates?'
+                line_idx.append(int(s[0]))
+                paths.append(s[1])
+                img_sizes.append([int(s[2]), int(s[3])])
+                # parse as float64 first, the same rounding as `parse_line`
+                objects = np.asarray(s[4:], np.float64).reshape(-1, 5)
+                boxes_list.append(objects[:, 1:5])
+                labels_list.append(objects[:, 0])
+            else:
+                line_idx.append(i)
+                paths.append(s[0])
+                img_sizes.append([-1, -1])
+                objects = np.asarray([box.split(',') for box in s[1:]], np.float64).reshape(-1, 5)
+                boxes_list.append(objects[:, 0:4])
+                labels_list.append(objects[:, 4])
+
+    box_cnt = [len(labels) for labels in labels_list]
+
+    store_dir = store_dir.rstrip('/\\')
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(store_dir) + '.', suffix='.tmp',
+                               dir=os.path.dirname(os.path.abspath(store_dir)))
+    np.save(os.path.join(tmp_dir, 'boxes.npy'), np.concatenate(boxes_list).astype(np.float32).reshape(-1, 4))
+    np.save(os.path.join(tmp_dir, 'labels.npy'), np.concatenate(labels_list).astype(np.int64))
+    np.save(os.path.join(tmp_dir, 'img_sizes.npy'), np.asarray(img_sizes, np.int32).reshape(-1, 2))
+    np.save(os.path.join(tmp_dir, 'line_idx.npy'), np.asarray(line_idx, np.int64))
+    np.save(os.path.join(tmp_dir, 'paths.npy'), np.asarray([p.encode('utf-8') for p in paths], dtype=bytes))
+    # offsets is written last, so that its mtime tells the store is complete
+    np.save(os.path.join(tmp_dir, 'offsets.npy'), np.concatenate([[0], np.cumsum(box_cnt)]).astype(np.int64))
+
+    # a directory can only be renamed to a missing (or empty) one: the old store is moved away first, the mapped
+    # files of its readers stay valid
+    old_dir = tmp_dir + '.old'
+    try:
+        os.replace(store_dir, old_dir)
+    except OSError:
+        pass
+    try:
+        os.replace(tmp_dir, store_dir)
+    except OSError:
+        # another process put its store in place first, it is the same
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return store_dir
+
+
+class AnnotationStore(object):
+    '''
+    Read-only access to a store written by `compile_annotation`.
+    '''
+    def __init__(self, store_dir, mmap=True):
+        self.store_dir = store_dir
+        # np.asarray drops the np.memmap subclass, whose slicing is several times slower,
+        # the arrays still share the mapped pages
+        load = lambda name: np.asarray(np.load(os.path.join(store_dir, name), mmap_mode='r' if mmap else None))
+        self.offsets = load('offsets.npy')
+        self.boxes = load('boxes.npy')
+        self.labels = load('labels.npy')
+        self.img_sizes = load('img_sizes.npy')
+        self.line_idx = load('line_idx.npy')
+        self.paths = load('paths.npy')
+
+    def __len__(self):
+        return len(self.line_idx)
+
+    def parse(self, i):
+        '''
+        Same return values as `data_utils.parse_line` for the i-th image:
+            line_idx, pic_path, boxes [N, 4] float32, labels [N] int64, img_width, img_height
+        '''
+        i = int(i)
+        start, end = self.offsets[i:i + 2].tolist()
+        img_width, img_height = self.img_sizes[i].tolist()
+        return int(self.line_idx[i]), self.paths[i].decode('utf-8'), self.boxes[start:end].copy(), \
+            self.labels[start:end].copy(), img_width, img_height
+
+
+store_cache = {}  # key: store directory, value: AnnotationStore
+path_cache = {}  # key: path given to `open_annotation_store`, value: store directory
+def open_annotation_store(path, refresh=False):
+    '''
+    Open the store of an annotation txt file, compiling it first if it is missing or older than the txt file.
+    path can also be a store directory. The store of a path is resolved once per process, the next calls don't touch
+    the file system, so it is cheap to call it for every sample. refresh: check again that the store is up to date.
+    '''
+    if isinstance(path, bytes):
+        path = path.decode('utf-8')
+    if refresh or path not in path_cache:
+        if os.path.isdir(path):
+            store_dir = path
+        else:
+            store_dir = path + '.store'
+            offsets_path = os.path.join(store_dir, 'offsets.npy')
+            if not os.path.exists(offsets_path) or os.path.getmtime(offsets_path) < os.path.getmtime(path):
+                compile_annotation(path, store_dir)
+                store_cache.pop(store_dir, None)
+        path_cache[path] = store_dir
+
+    store_dir = path_cache[path]
+    if store_dir not in store_cache:
+        store_cache[store_dir] = AnnotationStore(store_dir)
+    return store_cache[store_dir]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile annotation txt files into binary stores.')
+    parser.add_argument('anno_paths', nargs='+', help='Path to the annotation txt files.')
+    args = parser.parse_args()
+
+    for anno_path in args.anno_paths:
+        store = open_annotation_store(compile_annotation(anno_path))
+        print('{}: {} images, {} objects'.format(anno_path, len(store), len(store.labels)))
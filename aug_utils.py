@@ -0,0 +1,185 @@
+import numpy as np
+import cv2
+
+
+def affine_matrices(scale_x, scale_y, dx, dy, flip=False, width=0):
+    '''
+    Batch of 2x3 affine matrices of x' = scale_x * x + dx, y' = scale_y * y + dy, followed by a horizontal flip
+    in an image of the given width where flip is True. All the params are scalars or arrays of the batch size.
+    The coordinates are the ones of the boxes, i.e. the pixel edges: the pixel (i, j) spans [j, j+1] x [i, i+1].
+    return: [N, 2, 3] float64 matrices
+    '''
+    scale_x, scale_y, dx, dy, flip, width = np.broadcast_arrays(scale_x, scale_y, dx, dy, flip, width)
+    sign = np.where(flip, -1., 1.).reshape(-1)
+    M = np.zeros((len(sign), 2, 3))
+    M[:, 0, 0] = sign * scale_x.reshape(-1)
+    M[:, 0, 2] = sign * dx.reshape(-1) + np.where(flip, width, 0).reshape(-1)
+    M[:, 1, 1] = scale_y.reshape(-1)
+    M[:, 1, 2] = dy.reshape(-1)
+    return M
+
+
+def compose(M2, M1):
+    '''
+    The 2x3 matrix of M1 followed by M2.
+    '''
+    return np.concatenate([M2[:, :2] @ M1[:, :2], M2[:, :2] @ M1[:, 2:] + M2[:, 2:]], axis=1)
+
+
+def transform_boxes(boxes, M):
+    '''
+    Transform the boxes [N, 4+] (xmin, ymin, xmax, ymax, ...) with the 2x3 matrix M: the 4 corners of all the boxes
+    go through one matrix multiply, and the new boxes are their bounding boxes (xmin and xmax are swapped by a flip).
+    The other columns are kept. return: a new float array
+    '''
+    corners = boxes[:, [0, 1, 2, 1, 0, 3, 2, 3]].reshape(-1, 4, 2).astype(np.float64)
+    corners = corners @ M[:, :2].T + M[:, 2]
+    new_boxes = boxes.astype(np.float64)
+    new_boxes[:, :2] = corners.min(axis=1)
+    new_boxes[:, 2:4] = corners.max(axis=1)
+    return new_boxes
+
+
+def fast_random_crop_with_constraints(bbox, size, min_scale=0.3, max_scale=1, max_aspect_ratio=2, constraints=None, max_trial=50):
+    '''
+    Vectorized `data_aug.random_crop_with_constraints`, all the trials are sampled at once from np.random, see
+    `tf_data_utils.tf_random_crop_with_constraints`. Same params and return: the boxes in the crop and the crop
+    (x0, y0, w, h); if no crop keeps a box, the boxes and the whole image.
+    '''
+    if constraints is None:
+        constraints = ((0.1, None), (0.3, None), (0.5, None), (0.7, None), (0.9, None), (None, 1))
+    min_ious = np.array([[-np.inf if c[0] is None else c[0]] for c in constraints])
+    max_ious = np.array([[np.inf if c[1] is None else c[1]] for c in constraints])
+
+    w, h = size
+    shape = (len(constraints), max_trial)
+    scale = np.random.uniform(min_scale, max_scale, shape)
+    min_ar = np.maximum(1. / max_aspect_ratio, scale * scale)
+    max_ar = np.minimum(max_aspect_ratio, 1. / (scale * scale))
+    aspect_ratio = np.random.uniform(min_ar, max_ar)
+    crop_h = np.floor(h * scale / np.sqrt(aspect_ratio))
+    crop_w = np.floor(w * scale * np.sqrt(aspect_ratio))
+    crop_t = np.floor(np.random.uniform(0, 1, shape) * np.maximum(h - crop_h, 1))
+    crop_l = np.floor(np.random.uniform(0, 1, shape) * np.maximum(w - crop_w, 1))
+    # [C, T, 4]
+    crops = np.stack([crop_l, crop_t, crop_l + crop_w, crop_t + crop_h], axis=-1)
+
+    # IoU of every trial with every box, [C, T, N]
+    tl = np.maximum(crops[..., None, :2], bbox[:, :2])
+    br = np.minimum(crops[..., None, 2:4], bbox[:, 2:4])
+    area_i = np.prod(br - tl, axis=-1) * (tl < br).all(axis=-1)
+    area_crop = np.prod(crops[..., 2:4] - crops[..., :2], axis=-1)[..., None]
+    area_box = np.prod(bbox[:, 2:4] - bbox[:, :2], axis=-1)
+    iou = area_i / (area_crop + area_box - area_i)
+    valid = np.logical_and(iou.min(axis=-1) >= min_ious, iou.max(axis=-1) <= max_ious)
+    # each constraint keeps its first valid trial, the whole image is always a candidate, [K, 4]
+    candidates = np.concatenate([[[0, 0, w, h]], crops[np.arange(len(constraints)), valid.argmax(axis=1)][valid.any(axis=1)]])
+
+    # `data_aug.bbox_crop(allow_outside_center=False)` for every candidate, [K, N]
+    centers = (bbox[:, :2] + bbox[:, 2:4]) / 2
+    crop_tl, crop_br = candidates[:, None, :2], candidates[:, None, 2:4]
+    inside = np.logical_and(crop_tl <= centers, centers < crop_br).all(axis=-1)
+    tl = np.maximum(bbox[:, :2], crop_tl) - crop_tl
+    br = np.minimum(bbox[:, 2:4], crop_br) - crop_tl
+    keep = np.logical_and(inside, (tl < br).all(axis=-1))
+
+    usable = np.flatnonzero(keep.any(axis=1))
+    if len(usable) == 0:
+        return bbox, (0, 0, w, h)
+    choice = usable[np.random.randint(0, len(usable))]
+    new_bbox = np.concatenate([tl[choice], br[choice], bbox[:, 4:]], axis=-1)[keep[choice]].astype(bbox.dtype)
+    crop = candidates[choice].astype(int)
+    return new_bbox, (crop[0], crop[1], crop[2] - crop[0], crop[3] - crop[1])
+
+
+def _visible_span(t, s, src_len, dst_len):
+    '''
+    The source pixels [a0, a1) of x' = s * x + t (s > 0) which are visible in [0, dst_len), and where they go, [p0, p1).
+    '''
+    a0 = max(int(np.floor(-t / s)), 0)
+    a1 = min(int(np.ceil((dst_len - t) / s)), src_len)
+    return a0, a1, int(round(t + a0 * s)), int(round(t + a1 * s))
+
+
+def warp_image(img, M, dst, interp=cv2.INTER_LINEAR, border_value=None):
+    '''
+    Warp img into dst (an image of the preallocated batch) with the 2x3 box coordinates matrix M.
+    The matrices of `affine_matrices` (scale, translation and flip) don't need a real warp: only the visible part of
+    img is resized, with the cv2.resize interpolation, and copied in place (flipped by slicing). It is much faster than
+    cv2.warpAffine, which is used for the other matrices.
+    border_value: fill the pixels outside of img with it, e.g. (128, 128, 128). If None, they are not modified.
+    '''
+    h, w = dst.shape[:2]
+    if border_value is not None:
+        dst[...] = border_value
+    if M[0, 1] != 0 or M[1, 0] != 0:
+        # cv2 maps the pixel centers, which are at the pixel indices + 0.5 in the box coordinates
+        M_pixel = M.copy()
+        M_pixel[:, 2] += M[:, :2].sum(axis=1) * .5 - .5
+        return cv2.warpAffine(img, M_pixel, (w, h), dst=dst, flags=interp, borderMode=cv2.BORDER_TRANSPARENT)
+
+    flip = M[0, 0] < 0
+    x0, x1, p0, p1 = _visible_span(w - M[0, 2] if flip else M[0, 2], abs(M[0, 0]), img.shape[1], w)
+    y0, y1, q0, q1 = _visible_span(M[1, 2], M[1, 1], img.shape[0], h)
+    if x1 <= x0 or y1 <= y0 or p1 <= p0 or q1 <= q0:
+        return dst
+    patch = cv2.resize(img[y0: y1, x0: x1], (p1 - p0, q1 - q0), interpolation=interp)
+    # the rounding of the spans may put a pixel out of dst
+    c0, c1, r0, r1 = max(p0, 0), min(p1, w), max(q0, 0), min(q1, h)
+    patch = patch[r0 - q0: r1 - q0, c0 - p0: c1 - p0]
+    if flip:
+        dst[r0: r1, w - c1: w - c0] = patch[:, ::-1]
+    else:
+        dst[r0: r1, c0: c1] = patch
+    return dst
+
+
+def mosaic_into(images, boxes_list, dst, min_area_ratio=0.2):
+    '''
+    Mosaic of 4 images into dst: dst is split in 4 quarters at a random center, every image is resized to fit dst
+    with a random scale in [0.5, 1.5), placed with a corner on the center and cut by its quarter (the rest of the
+    quarter is grey). Only the visible part of each image is resized, see `warp_image`.
+    The boxes of the 4 images are merged, then clipped to their quarters and filtered at once: the boxes smaller than
+    2 pixels or keeping less than min_area_ratio of their area are dropped.
+    images: 4 uint8 images, the top left, top right, bottom left and bottom right ones
+    boxes_list: their [N, 4+] boxes, the other columns are kept
+    return: the boxes in dst
+    '''
+    h, w = dst.shape[:2]
+    cx, cy = int(np.random.uniform(.25, .75) * w), int(np.random.uniform(.25, .75) * h)
+    quarters = np.array([[0, 0, cx, cy], [cx, 0, w, cy], [0, cy, cx, h], [cx, cy, w, h]])
+    all_boxes, bounds = [], []
+    for k, (img, boxes) in enumerate(zip(images, boxes_list)):
+        ih, iw = img.shape[:2]
+        scale = min(w / iw, h / ih) * np.random.uniform(.5, 1.5)
+        # the corner of the image on the center
+        dx = cx - scale * iw if k % 2 == 0 else cx
+        dy = cy - scale * ih if k < 2 else cy
+        x0, y0, x1, y1 = quarters[k]
+        # the quarter is a view of dst, fine for the matrices of `affine_matrices`
+        warp_image(img, affine_matrices(scale, scale, dx - x0, dy - y0)[0], dst[y0: y1, x0: x1],
+                   cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR, (128, 128, 128))
+        all_boxes.append(transform_boxes(boxes, affine_matrices(scale, scale, dx, dy)[0]))
+        bounds.append(np.repeat(quarters[k: k + 1], len(boxes), axis=0))
+
+    boxes, bounds = np.concatenate(all_boxes), np.concatenate(bounds)
+    area = np.prod(boxes[:, 2:4] - boxes[:, :2], axis=1)
+    boxes[:, :2] = np.maximum(boxes[:, :2], bounds[:, :2])
+    boxes[:, 2:4] = np.minimum(boxes[:, 2:4], bounds[:, 2:4])
+    box_w, box_h = boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]
+    keep = np.logical_and.reduce([box_w > 2, box_h > 2, box_w * box_h >= min_area_ratio * area])
+    return boxes[keep]
+
+
+def mix_up_into(dst, img, dst_boxes, boxes, alpha=1.5):
+    '''
+    Mix up of 2 images of the same size, written in dst: dst * lam + img * (1 - lam), lam ~ Beta(alpha, alpha),
+    like `data_aug.mix_up`. The mix up weights of the boxes (5th column) are multiplied by lam and 1 - lam.
+    return: the merged boxes
+    '''
+    lam = min(max(np.random.beta(alpha, alpha), 0.), 1.)
+    cv2.addWeighted(dst, lam, img, 1. - lam, 0., dst=dst)
+    dst_boxes, boxes = dst_boxes.copy(), boxes.copy()
+    dst_boxes[:, 4] *= lam
+    boxes[:, 4] *= 1. - lam
+    return np.concatenate([dst_boxes, boxes])
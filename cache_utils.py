@@ -0,0 +1,180 @@
+import os
+import atexit
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import cv2
+from PIL import Image
+
+
+class ImageCache(object):
+    '''
+    Byte-bounded LRU cache of decoded uint8 images.
+    If cache_dir is None, the arrays are kept in the memory of the current process, and are shared by the
+    threads of the process (e.g. the `num_parallel_calls` workers of tf.data).
+    Otherwise every decoded image is also written as a .npy file and memory-mapped, so the processes forked after
+    the creation of the cache (e.g. the keras data_generator workers) reuse it instead of decoding again. The files are
+    named after the mtime and size of the image file too, so an image modified during the run is decoded again.
+    The files are in a directory 'run-<pid>' of cache_dir, removed when the process which created the cache exits (and
+    by the next cache in cache_dir if that process was killed). Use a directory in /dev/shm to keep the files in
+    shared memory.
+    NOTE: the returned arrays are read-only, copy them before any in-place modification.
+    '''
+    def __init__(self, max_bytes=1 << 30, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.owner_pid = os.getpid()
+        self.run_dir = None
+        if cache_dir is not None:
+            remove_stale_runs(cache_dir)
+            self.run_dir = os.path.join(cache_dir, 'run-{}'.format(self.owner_pid))
+            os.makedirs(self.run_dir, exist_ok=True)
+            atexit.register(self.remove_files)
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.entries = OrderedDict()  # key: (path, tag), value: array
+        self.file_paths = {}  # key: (path, tag), value: the file of the entry in cache_dir
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0  # misses served by the file of another process
+        self.evictions = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'shared_hits': self.shared_hits, 'evictions': self.evictions,
+                'entries': len(self.entries), 'bytes': self.nbytes}
+
+    def remove_files(self):
+        '''
+        Remove the files of the run, only in the process which created the cache (not in its forked workers).
+        '''
+        if self.run_dir is not None and os.getpid() == self.owner_pid:
+            shutil.rmtree(self.run_dir, ignore_errors=True)
+
+    def _file_path(self, key):
+        '''
+        The file of key in cache_dir, None if the image file is missing.
+        '''
+        try:
+            stat = os.stat(key[0])
+        except OSError:
+            return None
+        file_key = key + (stat.st_mtime_ns, stat.st_size)
+        return os.path.join(self.run_dir, hashlib.md5(repr(file_key).encode('utf-8')).hexdigest() + '.npy')
+
+    def get(self, path, loader, tag=''):
+        '''
+        Get the decoded image of path, loader(path) is called to decode it on a miss.
+        tag tells apart the different decodings of the same file.
+        '''
+        key = (path, tag)
+        with self.lock:
+            img = self.entries.get(key)
+            if img is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return img
+            self.misses += 1
+
+        # decode outside the lock, cv2 and PIL release the GIL
+        file_path = self._file_path(key) if self.cache_dir is not None else None
+        img = None
+        if file_path is not None and os.path.exists(file_path):
+            try:
+                # decoded by another process, np.asarray drops the slow np.memmap subclass
+                img = np.asarray(np.load(file_path, mmap_mode='r'))
+                with self.lock:
+                    self.shared_hits += 1
+            except (FileNotFoundError, ValueError):
+                # evicted by another process in the meantime, it is a miss
+                img = None
+        if img is None:
+            img = loader(path)
+            if img is None:
+                # not cached, e.g. cv2.imread of a missing file
+                return img
+            if file_path is not None:
+                # a temporary file of its own for every writer, even the threads of the same process
+                fd, tmp_path = tempfile.mkstemp(suffix='.tmp.npy', dir=self.run_dir)
+                with os.fdopen(fd, 'wb') as f:
+                    np.save(f, np.ascontiguousarray(img))
+                os.replace(tmp_path, file_path)
+                try:
+                    img = np.asarray(np.load(file_path, mmap_mode='r'))
+                except (FileNotFoundError, ValueError):
+                    # evicted by another process already, keep the decoded array
+                    pass
+        img.flags.writeable = False
+
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = img
+                self.nbytes += img.nbytes
+                if file_path is not None:
+                    self.file_paths[key] = file_path
+            # evict the least recently used images
+            while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                old_key, old_img = self.entries.popitem(last=False)
+                self.nbytes -= old_img.nbytes
+                self.evictions += 1
+                old_path = self.file_paths.pop(old_key, None)
+                if old_path is not None:
+                    try:
+                        os.remove(old_path)
+                    except OSError:
+                        # removed by another process
+                        pass
+        return img
+
+
+def remove_stale_runs(cache_dir):
+    '''
+    Remove the 'run-<pid>' directories of cache_dir whose process is gone, e.g. killed before its atexit cleanup.
+    '''
+    if not os.path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        if not name.startswith('run-') or not name[4:].isdigit():
+            continue
+        try:
+            os.kill(int(name[4:]), 0)
+        except ProcessLookupError:
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+        except OSError:
+            # alive, owned by another user
+            pass
+
+
+image_cache = None
+def configure_image_cache(max_bytes=1 << 30, cache_dir=None):
+    '''
+    Enable the image cache used by `cv2_imread` and `pil_open` in this process. max_bytes=0 disables it.
+    return: the ImageCache, to read its counters with `stats()`
+    '''
+    global image_cache
+    image_cache = ImageCache(max_bytes, cache_dir) if max_bytes > 0 else None
+    return image_cache
+
+
+def cv2_imread(path):
+    '''
+    Same as cv2.imread(path) (BGR, uint8), served from the image cache if it is configured.
+    '''
+    if image_cache is None:
+        return cv2.imread(path)
+    return image_cache.get(path, cv2.imread, 'cv2')
+
+
+def pil_open(path):
+    '''
+    Same as Image.open(path).convert('RGB') for the data augmentation, served from the image cache if it is configured.
+    '''
+    if image_cache is None:
+        return Image.open(path).convert('RGB')
+    return Image.fromarray(image_cache.get(path, lambda x: np.asarray(Image.open(x).convert('RGB')), 'pil'))
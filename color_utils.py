@@ -0,0 +1,50 @@
+import numpy as np
+import cv2
+
+
+def random_hsv_params(hue=.1, sat=1.5, val=1.5):
+    '''
+    Sample the hue shift and the saturation / value scales like `utils.get_random_data`:
+    hue in [-hue, hue] (fraction of the hue circle), sat in [1, sat] or its inverse with prob 0.5, same for val.
+    The draws from np.random are the same as the original code, so the random stream is unchanged.
+    '''
+    hue = np.random.rand()*2*hue - hue
+    sat = np.random.rand()*(sat-1) + 1 if np.random.rand()<.5 else 1/(np.random.rand()*(sat-1) + 1)
+    val = np.random.rand()*(val-1) + 1 if np.random.rand()<.5 else 1/(np.random.rand()*(val-1) + 1)
+    return hue, sat, val
+
+
+def hsv_lut(hue, sat, val):
+    '''
+    Lookup table of shape [1, 256, 3] for the 8 bit HSV channels of OpenCV with the full hue range (H in 0~255):
+    the hue is rotated modulo the circle, the saturation and the value are scaled and clipped to 0~255.
+    '''
+    x = np.arange(256, dtype=np.float64)
+    lut = np.empty((1, 256, 3), np.uint8)
+    lut[0, :, 0] = np.rint(x + hue*256) % 256
+    lut[0, :, 1] = np.clip(np.rint(x*sat), 0, 255)
+    lut[0, :, 2] = np.clip(np.rint(x*val), 0, 255)
+    return lut
+
+
+def hsv_jitter(img, hue, sat, val, bgr=False, dst=None):
+    '''
+    Color jittering of a uint8 image in HSV space, the uint8 version of the matplotlib
+    rgb_to_hsv / hsv_to_rgb distortion: one color conversion each way and a table lookup.
+    param:
+        img: uint8 image, RGB or BGR if bgr is True. It is not modified.
+        hue, sat, val: see `random_hsv_params`.
+        dst: write the result into this contiguous image, e.g. img itself or an image of a batch.
+    return: the jittered uint8 image, in the same channel order as img.
+    '''
+    to_hsv, to_rgb = (cv2.COLOR_BGR2HSV_FULL, cv2.COLOR_HSV2BGR_FULL) if bgr else (cv2.COLOR_RGB2HSV_FULL, cv2.COLOR_HSV2RGB_FULL)
+    x = cv2.cvtColor(np.ascontiguousarray(img), to_hsv)
+    cv2.LUT(x, hsv_lut(hue, sat, val), dst=x)
+    return cv2.cvtColor(x, to_rgb, dst=x if dst is None else dst)
+
+
+def random_hsv_jitter(img, hue=.1, sat=1.5, val=1.5, bgr=False):
+    '''
+    hsv_jitter with random parameters, see `random_hsv_params`.
+    '''
+    return hsv_jitter(img, *random_hsv_params(hue, sat, val), bgr=bgr)
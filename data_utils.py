@@ -3,10 +3,16 @@ import numpy as np
 import cv2
 import sys
 from utils.data_aug import *
+from utils.anno_utils import open_annotation_store
+from utils.cache_utils import cv2_imread
+from utils.color_utils import random_hsv_jitter
+from utils.aug_utils import affine_matrices, compose, transform_boxes, warp_image, fast_random_crop_with_constraints, \
+    mosaic_into, mix_up_into
 import random
 
 PY_VERSION = sys.version_info[0]
-iter_cnt = 0
+# the image sizes of the multi-scale training, see `scale_schedule`
+MULTI_SCALE_SIZES = [[x * 32, x * 32] for x in range(10, 20)]
 
 
 def parse_line(line):
@@ -45,7 +51,58 @@ def parse_line(line):
     return line_idx, pic_path, boxes, labels, img_width, img_height
 
 
-def process_box(boxes, labels, img_size, class_num, anchors):
+# the tables of the 9 anchors, indexed by the index of the best matched anchor
+# feature map group: 0,1,2 ==> 2; 3,4,5 ==> 1; 6,7,8 ==> 0
+anchor_group = np.array([2, 2, 2, 1, 1, 1, 0, 0, 0])
+# scale ratio: 0,1,2 ==> 8; 3,4,5 ==> 16; 6,7,8 ==> 32
+anchor_ratio = np.array([8., 8., 8., 16., 16., 16., 32., 32., 32.])
+# the slot of the anchor in its feature map group, i.e. anchors_mask[group].index(idx)
+anchor_slot = np.array([0, 1, 2, 0, 1, 2, 0, 1, 2])
+
+y_true_layouts = {}  # key: (img_width, img_height, class_num), value: the return of `get_y_true_layout`
+def get_y_true_layout(img_size, class_num):
+    '''
+    The 3 y_true feature maps [13, 13, 3, 5+num_class+1] of an image size are stored one after another in a single
+    [R, 6 + class_num] buffer, one row per cell and anchor. R = 3 * (13 * 13 + 26 * 26 + 52 * 52) for 416.
+    return:
+        template: the empty buffer, `5` means coords and labels. `1` means mix up weight, which defaults to 1.
+        shapes: the shapes of the 3 feature maps
+        offsets: [4], the first row of each feature map, and R
+        anchor_rows: [9, 4] int64, the first row, grid height, grid width and slot of the feature map of each anchor
+    '''
+    key = (int(img_size[0]), int(img_size[1]), int(class_num))
+    if key not in y_true_layouts:
+        shapes = [(key[1] // ratio, key[0] // ratio, 3, 6 + key[2]) for ratio in [32, 16, 8]]
+        offsets = np.cumsum([0] + [shape[0] * shape[1] * 3 for shape in shapes])
+        template = np.zeros((offsets[-1], 6 + key[2]), np.float32)
+        template[:, -1] = 1.
+        anchor_rows = np.array([[offsets[g], shapes[g][0], shapes[g][1], k] for g, k in zip(anchor_group, anchor_slot)], np.int64)
+        y_true_layouts[key] = template, shapes, offsets, anchor_rows
+    return y_true_layouts[key]
+
+
+def get_y_true_buffer(img_size, class_num, batch_size=None):
+    '''
+    Get a new empty y_true buffer copied from the template of the image size, see `get_y_true_layout`.
+    If batch_size is given, the buffer has a leading batch dimension.
+    '''
+    template = get_y_true_layout(img_size, class_num)[0]
+    if batch_size is None:
+        return template.copy()
+    buffer = np.empty((batch_size,) + template.shape, np.float32)
+    buffer[:] = template
+    return buffer
+
+
+def split_y_true(buffer, img_size, class_num):
+    '''
+    The y_true_13, y_true_26, y_true_52 views of a buffer from `get_y_true_buffer`.
+    '''
+    _, shapes, offsets, _ = get_y_true_layout(img_size, class_num)
+    return [buffer[..., offsets[g]: offsets[g + 1], :].reshape(buffer.shape[:-2] + shapes[g]) for g in range(3)]
+
+
+def process_box(boxes, labels, img_size, class_num, anchors, out=None):
     '''
     Generate the y_true label, i.e. the ground truth feature_maps in 3 different scales.
     params:
@@ -53,8 +110,11 @@ def process_box(boxes, labels, img_size, class_num, anchors):
         labels: [N] shape, int64 dtype.
         class_num: int64 num.
         anchors: [9, 4] shape, float32 dtype.
+        out: an empty buffer from `get_y_true_buffer` to write into, a new one if None.
     '''
-    anchors_mask = [[6, 7, 8], [3, 4, 5], [0, 1, 2]]
+    _, _, _, anchor_rows = get_y_true_layout(img_size, class_num)
+    if out is None:
+        out = get_y_true_buffer(img_size, class_num)
 
     # convert boxes form:
     # shape: [N, 2]
@@ -63,18 +123,6 @@ def process_box(boxes, labels, img_size, class_num, anchors):
     # (width, height)
     box_sizes = boxes[:, 2:4] - boxes[:, 0:2]
 
-    # [13, 13, 3, 5+num_class+1] `5` means coords and labels. `1` means mix up weight.
-    y_true_13 = np.zeros((img_size[1] // 32, img_size[0] // 32, 3, 6 + class_num), np.float32)
-    y_true_26 = np.zeros((img_size[1] // 16, img_size[0] // 16, 3, 6 + class_num), np.float32)
-    y_true_52 = np.zeros((img_size[1] // 8, img_size[0] // 8, 3, 6 + class_num), np.float32)
-
-    # mix up weight default to 1.
-    y_true_13[..., -1] = 1.
-    y_true_26[..., -1] = 1.
-    y_true_52[..., -1] = 1.
-
-    y_true = [y_true_13, y_true_26, y_true_52]
-
     # [N, 1, 2]
     box_sizes = np.expand_dims(box_sizes, 1)
     # broadcast tricks
@@ -91,48 +139,59 @@ def process_box(boxes, labels, img_size, class_num, anchors):
     # [N]
     best_match_idx = np.argmax(iou, axis=1)
 
-    ratio_dict = {1.: 8., 2.: 16., 3.: 32.}
-    for i, idx in enumerate(best_match_idx):
-        # idx: 0,1,2 ==> 2; 3,4,5 ==> 1; 6,7,8 ==> 0
-        feature_map_group = 2 - idx // 3
-        # scale ratio: 0,1,2 ==> 8; 3,4,5 ==> 16; 6,7,8 ==> 32
-        ratio = ratio_dict[np.ceil((idx + 1) / 3.)]
-        x = int(np.floor(box_centers[i, 0] / ratio))
-        y = int(np.floor(box_centers[i, 1] / ratio))
-        k = anchors_mask[feature_map_group].index(idx)
-        c = labels[i]
-        # print(feature_map_group, '|', y,x,k,c)
-
-        y_true[feature_map_group][y, x, k, :2] = box_centers[i]
-        y_true[feature_map_group][y, x, k, 2:4] = box_sizes[i]
-        y_true[feature_map_group][y, x, k, 4] = 1.
-        y_true[feature_map_group][y, x, k, 5 + c] = 1.
-        y_true[feature_map_group][y, x, k, -1] = boxes[i, -1]
-
+    # the row of each box in the buffer, the centers on or beyond the image edges go to the edge cells like
+    # `tf_data_utils.tf_process_box`
+    first_row, grid_h, grid_w, k = anchor_rows[best_match_idx].T
+    xy = np.floor(box_centers / anchor_ratio[best_match_idx][:, None]).astype(np.int64)
+    xy = np.clip(xy, 0, np.stack([grid_w - 1, grid_h - 1], axis=1))
+    rows = first_row + (xy[:, 1] * grid_w + xy[:, 0]) * 3 + k
+
+    # the last box of each cell wins, the same as writing the boxes one by one
+    if len(rows) > 1:
+        _, last = np.unique(rows[::-1], return_index=True)
+        last = len(rows) - 1 - last
+    else:
+        last = np.arange(len(rows))
+    out[rows[last], 0:2] = box_centers[last]
+    out[rows[last], 2:4] = box_sizes[last, 0]
+    out[rows[last], 4] = 1.
+    out[rows[last], -1] = boxes[last, -1]
+    # the classes of all the boxes of the cell are kept,
+    # NOTE: the labels of the boxes dropped by `random_crop_with_constraints` are not dropped, the first labels are used
+    out[rows, 5 + labels[:len(rows)]] = 1.
+
+    y_true_13, y_true_26, y_true_52 = split_y_true(out, img_size, class_num)
     return y_true_13, y_true_26, y_true_52
 
 
-def parse_data(line, class_num, img_size, anchors, mode, letterbox_resize):
+def parse_data(line, class_num, img_size, anchors, mode, letterbox_resize, anno_store=None, y_true_out=None, uint8=False, color_distort=False):
     '''
     param:
-        line: a line from the training/test txt file
+        line: a line from the training/test txt file, or the index of the image in anno_store
         class_num: totol class nums.
         img_size: the size of image to be resized to. [width, height] format.
         anchors: anchors.
         mode: 'train' or 'val'. When set to 'train', data_augmentation will be applied.
         letterbox_resize: whether to use the letterbox resize, i.e., keep the original aspect ratio in the resized image.
+        anno_store: path of the annotation txt file or store, see `anno_utils`. If given, the annotation is read from
+            the binary store instead of parsing the line.
+        y_true_out: the y_true buffer to write into, see `process_box`.
+        uint8: return the image as uint8 in range 0~255, the model normalizes it, see `yolov3.forward`.
+        color_distort: random HSV color jittering in 'train' mode, see `color_utils.random_hsv_jitter`.
     '''
+    parse_fn = parse_line if anno_store is None else open_annotation_store(anno_store).parse
+
     if not isinstance(line, list):
-        img_idx, pic_path, boxes, labels, _, _ = parse_line(line)
-        img = cv2.imread(pic_path)
+        img_idx, pic_path, boxes, labels, _, _ = parse_fn(line)
+        img = cv2_imread(pic_path)
         # expand the 2nd dimension, mix up weight default to 1.
         boxes = np.concatenate((boxes, np.full(shape=(boxes.shape[0], 1), fill_value=1., dtype=np.float32)), axis=-1)
     else:
         # the mix up case
-        _, pic_path1, boxes1, labels1, _, _ = parse_line(line[0])
-        img1 = cv2.imread(pic_path1)
-        img_idx, pic_path2, boxes2, labels2, _, _ = parse_line(line[1])
-        img2 = cv2.imread(pic_path2)
+        _, pic_path1, boxes1, labels1, _, _ = parse_fn(line[0])
+        img1 = cv2_imread(pic_path1)
+        img_idx, pic_path2, boxes2, labels2, _, _ = parse_fn(line[1])
+        img2 = cv2_imread(pic_path2)
 
         img, boxes = mix_up(img1, img2, boxes1, boxes2)
         labels = np.concatenate((labels1, labels2))
@@ -140,9 +199,8 @@ def parse_data(line, class_num, img_size, anchors, mode, letterbox_resize):
     if mode == b'train':
         # random color jittering
         # NOTE: applying color distort may lead to bad performance sometimes
-# =============================================================================
-#         img = random_color_distort(img)
-# =============================================================================
+        if color_distort:
+            img = random_hsv_jitter(img, bgr=True)
 
         # random expansion with prob 0.5
         if np.random.uniform(0, 1) > 0.5:
@@ -165,61 +223,193 @@ def parse_data(line, class_num, img_size, anchors, mode, letterbox_resize):
     else:
         img, boxes = resize_with_bbox(img, boxes, img_size[0], img_size[1], interp=1, letterbox=letterbox_resize)
 
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB).astype(np.float32)
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
-    # the input of yolo_v3 should be in range 0~1
-    img = img / 255.
+    if not uint8:
+        # the input of yolo_v3 should be in range 0~1
+        img = img.astype(np.float32) / 255.
 
-    y_true_13, y_true_26, y_true_52 = process_box(boxes, labels, img_size, class_num, anchors)
+    y_true_13, y_true_26, y_true_52 = process_box(boxes, labels, img_size, class_num, anchors, y_true_out)
 
     return img_idx, img, y_true_13, y_true_26, y_true_52
 
 
-def get_batch_data(batch_line, class_num, img_size, anchors, mode, multi_scale=False, mix_up=False, letterbox_resize=True, interval=10):
+def load_sample(line, parse_fn):
+    '''
+    Read the annotation and the (cached) image of a sample for `parse_batch_data`.
+    return: img_idx, the BGR image, the boxes [N, 6]: x_min, y_min, x_max, y_max, mixup_weight, label.
+        The labels are kept in the boxes so that they follow them through the cropping and the merges.
+    '''
+    img_idx, pic_path, boxes, labels, _, _ = parse_fn(line)
+    img = cv2_imread(pic_path)
+    boxes = np.concatenate((boxes, np.ones((len(boxes), 1), np.float32), labels[:, None].astype(np.float32)), axis=-1)
+    return img_idx, img, boxes
+
+
+def augment_into(img, boxes, img_size, mode, letterbox_resize, dst, color_distort=False):
+    '''
+    The augmentation of `parse_data` for one image, written in dst: the random expansion, cropping, resize and flip
+    are composed into one affine matrix, the image is warped once and the boxes are transformed with one matrix
+    multiply, see `aug_utils`. No expanded canvas or intermediate image is allocated.
+    img: the BGR image, dst: its [h, w, 3] uint8 place in the batch, BGR too.
+    boxes: [N, 5+], the extra columns follow their boxes.
+    return: the boxes in dst
+    '''
+    width, height = img_size
+    h, w, _ = img.shape
+    # the crop window, in the coordinates of the (expanded) image
+    x0, y0, crop_w, crop_h = 0, 0, w, h
+    expanded = False
+    interp, flip = cv2.INTER_LINEAR, False
+
+    if mode == b'train':
+        # random expansion with prob 0.5, same sampling as `random_expand`
+        if np.random.uniform(0, 1) > 0.5:
+            ratio = random.uniform(1, 4)
+            crop_h, crop_w = int(h * ratio), int(w * ratio)
+            off_y, off_x = random.randint(0, crop_h - h), random.randint(0, crop_w - w)
+            boxes = boxes + np.array([off_x, off_y, off_x, off_y] + [0] * (boxes.shape[1] - 4), boxes.dtype)
+            x0, y0, expanded = -off_x, -off_y, True
+
+        # random cropping, with all the trials sampled at once
+        boxes, crop = fast_random_crop_with_constraints(boxes, (crop_w, crop_h))
+        x0, y0, crop_w, crop_h = x0 + crop[0], y0 + crop[1], crop[2], crop[3]
+
+        # random interpolation and horizontal flip
+        interp = np.random.randint(0, 5)
+        flip = np.random.uniform(0, 1) < 0.5
+
+    # crop window -> resized image, like `resize_with_bbox`
+    if letterbox_resize:
+        resize_ratio = min(width / crop_w, height / crop_h)
+        resize_w, resize_h = int(resize_ratio * crop_w), int(resize_ratio * crop_h)
+        dw, dh = int((width - resize_w) / 2), int((height - resize_h) / 2)
+        # the image is resized to the rounded down size, the boxes are scaled by resize_ratio
+        M = affine_matrices(resize_w / crop_w, resize_h / crop_h, dw, dh, flip, width)[0]
+        boxes = transform_boxes(boxes, affine_matrices(resize_ratio, resize_ratio, dw, dh, flip, width)[0])
+    else:
+        M = affine_matrices(width / crop_w, height / crop_h, 0, 0, flip, width)[0]
+        boxes = transform_boxes(boxes, M)
+
+    # the expansion outside of the image is black, and the letterbox border is grey
+    warp_image(img, compose(M, affine_matrices(1., 1., -x0, -y0)[0]), dst, interp, (0, 0, 0) if expanded else None)
+    roi = np.rint(transform_boxes(np.array([[0, 0, crop_w, crop_h]]), M)[0]).astype(int)
+    dst[:roi[1]] = 128
+    dst[roi[3]:] = 128
+    dst[:, :roi[0]] = 128
+    dst[:, roi[2]:] = 128
+
+    # random color jittering on the image area, the borders keep their color
+    if color_distort and mode == b'train':
+        img_roi = dst[roi[1]: roi[3], roi[0]: roi[2]]
+        img_roi[...] = random_hsv_jitter(img_roi, bgr=True)
+    return boxes
+
+
+def parse_batch_data(batch_line, class_num, img_size, anchors, mode, letterbox_resize, y_true_out, anno_store=None,
+                     uint8=False, color_distort=False, mix_up=False, mosaic=False, mix_up_prob=0.5, mosaic_prob=0.5):
+    '''
+    Batch version of `parse_data`: every image is augmented once into the preallocated batch, see `augment_into`.
+    The params are the ones of `parse_data`, y_true_out is the batch buffer.
+    In 'train' mode, the mosaic and mix up samples use the other images of the batch, which are in the image cache
+    (see `cache_utils`), so they cost a resize and not a decode:
+        mosaic: with prob mosaic_prob, the image is a mosaic of itself and 3 other images, see `aug_utils.mosaic_into`.
+            With color_distort, each tile is jittered before the mosaic, so that the grey fill keeps its color.
+        mix_up: with prob mix_up_prob, the image is mixed with another augmented image, see `aug_utils.mix_up_into`
+    return: img_idx_batch, img_batch
+    '''
+    parse_fn = parse_line if anno_store is None else open_annotation_store(anno_store).parse
+    width, height = img_size
+    n = len(batch_line)
+    img_idx_batch = np.empty(n, np.int64)
+    img_batch = np.empty((n, height, width, 3), np.uint8)
+    mix_buffer = None
+
+    for b, line in enumerate(batch_line):
+        img_idx_batch[b], img, boxes = load_sample(line, parse_fn)
+        img_out = img_batch[b]
+        others = [batch_line[i] for i in range(n) if i != b]
+
+        if mode == b'train' and mosaic and others and np.random.uniform(0, 1) < mosaic_prob:
+            tiles = [(img, boxes)] + [load_sample(other, parse_fn)[1:] for other in random.choices(others, k=3)]
+            random.shuffle(tiles)
+            tile_imgs = [tile[0] for tile in tiles]
+            if color_distort:
+                tile_imgs = [random_hsv_jitter(tile_img, bgr=True) for tile_img in tile_imgs]
+            boxes = mosaic_into(tile_imgs, [tile[1] for tile in tiles], img_out)
+        else:
+            boxes = augment_into(img, boxes, img_size, mode, letterbox_resize, img_out, color_distort)
+
+        if mode == b'train' and mix_up and others and np.random.uniform(0, 1) < mix_up_prob:
+            mix_buffer = np.empty_like(img_out) if mix_buffer is None else mix_buffer
+            _, img2, boxes2 = load_sample(random.choice(others), parse_fn)
+            boxes2 = augment_into(img2, boxes2, img_size, mode, letterbox_resize, mix_buffer, color_distort)
+            boxes = mix_up_into(img_out, mix_buffer, boxes, boxes2)
+
+        cv2.cvtColor(img_out, cv2.COLOR_BGR2RGB, dst=img_out)
+        process_box(boxes[:, :5], boxes[:, 5].astype(np.int64), img_size, class_num, anchors, y_true_out[b])
+
+    if not uint8:
+        # the input of yolo_v3 should be in range 0~1
+        img_batch = img_batch.astype(np.float32) / 255.
+    return img_idx_batch, img_batch
+
+
+def scale_schedule(batch_num, img_size, multi_scale=False, interval=10, seed=None):
+    '''
+    The image size of every batch of an epoch, set ahead of time instead of being drawn by the loader threads.
+    param:
+        batch_num: number of batches in the epoch.
+        img_size: [width, height], the size of all the batches if multi_scale is False.
+        multi_scale: draw a size of MULTI_SCALE_SIZES for every interval batches, so the batches of each
+            interval block share one size and the model sees each shape in runs of interval steps.
+        seed: the schedule of a seed is always the same, e.g. pass the epoch.
+    return: [batch_num, 2] int32, [width, height] of every batch
+    '''
+    if not multi_scale:
+        return np.tile(np.asarray(img_size, np.int32), (batch_num, 1))
+    sizes = np.asarray(MULTI_SCALE_SIZES, np.int32)
+    choice = np.random.RandomState(seed).randint(len(sizes), size=(batch_num + interval - 1) // interval)
+    return np.repeat(sizes[choice], interval, axis=0)[:batch_num]
+
+
+def get_batch_data(batch_line, class_num, img_size, anchors, mode, mix_up=False, letterbox_resize=True, anno_store=None, uint8=False, color_distort=False,
+                   batch_aug=False, mosaic=False, mix_up_prob=0.5, mosaic_prob=0.5):
     '''
     generate a batch of imgs and labels
     param:
-        batch_line: a batch of lines from train/val.txt files
+        batch_line: a batch of lines from train/val.txt files, or a batch of image indices in anno_store
         class_num: num of total classes.
-        img_size: the image size to be resized to. format: [width, height].
+        img_size: the image size to be resized to. format: [width, height]. For multi_scale training, it is the size
+            of the batch in the schedule of `scale_schedule`, all the images of a batch have the same size.
         anchors: anchors. shape: [9, 2].
         mode: 'train' or 'val'. if set to 'train', data augmentation will be applied.
-        multi_scale: whether to use multi_scale training, img_size varies from [320, 320] to [640, 640] by default. Note that it will take effect only when mode is set to 'train'.
         letterbox_resize: whether to use the letterbox resize, i.e., keep the original aspect ratio in the resized image.
-        interval: change the scale of image every interval batches. Note that it's indeterministic because of the multi threading.
-    '''
-    global iter_cnt
-    # multi_scale training
-    if multi_scale and mode == b'train':
-        random.seed(iter_cnt // interval)
-        random_img_size = [[x * 32, x * 32] for x in range(10, 20)]
-        img_size = random.sample(random_img_size, 1)[0]
-    iter_cnt += 1
-
-    img_idx_batch, img_batch, y_true_13_batch, y_true_26_batch, y_true_52_batch = [], [], [], [], []
-
-    # mix up strategy
-# =============================================================================
-#     if mix_up and mode == 'train':
-#         mix_lines = []
-#         batch_line = batch_line.tolist()
-#         for idx, line in enumerate(batch_line):
-#             if np.random.uniform(0, 1) < 1:#0.5:
-#                 mix_lines.append([line, random.sample(batch_line[:idx] + batch_line[idx+1:], 1)[0]])
-#             else:
-#                 mix_lines.append(line)
-#         batch_line = mix_lines
-# =============================================================================
-
-    for line in batch_line:
-        img_idx, img, y_true_13, y_true_26, y_true_52 = parse_data(line, class_num, img_size, anchors, mode, letterbox_resize)
-
-        img_idx_batch.append(img_idx)
-        img_batch.append(img)
-        y_true_13_batch.append(y_true_13)
-        y_true_26_batch.append(y_true_26)
-        y_true_52_batch.append(y_true_52)
-
-    img_idx_batch, img_batch, y_true_13_batch, y_true_26_batch, y_true_52_batch = np.asarray(img_idx_batch, np.int64), np.asarray(img_batch), np.asarray(y_true_13_batch), np.asarray(y_true_26_batch), np.asarray(y_true_52_batch)
+        anno_store: path of the annotation txt file or store to read the annotations from, see `parse_data`.
+        uint8: uint8 images, 4 times smaller than float32 in the tf.data queues, see `parse_data`.
+        color_distort: random HSV color jittering, see `parse_data`.
+        batch_aug: augment the whole batch at once with `parse_batch_data`.
+        mix_up, mosaic: whether to use the mix up / mosaic augmentations, see `parse_batch_data`.
+        mix_up_prob, mosaic_prob: the probability of the mix up / mosaic of an image when they are used.
+    '''
+    img_size = [int(x) for x in img_size]
+    img_idx_batch, img_batch = [], []
+    # the y_true of the images are written in place in the batch buffer
+    y_true_batch = get_y_true_buffer(img_size, class_num, len(batch_line))
+
+    # the mix up and mosaic strategies are stages of the batch augmentation
+    if batch_aug or ((mix_up or mosaic) and mode == b'train'):
+        img_idx_batch, img_batch = parse_batch_data(batch_line, class_num, img_size, anchors, mode, letterbox_resize, y_true_batch,
+                                                    anno_store, uint8, color_distort, mix_up, mosaic, mix_up_prob,
+                                                    mosaic_prob)
+    else:
+        for b, line in enumerate(batch_line):
+            img_idx, img, _, _, _ = parse_data(line, class_num, img_size, anchors, mode, letterbox_resize, anno_store, y_true_batch[b], uint8, color_distort)
+
+            img_idx_batch.append(img_idx)
+            img_batch.append(img)
+
+        img_idx_batch, img_batch = np.asarray(img_idx_batch, np.int64), np.asarray(img_batch)
+    y_true_13_batch, y_true_26_batch, y_true_52_batch = split_y_true(y_true_batch, img_size, class_num)
 
     return img_idx_batch, img_batch, y_true_13_batch, y_true_26_batch, y_true_52_batch
@@ -1,9 +1,9 @@
+import os
 import numpy as np
 import cv2
-from collections import Counter
 
-from utils.nms_utils import cpu_nms, gpu_nms
-from utils.data_utils import parse_line
+from utils.nms_utils import batched_nms
+from utils.anno_utils import open_annotation_store
 
 
 def calc_iou(pred_boxes, true_boxes):
@@ -41,89 +41,98 @@ def calc_iou(pred_boxes, true_boxes):
     return iou
 
 
-def evaluate_on_cpu(y_pred, y_true, num_classes, calc_now=True, max_boxes=50, score_thresh=0.5, iou_thresh=0.5):
+def get_true_boxes(y_true):
     '''
-    Given y_pred and y_true of a batch of data, get the recall and precision of the current batch.
+    Extract the ground truth boxes of a whole batch from the y_true of the three feature maps.
+    return:
+        img_idx: [V], the index of the image in the batch each gt box belongs to.
+        boxes: [V, 4], (xmin, ymin, xmax, ymax), float64.
+        labels: [V], class index.
+        V: gt box number of the whole batch. The boxes of an image keep the order
+        of the feature maps (13, 26, 52), then the grid order.
+    '''
+    img_idx_list, boxes_list, labels_list = [], [], []
+    for j in range(3):  # three feature maps
+        # shape: [N, 13, 13, 3, 80]
+        true_probs_temp = y_true[j][..., 5:-1]
+        # [N, 13, 13, 3]
+        object_mask = true_probs_temp.sum(axis=-1) > 0
+
+        img_idx_list.append(np.nonzero(object_mask)[0])
+        # [V, 4] (x_center, y_center, w, h)
+        boxes_list.append(y_true[j][..., 0:4][object_mask])
+        # [V], labels
+        labels_list.append(np.argmax(true_probs_temp[object_mask], axis=-1))
+
+    img_idx = np.concatenate(img_idx_list)
+    # stable sort, so the feature map order is kept inside an image
+    order = np.argsort(img_idx, kind='stable')
+    img_idx = img_idx[order]
+    labels = np.concatenate(labels_list)[order]
+
+    # [V, 4] (xmin, ymin, xmax, ymax)
+    boxes = np.concatenate(boxes_list)[order].astype(np.float64)
+    box_centers, box_sizes = boxes[:, 0:2], boxes[:, 2:4]
+    boxes[:, 0:2] = box_centers - box_sizes / 2.
+    boxes[:, 2:4] = boxes[:, 0:2] + box_sizes
+
+    return img_idx, boxes, labels
+
+
+def calc_batch_stats(true_img_idx, true_boxes, true_labels, pred_img_idx, pred_boxes, pred_labels,
+                     num_classes, iou_thresh=0.5):
+    '''
+    Match the predictions of a whole batch to the ground truth.
+    Each prediction is assigned to the gt box of the same image with the highest IoU, and counts as
+    a true positive if the IoU > iou_thresh and the labels agree. A gt box matched by several
+    predictions is counted once.
+    return:
+        true_positive_dict, true_labels_dict, pred_labels_dict: {class: count}
     '''
+    true_labels_cnt = np.bincount(true_labels, minlength=num_classes)
+    pred_labels_cnt = np.bincount(pred_labels, minlength=num_classes)
+    true_positive_cnt = np.zeros(num_classes, dtype=np.int64)
 
-    num_images = y_true[0].shape[0]
-    true_labels_dict = {i: 0 for i in range(num_classes)}  # {class: count}
-    pred_labels_dict = {i: 0 for i in range(num_classes)}
-    true_positive_dict = {i: 0 for i in range(num_classes)}
-
-    for i in range(num_images):
-        true_labels_list, true_boxes_list = [], []
-        for j in range(3):  # three feature maps
-            # shape: [13, 13, 3, 80]
-            true_probs_temp = y_true[j][i][..., 5:-1]
-            # shape: [13, 13, 3, 4] (x_center, y_center, w, h)
-            true_boxes_temp = y_true[j][i][..., 0:4]
-
-            # [13, 13, 3]
-            object_mask = true_probs_temp.sum(axis=-1) > 0
-
-            # [V, 3] V: Ground truth number of the current image
-            true_probs_temp = true_probs_temp[object_mask]
-            # [V, 4]
-            true_boxes_temp = true_boxes_temp[object_mask]
-
-            # [V], labels
-            true_labels_list += np.argmax(true_probs_temp, axis=-1).tolist()
-            # [V, 4] (x_center, y_center, w, h)
-            true_boxes_list += true_boxes_temp.tolist()
-
-        if len(true_labels_list) != 0:
-            for cls, count in Counter(true_labels_list).items():
-                true_labels_dict[cls] += count
-
-        # [V, 4] (xmin, ymin, xmax, ymax)
-        true_boxes = np.array(true_boxes_list)
-        box_centers, box_sizes = true_boxes[:, 0:2], true_boxes[:, 2:4]
-        true_boxes[:, 0:2] = box_centers - box_sizes / 2.
-        true_boxes[:, 2:4] = true_boxes[:, 0:2] + box_sizes
-
-        # [1, xxx, 4]
-        pred_boxes = y_pred[0][i:i + 1]
-        pred_confs = y_pred[1][i:i + 1]
-        pred_probs = y_pred[2][i:i + 1]
-
-        # pred_boxes: [N, 4]
-        # pred_confs: [N]
-        # pred_labels: [N]
-        # N: Detected box number of the current image
-        pred_boxes, pred_confs, pred_labels = cpu_nms(pred_boxes, pred_confs * pred_probs, num_classes,
-                                                      max_boxes=max_boxes, score_thresh=score_thresh, iou_thresh=iou_thresh)
-
-        # len: N
-        pred_labels_list = [] if pred_labels is None else pred_labels.tolist()
-        if pred_labels_list == []:
-            continue
-
-        # calc iou
-        # [N, V]
+    if len(pred_labels) > 0 and len(true_labels) > 0:
+        # [N, V], boxes from different images never match
         iou_matrix = calc_iou(pred_boxes, true_boxes)
+        iou_matrix[pred_img_idx[:, None] != true_img_idx] = -1.
         # [N]
         max_iou_idx = np.argmax(iou_matrix, axis=-1)
+        max_iou = iou_matrix[np.arange(len(max_iou_idx)), max_iou_idx]
 
-        correct_idx = []
-        correct_conf = []
-        for k in range(max_iou_idx.shape[0]):
-            pred_labels_dict[pred_labels_list[k]] += 1
-            match_idx = max_iou_idx[k]  # V level
-            if iou_matrix[k, match_idx] > iou_thresh and true_labels_list[match_idx] == pred_labels_list[k]:
-                if match_idx not in correct_idx:
-                    correct_idx.append(match_idx)
-                    correct_conf.append(pred_confs[k])
-                else:
-                    same_idx = correct_idx.index(match_idx)
-                    if pred_confs[k] > correct_conf[same_idx]:
-                        correct_idx.pop(same_idx)
-                        correct_conf.pop(same_idx)
-                        correct_idx.append(match_idx)
-                        correct_conf.append(pred_confs[k])
-
-        for t in correct_idx:
-            true_positive_dict[true_labels_list[t]] += 1
+        correct = (max_iou > iou_thresh) & (true_labels[max_iou_idx] == pred_labels)
+        correct_idx = np.unique(max_iou_idx[correct])
+        true_positive_cnt = np.bincount(true_labels[correct_idx], minlength=num_classes)
+
+    true_positive_dict = {i: int(true_positive_cnt[i]) for i in range(num_classes)}
+    true_labels_dict = {i: int(true_labels_cnt[i]) for i in range(num_classes)}
+    pred_labels_dict = {i: int(pred_labels_cnt[i]) for i in range(num_classes)}
+    return true_positive_dict, true_labels_dict, pred_labels_dict
+
+
+def evaluate_on_cpu(y_pred, y_true, num_classes, calc_now=True, max_boxes=50, score_thresh=0.5, iou_thresh=0.5,
+                    nms_method='nms', class_agnostic=False, pre_nms_topk=None):
+    '''
+    Given y_pred and y_true of a batch of data, get the recall and precision of the current batch.
+    nms_method and class_agnostic select the NMS variant, pre_nms_topk the candidates of each class, see
+    `nms_utils.batched_nms`.
+    '''
+    true_img_idx, true_boxes, true_labels = get_true_boxes(y_true)
+
+    # NMS of the whole batch at once
+    # pred_boxes: [B, M, 4], pred_labels: [B, M], counts: [B]
+    pred_boxes, pred_confs, pred_labels, counts = batched_nms(y_pred[0], y_pred[1] * y_pred[2], num_classes,
+                                                              max_boxes=max_boxes, score_thresh=score_thresh,
+                                                              iou_thresh=iou_thresh, method=nms_method,
+                                                              class_agnostic=class_agnostic, pre_nms_topk=pre_nms_topk)
+    # [B, M] ==> [N], N: detected box number of the whole batch
+    valid_mask = np.arange(pred_labels.shape[1]) < counts[:, None]
+    pred_img_idx = np.nonzero(valid_mask)[0]
+
+    true_positive_dict, true_labels_dict, pred_labels_dict = calc_batch_stats(
+        true_img_idx, true_boxes, true_labels, pred_img_idx, pred_boxes[valid_mask], pred_labels[valid_mask],
+        num_classes, iou_thresh)
 
     if calc_now:
         # avoid divided by 0
@@ -138,87 +147,30 @@ def evaluate_on_cpu(y_pred, y_true, num_classes, calc_now=True, max_boxes=50, sc
 def evaluate_on_gpu(sess, gpu_nms_op, pred_boxes_flag, pred_scores_flag, y_pred, y_true, num_classes, iou_thresh=0.5, calc_now=True):
     '''
     Given y_pred and y_true of a batch of data, get the recall and precision of the current batch.
-    This function will perform gpu operation on the GPU.
+    gpu_nms_op is the NMS of a whole batch, `nms_utils.gpu_batch_nms` or `nms_utils.combined_nms` built on the
+    placeholders pred_boxes_flag [None, None, 4] and pred_scores_flag [None, None, num_classes]: it runs once for
+    all the images, then its padded detections are evaluated by `evaluate_batch_preds`.
     '''
+    boxes, scores, labels, num_detections = sess.run(gpu_nms_op,
+                                                     feed_dict={pred_boxes_flag: y_pred[0],
+                                                                pred_scores_flag: y_pred[1] * y_pred[2]})
+    return evaluate_batch_preds(y_true, boxes, scores, labels, num_detections, num_classes, iou_thresh, calc_now)
 
-    num_images = y_true[0].shape[0]
-    true_labels_dict = {i: 0 for i in range(num_classes)}  # {class: count}
-    pred_labels_dict = {i: 0 for i in range(num_classes)}
-    true_positive_dict = {i: 0 for i in range(num_classes)}
-
-    for i in range(num_images):
-        true_labels_list, true_boxes_list = [], []
-        for j in range(3):  # three feature maps
-            # shape: [13, 13, 3, 80]
-            true_probs_temp = y_true[j][i][..., 5:-1]
-            # shape: [13, 13, 3, 4] (x_center, y_center, w, h)
-            true_boxes_temp = y_true[j][i][..., 0:4]
-
-            # [13, 13, 3]
-            object_mask = true_probs_temp.sum(axis=-1) > 0
-
-            # [V, 80] V: Ground truth number of the current image
-            true_probs_temp = true_probs_temp[object_mask]
-            # [V, 4]
-            true_boxes_temp = true_boxes_temp[object_mask]
-
-            # [V], labels, each from 0 to 79
-            true_labels_list += np.argmax(true_probs_temp, axis=-1).tolist()
-            # [V, 4] (x_center, y_center, w, h)
-            true_boxes_list += true_boxes_temp.tolist()
-
-        if len(true_labels_list) != 0:
-            for cls, count in Counter(true_labels_list).items():
-                true_labels_dict[cls] += count
-
-        # [V, 4] (xmin, ymin, xmax, ymax)
-        true_boxes = np.array(true_boxes_list)
-        box_centers, box_sizes = true_boxes[:, 0:2], true_boxes[:, 2:4]
-        true_boxes[:, 0:2] = box_centers - box_sizes / 2.
-        true_boxes[:, 2:4] = true_boxes[:, 0:2] + box_sizes
-
-        # [1, xxx, 4]
-        pred_boxes = y_pred[0][i:i + 1]
-        pred_confs = y_pred[1][i:i + 1]
-        pred_probs = y_pred[2][i:i + 1]
-
-        # pred_boxes: [N, 4]
-        # pred_confs: [N]
-        # pred_labels: [N]
-        # N: Detected box number of the current image
-        pred_boxes, pred_confs, pred_labels = sess.run(gpu_nms_op,
-                                                       feed_dict={pred_boxes_flag: pred_boxes,
-                                                                  pred_scores_flag: pred_confs * pred_probs})
-        # len: N
-        pred_labels_list = [] if pred_labels is None else pred_labels.tolist()
-        if pred_labels_list == []:
-            continue
-
-        # calc iou
-        # [N, V]
-        iou_matrix = calc_iou(pred_boxes, true_boxes)
-        # [N]
-        max_iou_idx = np.argmax(iou_matrix, axis=-1)
 
-        correct_idx = []
-        correct_conf = []
-        for k in range(max_iou_idx.shape[0]):
-            pred_labels_dict[pred_labels_list[k]] += 1
-            match_idx = max_iou_idx[k]  # V level
-            if iou_matrix[k, match_idx] > iou_thresh and true_labels_list[match_idx] == pred_labels_list[k]:
-                if match_idx not in correct_idx:
-                    correct_idx.append(match_idx)
-                    correct_conf.append(pred_confs[k])
-                else:
-                    same_idx = correct_idx.index(match_idx)
-                    if pred_confs[k] > correct_conf[same_idx]:
-                        correct_idx.pop(same_idx)
-                        correct_conf.pop(same_idx)
-                        correct_idx.append(match_idx)
-                        correct_conf.append(pred_confs[k])
-
-        for t in correct_idx:
-            true_positive_dict[true_labels_list[t]] += 1
+def evaluate_batch_preds(y_true, boxes, scores, labels, num_detections, num_classes, iou_thresh=0.5, calc_now=True):
+    '''
+    Get the recall and precision of a batch from its padded detections, e.g. the ones of `yolov3.predict(nms=True)`
+    fetched with y_true: boxes [B, K, 4], scores [B, K], labels [B, K] and num_detections [B].
+    '''
+    true_img_idx, true_boxes, true_labels = get_true_boxes(y_true)
+
+    # [B, K] ==> [N], N: detected box number of the whole batch
+    valid_mask = np.arange(labels.shape[1]) < num_detections[:, None]
+    pred_img_idx = np.nonzero(valid_mask)[0]
+
+    true_positive_dict, true_labels_dict, pred_labels_dict = calc_batch_stats(
+        true_img_idx, true_boxes, true_labels, pred_img_idx, boxes[valid_mask], labels[valid_mask],
+        num_classes, iou_thresh)
 
     if calc_now:
         # avoid divided by 0
@@ -257,49 +209,124 @@ def get_preds_gpu(sess, gpu_nms_op, pred_boxes_flag, pred_scores_flag, image_ids
     return pred_content
 
 
-gt_dict = {}  # key: img_id, value: gt object list
-def parse_gt_rec(gt_filename, target_img_size, letterbox_resize=True):
+def get_batch_preds(image_ids, boxes, scores, labels, num_detections):
     '''
-    parse and re-organize the gt info.
+    Unpack the padded detections of `nms_utils.gpu_batch_nms` per image id.
     return:
-        gt_dict: dict. Each key is a img_id, the value is the gt bboxes in the corresponding img.
+        pred_content: 2d list, the rows of `get_preds_gpu` for all the images of the batch.
     '''
+    pred_content = []
+    for image_id, image_boxes, image_scores, image_labels, num in zip(image_ids, boxes, scores, labels, num_detections):
+        for (x_min, y_min, x_max, y_max), score, label in zip(image_boxes[:num], image_scores[:num], image_labels[:num]):
+            pred_content.append([image_id, x_min, y_min, x_max, y_max, score, label])
+    return pred_content
 
-    global gt_dict
-
-    if not gt_dict:
-        new_width, new_height = target_img_size
-        with open(gt_filename, 'r') as f:
-            for line in f:
-                img_id, pic_path, boxes, labels, ori_width, ori_height = parse_line(line)
-
-                objects = []
-                for i in range(len(labels)):
-                    x_min, y_min, x_max, y_max = boxes[i]
-                    label = labels[i]
-
-                    if letterbox_resize:
-                        resize_ratio = min(new_width / ori_width, new_height / ori_height)
-
-                        resize_w = int(resize_ratio * ori_width)
-                        resize_h = int(resize_ratio * ori_height)
 
-                        dw = int((new_width - resize_w) / 2)
-                        dh = int((new_height - resize_h) / 2)
+class GTIndex(object):
+    '''
+    The gt info of an annotation file, stored in contiguous arrays.
+    The gt of the image img_ids[i] are boxes[offsets[i]: offsets[i + 1]] and labels[offsets[i]: offsets[i + 1]].
+    The boxes of a class are also kept contiguous in class_boxes[c], with their image in class_img_ids[c].
+    It can be used as the old gt_dict: iterating over it gives the img_ids, and gt_index[img_id]
+    gives the list of [x_min, y_min, x_max, y_max, label] of the image.
+    '''
+    def __init__(self, img_ids, offsets, boxes, labels):
+        self.img_ids = np.asarray(img_ids, np.int64)
+        self.offsets = np.asarray(offsets, np.int64)
+        self.boxes = np.asarray(boxes, np.float64).reshape(-1, 4)
+        self.labels = np.asarray(labels, np.int64)
+        self.position = {img_id: i for i, img_id in enumerate(self.img_ids.tolist())}
+
+        box_img_ids = np.repeat(self.img_ids, np.diff(self.offsets))
+        self.class_boxes, self.class_img_ids = {}, {}
+        for c in np.unique(self.labels).tolist():
+            self.class_boxes[c] = self.boxes[self.labels == c]
+            self.class_img_ids[c] = box_img_ids[self.labels == c]
+
+    @classmethod
+    def from_dict(cls, gt_dict):
+        img_ids, offsets, boxes, labels = [], [0], [], []
+        for img_id in gt_dict:
+            img_ids.append(img_id)
+            for obj in gt_dict[img_id]:
+                boxes.append(obj[:4])
+                labels.append(obj[-1])
+            offsets.append(len(labels))
+        return cls(img_ids, offsets, boxes, labels)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['img_ids'], data['offsets'], data['boxes'], data['labels'])
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, img_ids=self.img_ids, offsets=self.offsets, boxes=self.boxes, labels=self.labels)
+
+    def gt_range(self, img_id):
+        i = self.position[img_id]
+        return self.offsets[i], self.offsets[i + 1]
+
+    def __len__(self):
+        return len(self.img_ids)
+
+    def __iter__(self):
+        return iter(self.img_ids.tolist())
+
+    def __contains__(self, img_id):
+        return img_id in self.position
+
+    def __getitem__(self, img_id):
+        start, end = self.gt_range(img_id)
+        return [box + [label] for box, label in zip(self.boxes[start:end].tolist(), self.labels[start:end].tolist())]
+
+
+gt_index_cache = {}  # key: (gt_filename, target_img_size, letterbox_resize), value: GTIndex
+def parse_gt_rec(gt_filename, target_img_size, letterbox_resize=True, use_cache_file=True):
+    '''
+    parse and re-organize the gt info.
+    The result is cached per (gt_filename, target_img_size, letterbox_resize), and saved to a `.npz` file
+    next to gt_filename if use_cache_file is True, so that the next run can skip the parsing.
+    return:
+        gt_index: GTIndex. It can be used as a dict: each key is a img_id, the value is the gt bboxes in the corresponding img.
+    '''
+    new_width, new_height = int(target_img_size[0]), int(target_img_size[1])
+    key = (os.path.abspath(gt_filename), (new_width, new_height), bool(letterbox_resize))
+    if key in gt_index_cache:
+        return gt_index_cache[key]
+
+    cache_path = '{}.gt_{}x{}{}.npz'.format(gt_filename, new_width, new_height, '_letterbox' if letterbox_resize else '')
+    if use_cache_file and os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(gt_filename):
+        gt_index_cache[key] = GTIndex.load(cache_path)
+        return gt_index_cache[key]
+
+    # the parsed annotations, see `anno_utils`
+    store = open_annotation_store(gt_filename)
+    offsets = np.array(store.offsets)
+    boxes = store.boxes.astype(np.float64)
+    # [G, 1] original size of the image of each box
+    ori_sizes = np.repeat(store.img_sizes.astype(np.float64), np.diff(offsets), axis=0)
+    ori_width, ori_height = ori_sizes[:, 0:1], ori_sizes[:, 1:2]
+
+    if letterbox_resize:
+        resize_ratio = np.minimum(new_width / ori_width, new_height / ori_height)
+
+        resize_w = np.floor(resize_ratio * ori_width)
+        resize_h = np.floor(resize_ratio * ori_height)
+
+        dw = np.floor((new_width - resize_w) / 2)
+        dh = np.floor((new_height - resize_h) / 2)
+
+        boxes = boxes * resize_ratio + np.concatenate([dw, dh, dw, dh], axis=-1)
+    else:
+        boxes = boxes * np.asarray([new_width, new_height, new_width, new_height]) / \
+            np.concatenate([ori_width, ori_height, ori_width, ori_height], axis=-1)
 
-                        objects.append([x_min * resize_ratio + dw,
-                                        y_min * resize_ratio + dh,
-                                        x_max * resize_ratio + dw,
-                                        y_max * resize_ratio + dh,
-                                        label])
-                    else:
-                        objects.append([x_min * new_width / ori_width,
-                                        y_min * new_height / ori_height,
-                                        x_max * new_width / ori_width,
-                                        y_max * new_height / ori_height,
-                                        label])
-                gt_dict[img_id] = objects
-    return gt_dict
+    gt_index = GTIndex(store.line_idx, offsets, boxes, store.labels)
+    if use_cache_file:
+        gt_index.save(cache_path)
+    gt_index_cache[key] = gt_index
+    return gt_index
 
 
 # The following two functions are modified from FAIR's Detectron repo to calculate mAP:
@@ -323,9 +350,8 @@ def voc_ap(rec, prec, use_07_metric=False):
         mrec = np.concatenate(([0.], rec, [1.]))
         mpre = np.concatenate(([0.], prec, [0.]))
 
-        # compute the precision envelope
-        for i in range(mpre.size - 1, 0, -1):
-            mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+        # compute the precision envelope, i.e. the reverse cumulative maximum
+        mpre = np.maximum.accumulate(mpre[::-1])[::-1]
 
         # to calculate area under PR curve, look for points
         # where X axis (recall) changes value
@@ -374,7 +400,7 @@ def voc_eval(gt_dict, val_preds, classidx, iou_thres=0.5, use_07_metric=False):
         # all the gt info in some image
         R = class_recs[img_ids[d]]
         bb = BB[d, :]
-        ovmax = -np.Inf
+        ovmax = -np.inf
         BBGT = R['bbox']
 
         if BBGT.size > 0:
@@ -416,4 +442,126 @@ def voc_eval(gt_dict, val_preds, classidx, iou_thres=0.5, use_07_metric=False):
     ap = voc_ap(rec, prec, use_07_metric)
 
     # return rec, prec, ap
-    return npos, nd, tp[-1] / float(npos), tp[-1] / float(nd), ap
\ No newline at end of file
+    return npos, nd, tp[-1] / float(npos), tp[-1] / float(nd), ap
+
+
+class APAccumulator(object):
+    '''
+    Incremental version of `voc_eval` for all the classes at once.
+    The detections are matched to the pre-indexed gt as they arrive, so only the per-class
+    scores and TP flags are kept, and the final AP is a single cumulative sum per class.
+    NOTE: like `voc_eval`, a detection can only match a gt box which is not matched by a detection
+    with a higher score, so all the detections of an image should come in the same `update` call.
+    If coco_metric is True, the TP flags are also recorded for the IoU thresholds 0.5:0.05:0.95
+    from the same IoU matrix, and `evaluate_coco` gives the AP@[.5:.95] of a class.
+    '''
+    def __init__(self, gt_dict, num_classes, iou_thres=0.5, use_07_metric=False, coco_metric=False):
+        self.num_classes = num_classes
+        self.use_07_metric = use_07_metric
+        # the first column is iou_thres, followed by the 10 coco thresholds if needed
+        self.iou_thres = np.array([iou_thres] + (list(np.linspace(0.5, 0.95, 10)) if coco_metric else []))
+
+        # gt_dict can be a GTIndex returned by `parse_gt_rec` or a plain dict
+        self.gt_index = gt_dict if isinstance(gt_dict, GTIndex) else GTIndex.from_dict(gt_dict)
+        self.npos = np.bincount(self.gt_index.labels, minlength=num_classes)
+
+        self.reset()
+
+    def reset(self):
+        self.gt_matched = np.zeros((len(self.gt_index.labels), len(self.iou_thres)), dtype=bool)
+        self.scores = [[] for _ in range(self.num_classes)]
+        self.tp = [[] for _ in range(self.num_classes)]
+
+    def update(self, preds):
+        '''
+        param:
+            preds: 2d list or array returned by `get_preds_gpu`, each row is
+                [image_id, x_min, y_min, x_max, y_max, score, label]
+        '''
+        preds = np.asarray(preds, np.float64).reshape(-1, 7)
+        if len(preds) == 0:
+            return
+
+        # sort by score, the matching order of `voc_eval`
+        preds = preds[np.argsort(-preds[:, 5])]
+        img_ids = preds[:, 0].astype(np.int64)
+        BB = preds[:, 1:5]
+        labels = preds[:, 6].astype(np.int64)
+
+        # [G] indices of the gt of the images in this batch
+        batch_img_ids = np.unique(img_ids)
+        gt_ranges = [self.gt_index.gt_range(i) for i in batch_img_ids.tolist()]
+        gt_idx = np.concatenate([np.arange(start, end) for start, end in gt_ranges])
+        gt_img_ids = np.repeat(batch_img_ids, [end - start for start, end in gt_ranges])
+        BBGT = self.gt_index.boxes[gt_idx]
+
+        # [D, G] iou, the same formula as `voc_eval`
+        ixmin = np.maximum(BBGT[:, 0], BB[:, 0:1])
+        iymin = np.maximum(BBGT[:, 1], BB[:, 1:2])
+        ixmax = np.minimum(BBGT[:, 2], BB[:, 2:3])
+        iymax = np.minimum(BBGT[:, 3], BB[:, 3:4])
+        iw = np.maximum(ixmax - ixmin + 1., 0.)
+        ih = np.maximum(iymax - iymin + 1., 0.)
+        inters = iw * ih
+        uni = ((BB[:, 2:3] - BB[:, 0:1] + 1.) * (BB[:, 3:4] - BB[:, 1:2] + 1.) +
+               (BBGT[:, 2] - BBGT[:, 0] + 1.) * (BBGT[:, 3] - BBGT[:, 1] + 1.) - inters)
+        overlaps = inters / uni
+
+        # only the gt of the same image and class can be matched
+        valid = (img_ids[:, None] == gt_img_ids) & (labels[:, None] == self.gt_index.labels[gt_idx])
+        overlaps = np.where(valid, overlaps, -np.inf)
+
+        # [D, T], T: number of iou thresholds
+        tp = np.zeros((len(preds), len(self.iou_thres)), dtype=bool)
+        if overlaps.shape[1] > 0:
+            jmax = np.argmax(overlaps, axis=1)
+            ovmax = overlaps[np.arange(len(preds)), jmax]
+            for t, iou_thres in enumerate(self.iou_thres):
+                hit = np.flatnonzero(ovmax > iou_thres)
+                # a gt is only matched by its first detection, in descending score order
+                matched, first = np.unique(gt_idx[jmax[hit]], return_index=True)
+                first = hit[first][~self.gt_matched[matched, t]]
+                tp[first, t] = True
+                self.gt_matched[matched, t] = True
+
+        for c in np.unique(labels):
+            self.scores[c].append(preds[labels == c, 5])
+            self.tp[c].append(tp[labels == c])
+
+    def _pr_curve(self, classidx, column):
+        confidence = np.concatenate(self.scores[classidx])
+        tp = np.concatenate(self.tp[classidx])[np.argsort(-confidence), column].astype(np.float64)
+
+        # compute precision recall
+        fp = np.cumsum(1. - tp)
+        tp = np.cumsum(tp)
+        rec = tp / float(self.npos[classidx])
+        prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+        return tp, rec, prec
+
+    def evaluate(self, classidx):
+        '''
+        Same return values as `voc_eval`: npos, nd, recall, precision, ap
+        '''
+        if len(self.scores[classidx]) == 0:
+            print('no box, ignore')
+            return 1e-6, 1e-6, 0, 0, 0
+        npos = int(self.npos[classidx])
+        tp, rec, prec = self._pr_curve(classidx, 0)
+        nd = len(tp)
+        ap = voc_ap(rec, prec, self.use_07_metric)
+
+        return npos, nd, tp[-1] / float(npos), tp[-1] / float(nd), ap
+
+    def evaluate_coco(self, classidx):
+        '''
+        AP@[.5:.95] of a class: the mean of the APs at the IoU thresholds 0.5:0.05:0.95.
+        '''
+        assert len(self.iou_thres) > 1, 'Set coco_metric=True to record the coco thresholds.'
+        if len(self.scores[classidx]) == 0:
+            return 0
+        aps = []
+        for column in range(1, len(self.iou_thres)):
+            _, rec, prec = self._pr_curve(classidx, column)
+            aps.append(voc_ap(rec, prec, self.use_07_metric))
+        return np.mean(aps)
@@ -0,0 +1,111 @@
+import os
+import argparse
+import tensorflow as tf
+
+from yolo3.model_GIOU import yolov3
+
+INPUT_NAME = 'input_data'
+
+
+def output_names(nms=True):
+    '''
+    The names of the outputs of the inference graph, the returns of `yolov3.predict_static`.
+    '''
+    return ['boxes', 'scores', 'labels', 'num_detections'] if nms else ['boxes', 'confs', 'probs']
+
+
+def build_inference_graph(class_num, anchors, img_size, nms=True, uint8=False, max_boxes=50, score_thresh=0.5,
+                          nms_thresh=0.5, class_agnostic=False):
+    '''
+    Build the inference graph of a fixed img_size [width, height] in the default graph: the placeholder 'input_data'
+    [None, height, width, 3] of the letterboxed images, then the model with static shapes and `yolov3.predict_static`.
+    param:
+        uint8: the input images are uint8 in range 0~255 instead of float32 in range 0~1
+        nms: the outputs are the detections after the NMS, see `nms_utils.combined_nms`
+    return: the input and the outputs, named after `output_names`
+    '''
+    inputs = tf.placeholder(tf.uint8 if uint8 else tf.float32, [None, img_size[1], img_size[0], 3], name=INPUT_NAME)
+    yolo_model = yolov3(class_num, anchors, use_static_shape=True)
+    with tf.variable_scope('yolov3'):
+        pred_feature_maps = yolo_model.forward(inputs, is_training=False)
+    outputs = yolo_model.predict_static(pred_feature_maps, img_size, nms, max_boxes, score_thresh, nms_thresh,
+                                        class_agnostic)
+    outputs = [tf.identity(output, name=name) for output, name in zip(outputs, output_names(nms))]
+    return inputs, outputs
+
+
+def export_inference_graph(restore_path, output_dir, class_num, anchors, img_size, saved_model=False, **kwargs):
+    '''
+    Export the graph of `build_inference_graph` with the weights of the checkpoint restore_path.
+    The frozen graph output_dir/frozen_graph.pb is a single file: the variables are turned into constants and the
+    training nodes are removed. If saved_model, the SavedModel output_dir/saved_model (which must not exist) has the
+    'serving_default' signature and keeps the weights as variables: its graph stays small, it loads and runs its first
+    batch faster than the frozen graph, whose weights go through the graph optimizations as constants.
+    kwargs: the other params of `build_inference_graph`
+    return: the path of the frozen graph
+    '''
+    names = output_names(kwargs.get('nms', True))
+    graph = tf.Graph()
+    with graph.as_default():
+        inputs, outputs = build_inference_graph(class_num, anchors, img_size, **kwargs)
+        with tf.Session() as sess:
+            tf.train.Saver().restore(sess, restore_path)
+            if saved_model:
+                builder = tf.saved_model.builder.SavedModelBuilder(os.path.join(output_dir, 'saved_model'))
+                signature = tf.saved_model.signature_def_utils.predict_signature_def(
+                    {INPUT_NAME: inputs}, dict(zip(names, outputs)))
+                builder.add_meta_graph_and_variables(sess, [tf.saved_model.tag_constants.SERVING],
+                                                     signature_def_map={'serving_default': signature})
+                builder.save()
+            graph_def = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), names)
+    graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=[INPUT_NAME] + names)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    pb_path = os.path.join(output_dir, 'frozen_graph.pb')
+    with open(pb_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    return pb_path
+
+
+def load_frozen_graph(pb_path):
+    '''
+    Import the frozen graph written by `export_inference_graph` into a new graph.
+    return: the graph, its input and its outputs, see `output_names`
+    '''
+    graph_def = tf.GraphDef()
+    with open(pb_path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+    nms = any(node.name == 'num_detections' for node in graph_def.node)
+    return graph, graph.get_tensor_by_name(INPUT_NAME + ':0'), \
+        [graph.get_tensor_by_name(name + ':0') for name in output_names(nms)]
+
+
+if __name__ == '__main__':
+    from utils.misc_utils import parse_anchors
+
+    parser = argparse.ArgumentParser(description='Export a checkpoint as a frozen inference graph of a fixed input size.')
+    parser.add_argument('restore_path', type=str, help='The path of the checkpoint to export.')
+    parser.add_argument('--output_dir', type=str, default='./data/export/', help='The directory of the exported graph.')
+    parser.add_argument('--anchor_path', type=str, default='./data/yolo_anchors.txt', help='The path of the anchor txt file.')
+    parser.add_argument('--class_num', type=int, required=True, help='The number of classes.')
+    parser.add_argument('--img_size', nargs=2, type=int, default=[416, 416],
+                        help='The fixed input size [width, height] of the letterboxed images.')
+    parser.add_argument('--nms', type=lambda x: (str(x).lower() == 'true'), default=True,
+                        help='Whether to export the detections after the NMS instead of all the predicted boxes.')
+    parser.add_argument('--max_boxes', type=int, default=50, help='The max number of detections per image.')
+    parser.add_argument('--score_thresh', type=float, default=0.5, help='The score threshold of the NMS.')
+    parser.add_argument('--nms_thresh', type=float, default=0.5, help='The IoU threshold of the NMS.')
+    parser.add_argument('--uint8', type=lambda x: (str(x).lower() == 'true'), default=False,
+                        help='Whether the input images are uint8 in range 0~255 instead of float32 in range 0~1.')
+    parser.add_argument('--saved_model', type=lambda x: (str(x).lower() == 'true'), default=False,
+                        help='Whether to write a SavedModel too.')
+    args = parser.parse_args()
+
+    pb_path = export_inference_graph(args.restore_path, args.output_dir, args.class_num, parse_anchors(args.anchor_path),
+                                     args.img_size, args.saved_model, nms=args.nms, uint8=args.uint8,
+                                     max_boxes=args.max_boxes, score_thresh=args.score_thresh, nms_thresh=args.nms_thresh)
+    print('{}x{} inference graph of {} written to {}'.format(args.img_size[0], args.img_size[1], args.restore_path, pb_path))
@@ -0,0 +1,133 @@
+import queue
+import traceback
+import threading
+import multiprocessing
+
+import numpy as np
+
+
+def epoch_batches(indices, batch_size, rng=np.random):
+    '''
+    Infinite stream of index batches, in the order of `train.data_generator`:
+    the indices are reshuffled at the beginning of every epoch, and a batch may span two epochs.
+    rng: np.random or a np.random.RandomState for a reproducible order
+    '''
+    indices = np.array(indices)
+    n = len(indices)
+    i = 0
+    while True:
+        batch = []
+        for b in range(batch_size):
+            if i == 0:
+                rng.shuffle(indices)
+            batch.append(indices[i])
+            i = (i + 1) % n
+        yield batch
+
+
+def _worker_loop(batch_fn, task_queue, result_queue):
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        batch_id, seed, batch = task
+        try:
+            # seeded per batch, so the result doesn't depend on which worker got the task
+            np.random.seed(seed)
+            result_queue.put((batch_id, batch_fn(batch), None))
+        except Exception:
+            result_queue.put((batch_id, None, traceback.format_exc()))
+
+
+class ProcessPoolLoader(object):
+    '''
+    Run batch_fn(batch) for every batch of batch_iter in a pool of worker processes.
+    Iterate over it to get the results, it is a drop-in for a python generator in keras `fit_generator`.
+    ordered: deliver the batches in the order of batch_iter, or as soon as they are ready if False.
+    prefetch: the max number of batches in flight (queued, being processed or waiting to be delivered),
+        2 * workers by default.
+    seed: np.random is seeded with (seed, batch number) before each batch_fn call, so with a fixed seed
+        and ordered=True the stream is reproducible whatever the number of workers.
+        Drawn from np.random in the main process if None.
+    '''
+    def __init__(self, batch_fn, batch_iter, workers=4, ordered=True, prefetch=None, seed=None):
+        assert workers > 0, 'At least one worker is required!'
+        self.batch_fn = batch_fn
+        self.batch_iter = iter(batch_iter)
+        self.workers = workers
+        self.ordered = ordered
+        self.prefetch = max(prefetch if prefetch is not None else 2 * workers, 1)
+        self.seed = seed if seed is not None else np.random.randint(1 << 31)
+        self.lock = threading.Lock()
+        self.processes = None
+
+    def start(self):
+        self.task_queue = multiprocessing.Queue()
+        self.result_queue = multiprocessing.Queue()
+        self.processes = [multiprocessing.Process(target=_worker_loop, args=(self.batch_fn, self.task_queue, self.result_queue))
+                          for _ in range(self.workers)]
+        for p in self.processes:
+            p.daemon = True
+            p.start()
+        self.submitted = 0  # number of batches sent to the workers
+        self.delivered = 0  # number of batches returned to the caller
+        self.ready = {}  # key: batch number, value: batch_fn result
+        while self.submitted < self.prefetch and self._submit():
+            pass
+
+    def _submit(self):
+        batch = next(self.batch_iter, None)
+        if batch is None:
+            return False
+        self.task_queue.put((self.submitted, [self.seed, self.submitted], batch))
+        self.submitted += 1
+        return True
+
+    def _receive(self):
+        while True:
+            try:
+                batch_id, result, error = self.result_queue.get(timeout=1.)
+                break
+            except queue.Empty:
+                if any(p.exitcode not in (None, 0) for p in self.processes):
+                    self.close()
+                    raise RuntimeError('A data loader worker exited unexpectedly!')
+        if error is not None:
+            self.close()
+            raise RuntimeError('Data loader worker failed:\n' + error)
+        self.ready[batch_id] = result
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.lock:
+            if self.processes is None:
+                self.start()
+            if self.delivered == self.submitted:
+                raise StopIteration
+            if self.ordered:
+                while self.delivered not in self.ready:
+                    self._receive()
+                result = self.ready.pop(self.delivered)
+            else:
+                if not self.ready:
+                    self._receive()
+                result = self.ready.pop(next(iter(self.ready)))
+            self.delivered += 1
+            self._submit()
+            return result
+
+    def close(self):
+        if self.processes is None:
+            return
+        for _ in self.processes:
+            self.task_queue.put(None)
+        for p in self.processes:
+            p.join(timeout=1.)
+            if p.is_alive():
+                p.terminate()
+        self.processes = None
+
+    def __del__(self):
+        self.close()
@@ -1,3 +1,4 @@
+import time
 import numpy as np
 import tensorflow as tf
 import random
@@ -26,6 +27,73 @@ class AverageMeter(object):
         self.average = self.sum / float(self.count)
 
 
+def fetched_bytes(value):
+    '''
+    The host memory of the values returned by sess.run, nested in lists, tuples and dicts.
+    '''
+    if value is None:
+        return 0
+    if isinstance(value, dict):
+        return sum(fetched_bytes(x) for x in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(fetched_bytes(x) for x in value)
+    if isinstance(value, bytes):
+        return len(value)
+    return np.asarray(value).nbytes
+
+
+class StepScheduler(object):
+    '''
+    The sess.run of the training steps: the base fetches (dict) on every step, and every group of extra fetches only on
+    the steps which are multiples of its interval, e.g. eval=({'y_pred': y_pred}, 100). The time and the fetched bytes
+    are kept per kind of step, see `report`.
+    '''
+    def __init__(self, base, **groups):
+        self.base = base
+        self.groups = groups
+        self.reset()
+
+    def reset(self):
+        self.times = {}  # key: kind of step, e.g. 'base+eval', value: AverageMeter of seconds
+        self.bytes = {}  # key: kind of step, value: AverageMeter of fetched bytes
+        self.group_bytes = {name: AverageMeter() for name in self.groups}
+        self.skipped = {name: 0 for name in self.groups}
+
+    def run(self, sess, step, feed_dict=None):
+        '''
+        Run the fetches of the global step, return the dict of the fetched values.
+        '''
+        due = [name for name, (_, interval) in self.groups.items() if interval > 0 and step % interval == 0]
+        fetches = dict(self.base)
+        for name in due:
+            fetches.update(self.groups[name][0])
+        start = time.time()
+        values = sess.run(fetches, feed_dict=feed_dict)
+        elapsed = time.time() - start
+
+        kind = '+'.join(['base'] + due)
+        self.times.setdefault(kind, AverageMeter()).update(elapsed)
+        self.bytes.setdefault(kind, AverageMeter()).update(fetched_bytes(values))
+        for name in self.groups:
+            if name in due:
+                self.group_bytes[name].update(fetched_bytes([values[key] for key in self.groups[name][0]]))
+            else:
+                self.skipped[name] += 1
+        return values
+
+    def report(self):
+        '''
+        The step times and the fetched bytes since the last report, and the bytes of the skipped fetches,
+        estimated from the steps which fetched them.
+        '''
+        info = ', '.join('{}: {} steps, {:.1f} ms/step, {:.2f} MB/step'.format(
+            kind, self.times[kind].count, self.times[kind].average * 1e3, self.bytes[kind].average / 2 ** 20) for kind in sorted(self.times))
+        info += ' | skipped: ' + ', '.join('{} {:.1f} MB'.format(
+            name, self.group_bytes[name].average * self.skipped[name] / 2 ** 20) for name in sorted(self.groups))
+        self.reset()
+        return info
+
+
 def parse_anchors(anchor_path):
     '''
     parse anchors.
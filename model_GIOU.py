@@ -1,8 +1,10 @@
 import tensorflow as tf
+import numpy as np
 
 slim = tf.contrib.slim
 
 from utils.layer_utils import conv2d, darknet53_body, yolo_block, upsample_layer
+from utils.nms_utils import combined_nms
 from ctypes import *
 import random
 
@@ -172,6 +174,9 @@ class yolov3(object):
         # the input img_size, form: [height, weight]
         # it will be used later
         self.img_size = tf.shape(inputs)[1:3]
+        # uint8 images from the uint8 data pipelines are normalized here, on the device
+        if inputs.dtype == tf.uint8:
+            inputs = tf.cast(inputs, tf.float32) / 255.
         # set batch norm params
         batch_norm_params = {
             'decay': self.batch_norm_decay,
@@ -282,10 +287,15 @@ class yolov3(object):
         # prob_logits: [N, 13, 13, 3, class_num]
         return x_y_offset, boxes, conf_logits, prob_logits
 
-    def predict(self, feature_maps):
+    def predict(self, feature_maps, nms=False, max_boxes=50, score_thresh=0.5, nms_thresh=0.5, class_agnostic=False,
+                pre_nms_topk=None, method='nms', sigma=0.5):
         '''
         Receive the returned feature_maps from `forward` function,
         the produce the output predictions at the test stage.
+        nms: append the post-processing to the graph, i.e. the scores conf * prob and the NMS of the whole batch
+            (see `nms_utils.combined_nms`), and return the detections padded to a fixed count K per image:
+            boxes [N, K, 4], scores [N, K], labels [N, K], num_detections [N]
+        class_agnostic, pre_nms_topk, method, sigma: the NMS variant, see `nms_utils.combined_nms`
         '''
         feature_map_1, feature_map_2, feature_map_3 = feature_maps
 
@@ -332,6 +342,54 @@ class yolov3(object):
 
         boxes = tf.concat([x_min, y_min, x_max, y_max], axis=-1)
 
+        if nms:
+            return combined_nms(boxes, confs * probs, self.class_num, max_boxes, score_thresh, nms_thresh, pre_nms_topk,
+                                method, class_agnostic, sigma)
+        return boxes, confs, probs
+
+    def predict_static(self, feature_maps, img_size, nms=False, max_boxes=50, score_thresh=0.5, nms_thresh=0.5,
+                       class_agnostic=False, pre_nms_topk=None, method='nms', sigma=0.5):
+        '''
+        `predict` for a fixed input size img_size [width, height], e.g. for a frozen inference graph: the grid offsets,
+        strides and anchors of the 3 scales are numpy constants instead of the tf.range / tf.meshgrid of `reorg_layer`,
+        and the feature maps are concatenated first, so the sigmoid / exp decode and the conversion to the box corners
+        run once for all the scales. Same returns as `predict`.
+        '''
+        width, height = [int(x) for x in img_size]
+        if width % 32 or height % 32:
+            raise ValueError('The static img_size {}x{} is not a multiple of 32!'.format(width, height))
+
+        feature_map_anchors = [(feature_maps[0], self.anchors[6:9], 32),
+                               (feature_maps[1], self.anchors[3:6], 16),
+                               (feature_maps[2], self.anchors[0:3], 8)]
+        logits_list, grid_offsets, strides, anchor_sizes = [], [], [], []
+        for feature_map, anchors, stride in feature_map_anchors:
+            grid_w, grid_h = width // stride, height // stride
+            # shape: [N, 13*13*3, 5 + class_num], the boxes in the order of `predict`
+            logits_list.append(tf.reshape(feature_map, [-1, grid_h * grid_w * 3, 5 + self.class_num]))
+            # shape: [13*13*3, 2], (x, y) of the cell of every box
+            grid_x, grid_y = np.meshgrid(np.arange(grid_w), np.arange(grid_h))
+            grid_offsets.append(np.repeat(np.stack([grid_x, grid_y], axis=-1).reshape(-1, 2), 3, axis=0))
+            strides.append(np.full([grid_h * grid_w * 3, 2], stride))
+            # the anchors rescaled to the feature map then back to the image are the anchors
+            anchor_sizes.append(np.tile(np.asarray(anchors), [grid_h * grid_w, 1]))
+        # shape: [(13*13+26*26+52*52)*3, 2]
+        grid_offsets, strides, anchor_sizes = [tf.constant(np.concatenate(x).astype(np.float32))
+                                               for x in [grid_offsets, strides, anchor_sizes]]
+
+        # shape: [N, (13*13+26*26+52*52)*3, 5 + class_num]
+        logits = tf.concat(logits_list, axis=1)
+        box_centers, box_sizes, conf_logits, prob_logits = tf.split(logits, [2, 2, 1, self.class_num], axis=-1)
+        box_centers = (tf.sigmoid(box_centers) + grid_offsets) * strides
+        box_sizes = tf.exp(box_sizes) * anchor_sizes
+        # shape: [N, (13*13+26*26+52*52)*3, 4], (x_min, y_min, x_max, y_max)
+        boxes = tf.concat([box_centers - box_sizes / 2, box_centers + box_sizes / 2], axis=-1)
+        confs = tf.sigmoid(conf_logits)
+        probs = tf.sigmoid(prob_logits)
+
+        if nms:
+            return combined_nms(boxes, confs * probs, self.class_num, max_boxes, score_thresh, nms_thresh, pre_nms_topk,
+                                method, class_agnostic, sigma)
         return boxes, confs, probs
 
     def loss_layer(self, feature_map_i, y_true, anchors):
@@ -362,38 +420,39 @@ class yolov3(object):
 
         # the calculation of ignore mask if referred from
         # https://github.com/pjreddie/darknet/blob/master/src/yolo_layer.c#L179
-        ignore_mask = tf.TensorArray(tf.float32, size=0, dynamic_size=True)
-        iou = tf.TensorArray(tf.float32, size=0, dynamic_size=True)
-
-        def loop_cond(idx, ignore_mask, iou, ):
-            return tf.less(idx, tf.cast(N, tf.int32))
-
-        def loop_body(idx, ignore_mask, iou):
-            # shape: [13, 13, 3, 4] & [13, 13, 3]  ==>  [V, 4]
-            # V: num of true gt box of each image in a batch
-            valid_true_boxes = tf.boolean_mask(y_true[idx, ..., 0:4], tf.cast(object_mask[idx, ..., 0], 'bool'))
-            # shape: [13, 13, 3, 4] & [V, 4] ==> [13, 13, 3, V]
-            if self.use_giou_loss:
-                temp_iou, temp_giou = self.box_iou(pred_boxes[idx], valid_true_boxes)
-            else:
-                temp_iou = self.box_iou(pred_boxes[idx], valid_true_boxes)
-            # shape: [13, 13, 3]
-            best_iou = tf.reduce_max(temp_iou, axis=-1)
-            # shape: [13, 13, 3]
-            ignore_mask_tmp = tf.cast(best_iou < 0.5, tf.float32)
-            # finally will be shape: [N, 13, 13, 3]
-            ignore_mask = ignore_mask.write(idx, ignore_mask_tmp)
-            if self.use_giou_loss:
-                # shape: [13, 13, 3]
-                best_iou = tf.reduce_max(temp_giou, axis=-1)
-            iou = iou.write(idx, best_iou)
-            return idx + 1, ignore_mask, iou
-
-        _, ignore_mask, iou = tf.while_loop(cond=loop_cond, body=loop_body, loop_vars=[0, ignore_mask, iou])
-        ignore_mask = ignore_mask.stack()
+        # the true boxes of the whole batch are padded to V, the max count of an image, so that the IoU of all the
+        # images are computed at once instead of in a tf.while_loop
+        # shape: [N, 13*13*3]
+        flat_object_mask = tf.reshape(object_mask, [tf.shape(object_mask)[0], -1])
+        # shape: [N]
+        true_box_cnt = tf.cast(tf.reduce_sum(flat_object_mask, axis=1), tf.int32)
+        # shape: [N, V], the cells of the true boxes come first, V >= 1 so that every image has a best box
+        _, true_box_idx = tf.nn.top_k(flat_object_mask, k=tf.maximum(tf.reduce_max(true_box_cnt), 1))
+        # shape: [N, V], 0. for the padding
+        true_box_valid = tf.cast(tf.range(tf.shape(true_box_idx)[1])[None] < true_box_cnt[:, None], tf.float32)
+        # shape: [N, V, 4], the padding boxes are empty, their IoU is 0
+        true_boxes = tf.gather(tf.reshape(y_true[..., 0:4], [tf.shape(y_true)[0], -1, 4]), true_box_idx, batch_dims=1)
+        true_boxes = true_boxes * true_box_valid[..., None]
+        # shape: [N, 13, 13, 3, 4] & [N, 1, 1, 1, V, 4] ==> [N, 13, 13, 3, V]
+        # without gradient: the gradient of a max only goes to the best box, which is differentiated alone below
+        if self.use_giou_loss:
+            temp_iou, temp_giou = self.box_iou(tf.stop_gradient(pred_boxes), true_boxes[:, None, None, None])
+            # the GIoU of the padding is negative, it is pushed below -1 so it never wins the max
+            temp_giou -= 4. * (1. - true_box_valid[:, None, None, None])
+        else:
+            temp_iou = self.box_iou(tf.stop_gradient(pred_boxes), true_boxes[:, None, None, None])
         # shape: [N, 13, 13, 3, 1]
-        ignore_mask = tf.expand_dims(ignore_mask, -1)
-        iou = iou.stack()
+        # the best IoU of an image without true box is 0 instead of -inf, the ignore mask and the clipped IoU are the same
+        ignore_mask = tf.expand_dims(tf.cast(tf.reduce_max(temp_iou, axis=-1) < 0.5, tf.float32), -1)
+        # shape: [N, 13, 13, 3, 4], the true box of the best IoU (GIoU) of each predicted box
+        best_true_boxes = tf.gather(true_boxes, tf.argmax(temp_giou if self.use_giou_loss else temp_iou, axis=-1,
+                                                          output_type=tf.int32), batch_dims=1)
+        # shape: [N, 13, 13, 3, 1] ==> [N, 13, 13, 3]
+        if self.use_giou_loss:
+            _, iou = self.box_iou(pred_boxes, best_true_boxes[..., None, :])
+        else:
+            iou = self.box_iou(pred_boxes, best_true_boxes[..., None, :])
+        iou = iou[..., 0]
         if self.use_giou_loss:
             iou = tf.clip_by_value(iou, -1, 1)
         else:
@@ -453,7 +512,7 @@ class yolov3(object):
         '''
         param:
             pred_boxes: [13, 13, 3, 4], (center_x, center_y, w, h)
-            valid_true: [V, 4]
+            valid_true: [V, 4], or the padded true boxes of the batch [N, 1, 1, 1, V, 4] with pred_boxes [N, 13, 13, 3, 4]
         '''
 
         # [13, 13, 3, 2]
@@ -465,8 +524,8 @@ class yolov3(object):
         pred_box_wh = tf.expand_dims(pred_box_wh, -2)
 
         # [V, 2]
-        true_box_xy = valid_true_boxes[:, 0:2]
-        true_box_wh = valid_true_boxes[:, 2:4]
+        true_box_xy = valid_true_boxes[..., 0:2]
+        true_box_wh = valid_true_boxes[..., 2:4]
 
         # [13, 13, 3, 1, 2] & [V, 2] ==> [13, 13, 3, V, 2]
         intersect_mins = tf.maximum(pred_box_xy - pred_box_wh / 2.,
@@ -479,10 +538,8 @@ class yolov3(object):
         intersect_area = intersect_wh[..., 0] * intersect_wh[..., 1]
         # shape: [13, 13, 3, 1]
         pred_box_area = pred_box_wh[..., 0] * pred_box_wh[..., 1]
-        # shape: [V]
+        # shape: [V], broadcast to [13, 13, 3, V]
         true_box_area = true_box_wh[..., 0] * true_box_wh[..., 1]
-        # shape: [1, V]
-        true_box_area = tf.expand_dims(true_box_area, axis=0)
 
         # [13, 13, 3, V]
         iou = intersect_area / (pred_box_area + true_box_area - intersect_area + 1e-10)
@@ -2,7 +2,14 @@
 import numpy as np
 import tensorflow as tf
 
-def gpu_nms(boxes, scores, num_classes, max_boxes=50, score_thresh=0.5, nms_thresh=0.5):
+# numba is optional, `py_nms` falls back to the numpy implementation without it
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+def gpu_nms(boxes, scores, num_classes, max_boxes=50, score_thresh=0.5, nms_thresh=0.5, pre_nms_topk=None,
+            method='nms', class_agnostic=False, sigma=0.5):
     """
     Perform NMS on GPU using TensorFlow.
     params:
@@ -13,7 +20,13 @@ def gpu_nms(boxes, scores, num_classes, max_boxes=50, score_thresh=0.5, nms_thre
         score_thresh: if [ highest class probability score < score_threshold]
                         then get rid of the corresponding box
         nms_thresh: real value, "intersection over union" threshold used for NMS filtering
+        pre_nms_topk: integer, only the top pre_nms_topk scores of each class are fed into NMS, None to keep all
+        method: 'nms', or 'gaussian' for the gaussian soft-NMS. 'diou' and 'linear' are only available in `cpu_nms`
+        class_agnostic: if True, each box only keeps its highest class score and NMS runs once for all the classes
+        sigma: the sigma of the gaussian soft-NMS, decay = exp(-iou^2 / sigma)
     """
+    if method not in ['nms', 'gaussian']:
+        raise ValueError('Unsupported NMS method on GPU!')
 
     boxes_list, label_list, score_list = [], [], []
     max_boxes = tf.constant(max_boxes, dtype='int32')
@@ -21,21 +34,45 @@ def gpu_nms(boxes, scores, num_classes, max_boxes=50, score_thresh=0.5, nms_thre
     # since we do nms for single image, then reshape it
     boxes = tf.reshape(boxes, [-1, 4]) # '-1' means we don't konw the exact number of boxes
     score = tf.reshape(scores, [-1, num_classes])
+    if class_agnostic:
+        box_label = tf.argmax(score, axis=-1, output_type=tf.int32)
+        score = tf.reduce_max(score, axis=-1, keepdims=True)
 
     # Step 1: Create a filtering mask based on "box_class_scores" by using "threshold".
     mask = tf.greater_equal(score, tf.constant(score_thresh))
     # Step 2: Do non_max_suppression for each class
-    for i in range(num_classes):
+    for i in range(1 if class_agnostic else num_classes):
         # Step 3: Apply the mask to scores, boxes and pick them out
         filter_boxes = tf.boolean_mask(boxes, mask[:,i])
         filter_score = tf.boolean_mask(score[:,i], mask[:,i])
-        nms_indices = tf.image.non_max_suppression(boxes=filter_boxes,
-                                                   scores=filter_score,
-                                                   max_output_size=max_boxes,
-                                                   iou_threshold=nms_thresh, name='nms_indices')
-        label_list.append(tf.ones_like(tf.gather(filter_score, nms_indices), 'int32')*i)
+        if pre_nms_topk is not None:
+            # top_k instead of a full sort inside non_max_suppression
+            filter_score, top_indices = tf.nn.top_k(filter_score, k=tf.minimum(pre_nms_topk, tf.shape(filter_score)[0]))
+            filter_boxes = tf.gather(filter_boxes, top_indices)
+        if method == 'gaussian':
+            # tf decays the scores by exp(-0.5 * iou^2 / soft_nms_sigma)
+            nms_indices, nms_score = tf.image.non_max_suppression_with_scores(boxes=filter_boxes,
+                                                                              scores=filter_score,
+                                                                              max_output_size=max_boxes,
+                                                                              iou_threshold=1.0,
+                                                                              score_threshold=score_thresh,
+                                                                              soft_nms_sigma=sigma / 2.,
+                                                                              name='soft_nms_indices')
+        else:
+            nms_indices = tf.image.non_max_suppression(boxes=filter_boxes,
+                                                       scores=filter_score,
+                                                       max_output_size=max_boxes,
+                                                       iou_threshold=nms_thresh, name='nms_indices')
+            nms_score = tf.gather(filter_score, nms_indices)
+        if class_agnostic:
+            filter_label = tf.boolean_mask(box_label, mask[:,i])
+            if pre_nms_topk is not None:
+                filter_label = tf.gather(filter_label, top_indices)
+            label_list.append(tf.gather(filter_label, nms_indices))
+        else:
+            label_list.append(tf.ones_like(nms_score, 'int32')*i)
         boxes_list.append(tf.gather(filter_boxes, nms_indices))
-        score_list.append(tf.gather(filter_score, nms_indices))
+        score_list.append(nms_score)
 
     boxes = tf.concat(boxes_list, axis=0)
     score = tf.concat(score_list, axis=0)
@@ -44,7 +81,62 @@ def gpu_nms(boxes, scores, num_classes, max_boxes=50, score_thresh=0.5, nms_thre
     return boxes, score, label
 
 
-def py_nms(boxes, scores, max_boxes=50, iou_thresh=0.5):
+def gpu_batch_nms(boxes, scores, num_classes, max_boxes=50, score_thresh=0.5, nms_thresh=0.5, pre_nms_topk=None,
+                  method='nms', class_agnostic=False, sigma=0.5):
+    """
+    `gpu_nms` of every image of a batch, in the same graph as the model, with the detections padded to a fixed count.
+    params:
+        boxes: tensor of shape [B, 10647, 4]
+        scores: tensor of shape [B, 10647, num_classes], score=conf*prob
+        the other params are the ones of `gpu_nms`
+    return:
+        boxes [B, K, 4], scores [B, K], labels [B, K] int32 and num_detections [B] int32, K = max_boxes * num_classes
+        (max_boxes if class_agnostic). The detections of the image b are the first num_detections[b] ones.
+    """
+    max_detections = max_boxes * (1 if class_agnostic else num_classes)
+
+    def image_nms(x):
+        nms_boxes, nms_score, nms_label = gpu_nms(x[0][None], x[1][None], num_classes, max_boxes, score_thresh, nms_thresh,
+                                                  pre_nms_topk, method, class_agnostic, sigma)
+        num = tf.shape(nms_score)[0]
+        pad = max_detections - num
+        return tf.pad(nms_boxes, [[0, pad], [0, 0]]), tf.pad(nms_score, [[0, pad]]), tf.pad(nms_label, [[0, pad]]), num
+
+    return tf.map_fn(image_nms, (boxes, scores), dtype=(tf.float32, tf.float32, tf.int32, tf.int32), back_prop=False)
+
+
+def combined_nms(boxes, scores, num_classes, max_boxes=50, score_thresh=0.5, nms_thresh=0.5, pre_nms_topk=None,
+                 method='nms', class_agnostic=False, sigma=0.5):
+    """
+    The per-class NMS of a whole batch as one tf.image.combined_non_max_suppression op, on any device.
+    The op only sorts the scores above score_thresh, so there is no pre_nms_topk selection by default (tf.nn.top_k
+    costs more than the NMS on CPU); with pre_nms_topk, the top scores of each class are gathered with their boxes
+    first, and the detections are the ones of `gpu_nms` with the same pre_nms_topk.
+    The class agnostic NMS and the gaussian soft-NMS fall back to `gpu_batch_nms`.
+    Same params and return values as `gpu_batch_nms`, the detections of an image are sorted by descending score
+    instead of grouped by class.
+    """
+    if method not in ['nms', 'gaussian']:
+        raise ValueError('Unsupported NMS method on GPU!')
+    if method == 'gaussian' or class_agnostic:
+        return gpu_batch_nms(boxes, scores, num_classes, max_boxes, score_thresh, nms_thresh, pre_nms_topk, method,
+                             class_agnostic, sigma)
+
+    if pre_nms_topk is None:
+        # all the classes share the boxes, [B, N, 1, 4]
+        boxes = boxes[:, :, None]
+    else:
+        # [B, C, k], the top scores of each class and their boxes [B, k, C, 4]
+        scores, top_indices = tf.nn.top_k(tf.transpose(scores, [0, 2, 1]), k=tf.minimum(pre_nms_topk, tf.shape(scores)[1]))
+        boxes = tf.transpose(tf.gather(boxes, top_indices, batch_dims=1), [0, 2, 1, 3])
+        scores = tf.transpose(scores, [0, 2, 1])
+    nms_boxes, nms_score, nms_label, num_detections = tf.image.combined_non_max_suppression(
+        boxes, scores, max_output_size_per_class=max_boxes, max_total_size=max_boxes * num_classes,
+        iou_threshold=nms_thresh, score_threshold=score_thresh, clip_boxes=False)
+    return nms_boxes, nms_score, tf.cast(nms_label, tf.int32), num_detections
+
+
+def numpy_nms(boxes, scores, max_boxes=50, iou_thresh=0.5):
     """
     Pure Python NMS baseline.
     Arguments: boxes: shape of [-1, 4], the value of '-1' means that dont know the
@@ -61,7 +153,8 @@ def py_nms(boxes, scores, max_boxes=50, iou_thresh=0.5):
     y2 = boxes[:, 3]
 
     areas = (x2 - x1) * (y2 - y1)
-    order = scores.argsort()[::-1]
+    # stable, so the ties are in descending index order like `batched_nms`
+    order = scores.argsort(kind='stable')[::-1]
 
     keep = []
     while order.size > 0:
@@ -83,23 +176,125 @@ def py_nms(boxes, scores, max_boxes=50, iou_thresh=0.5):
     return keep[:max_boxes]
 
 
-def cpu_nms(boxes, scores, num_classes, max_boxes=50, score_thresh=0.5, iou_thresh=0.5):
+if njit is not None:
+    @njit(cache=True)
+    def _compiled_nms(x1, y1, x2, y2, areas, order, max_boxes, iou_thresh, zero, one):
+        # same arithmetic as `numpy_nms`, but suppressed boxes are flagged in place
+        # instead of re-slicing `order`, so nothing is allocated inside the loop
+        n = order.shape[0]
+        suppressed = np.zeros(n, np.bool_)
+        keep = np.empty(min(n, max_boxes), np.int64)
+        cnt = 0
+        for _i in range(n):
+            if suppressed[_i]:
+                continue
+            i = order[_i]
+            keep[cnt] = i
+            cnt += 1
+            if cnt == max_boxes:
+                break
+            for _j in range(_i + 1, n):
+                if suppressed[_j]:
+                    continue
+                j = order[_j]
+                w = max(zero, min(x2[i], x2[j]) - max(x1[i], x1[j]) + one)
+                h = max(zero, min(y2[i], y2[j]) - max(y1[i], y1[j]) + one)
+                inter = w * h
+                ovr = inter / (areas[i] + areas[j] - inter)
+                if not ovr <= iou_thresh:
+                    suppressed[_j] = True
+        return keep[:cnt]
+
+
+def compiled_nms(boxes, scores, max_boxes=50, iou_thresh=0.5):
+    """
+    Greedy NMS with the numba kernel, same arguments and results as `numpy_nms`.
+    """
+    assert boxes.shape[1] == 4 and len(scores.shape) == 1
+    if max_boxes is None:
+        # no limit, like keep[:None] in `numpy_nms`
+        max_boxes = len(scores)
+    if max_boxes <= 0:
+        return []
+    # integer boxes are computed in float64 like in `numpy_nms`, so that iou_thresh is not truncated
+    if not np.issubdtype(boxes.dtype, np.floating):
+        boxes = boxes.astype(np.float64)
+
+    x1 = np.ascontiguousarray(boxes[:, 0])
+    y1 = np.ascontiguousarray(boxes[:, 1])
+    x2 = np.ascontiguousarray(boxes[:, 2])
+    y2 = np.ascontiguousarray(boxes[:, 3])
+
+    areas = (x2 - x1) * (y2 - y1)
+    order = scores.argsort(kind='stable')[::-1].copy()
+
+    # pass the constants in the box dtype, so that float32 boxes are not computed in float64
+    dtype = areas.dtype.type
+    keep = _compiled_nms(x1, y1, x2, y2, areas, order, max_boxes, dtype(iou_thresh), dtype(0), dtype(1))
+    return keep.tolist()
+
+
+# pick the NMS kernel at import time
+py_nms = compiled_nms if njit is not None else numpy_nms
+
+
+def preselect(scores, score_thresh=0.5, pre_nms_topk=None):
+    """
+    Candidate pre-selection before NMS: apply the score threshold over all the classes, then
+    keep only the top pre_nms_topk candidates of each class, like `gpu_nms`, with argpartition
+    instead of a full sort.
+    Arguments: scores: shape of [10647, num_classes]
+               score_thresh: candidates with score < score_thresh are dropped
+               pre_nms_topk: maximum number of candidates to keep per class, None to keep all
+    return: box_idx, labels, scores of the candidates, shape of [K], K <= pre_nms_topk * num_classes.
+            Kept in ascending box index order, not sorted by score.
+    """
+    flat_scores = scores.ravel()
+    indices = np.flatnonzero(flat_scores >= score_thresh)
+    box_idx, labels = np.divmod(indices, scores.shape[1])
+    if pre_nms_topk is not None and len(indices) > pre_nms_topk:
+        # only the classes with more than pre_nms_topk candidates are cut
+        over = np.flatnonzero(np.bincount(labels, minlength=scores.shape[1]) > pre_nms_topk)
+        if len(over) > 0:
+            keep = np.ones(len(indices), dtype=bool)
+            for i in over:
+                cls_idx = np.flatnonzero(labels == i)
+                keep[cls_idx] = False
+                keep[cls_idx[np.argpartition(-flat_scores[indices[cls_idx]], pre_nms_topk - 1)[:pre_nms_topk]]] = True
+            indices, box_idx, labels = indices[keep], box_idx[keep], labels[keep]
+    return box_idx, labels, flat_scores[indices]
+
+
+def cpu_nms(boxes, scores, num_classes, max_boxes=50, score_thresh=0.5, iou_thresh=0.5, pre_nms_topk=None,
+            method='nms', class_agnostic=False, sigma=0.5):
     """
     Perform NMS on CPU.
     Arguments:
         boxes: shape [1, 10647, 4]
         scores: shape [1, 10647, num_classes]
+        pre_nms_topk: only the top pre_nms_topk candidates of each class are fed into NMS like `gpu_nms`,
+                      None to keep all
+        method, class_agnostic, sigma: the NMS variant, see `batched_nms`
     """
+    if method != 'nms' or class_agnostic:
+        boxes, score, label, count = batched_nms(boxes.reshape(1, -1, 4), scores.reshape(1, -1, num_classes),
+                                                 num_classes, max_boxes=max_boxes, score_thresh=score_thresh,
+                                                 iou_thresh=iou_thresh, pre_nms_topk=pre_nms_topk,
+                                                 method=method, class_agnostic=class_agnostic, sigma=sigma)
+        if count[0] == 0:
+            return None, None, None
+        return boxes[0, :count[0]], score[0, :count[0]], label[0, :count[0]]
 
     boxes = boxes.reshape(-1, 4)
     scores = scores.reshape(-1, num_classes)
     # Picked bounding boxes
     picked_boxes, picked_score, picked_label = [], [], []
 
+    box_idx, labels, cand_scores = preselect(scores, score_thresh, pre_nms_topk)
     for i in range(num_classes):
-        indices = np.where(scores[:,i] >= score_thresh)
+        indices = box_idx[labels == i]
         filter_boxes = boxes[indices]
-        filter_scores = scores[:,i][indices]
+        filter_scores = cand_scores[labels == i]
         if len(filter_boxes) == 0:
             continue
         # do non_max_suppression on the cpu
@@ -116,3 +311,205 @@ def cpu_nms(boxes, scores, num_classes, max_boxes=50, score_thresh=0.5, iou_thre
     label = np.concatenate(picked_label, axis=0)
 
     return boxes, score, label
+
+
+def box_overlaps(boxes_a, boxes_b, overlap='iou'):
+    """
+    Pairwise overlap of two sets of boxes, using the same arithmetic as `py_nms`
+    so that the kept boxes are identical to the per-class loop.
+    This is the overlap kernel shared by all the NMS methods.
+    Arguments: boxes_a: shape of [N, 4], (x_min, y_min, x_max, y_max)
+               boxes_b: shape of [M, 4]
+               overlap: 'iou', or 'diou' to subtract the normalized center distance
+    return: overlap matrix, shape of [N, M]
+    """
+    # [N, 1] & [1, M] ==> [N, M]
+    xx1 = np.maximum(boxes_a[:, 0:1], boxes_b[:, 0])
+    yy1 = np.maximum(boxes_a[:, 1:2], boxes_b[:, 1])
+    xx2 = np.minimum(boxes_a[:, 2:3], boxes_b[:, 2])
+    yy2 = np.minimum(boxes_a[:, 3:4], boxes_b[:, 3])
+
+    w = np.maximum(0.0, xx2 - xx1 + 1)
+    h = np.maximum(0.0, yy2 - yy1 + 1)
+    inter = w * h
+
+    areas_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    areas_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+
+    iou = inter / (areas_a[:, None] + areas_b - inter)
+    if overlap == 'iou':
+        return iou
+    elif overlap == 'diou':
+        # squared distance of the box centers
+        dx = (boxes_a[:, 0:1] + boxes_a[:, 2:3]) / 2. - (boxes_b[:, 0] + boxes_b[:, 2]) / 2.
+        dy = (boxes_a[:, 1:2] + boxes_a[:, 3:4]) / 2. - (boxes_b[:, 1] + boxes_b[:, 3]) / 2.
+        # squared diagonal of the smallest enclosing box
+        cw = np.maximum(boxes_a[:, 2:3], boxes_b[:, 2]) - np.minimum(boxes_a[:, 0:1], boxes_b[:, 0])
+        ch = np.maximum(boxes_a[:, 3:4], boxes_b[:, 3]) - np.minimum(boxes_a[:, 1:2], boxes_b[:, 1])
+        return iou - (dx ** 2 + dy ** 2) / (cw ** 2 + ch ** 2 + 1e-10)
+    else:
+        raise ValueError('Unsupported overlap type!')
+
+
+def greedy_nms(boxes, labels, max_boxes=50, iou_thresh=0.5, overlap='iou', block_size=64):
+    """
+    Greedy NMS over boxes of all classes at once. Boxes only suppress boxes with the
+    same label, so the result is the same as running `py_nms` once per class.
+    The candidates are processed in blocks: each block is first suppressed by the boxes
+    already kept, then the greedy pass runs on the [block_size, block_size] overlap matrix.
+    Arguments: boxes: shape of [N, 4], already sorted by descending score
+               labels: shape of [N], non-negative integers
+               max_boxes: maximum of boxes to be kept for each label
+               iou_thresh: representing iou_threshold for deciding to keep boxes
+               overlap: 'iou' for the standard NMS, 'diou' for DIoU-NMS
+               block_size: number of candidates handled per overlap matrix
+    return: indices of the kept boxes, in descending score order
+    """
+    keep = []
+    keep_cnt = np.zeros(labels.max() + 1 if len(labels) else 0, dtype=np.int64)
+    for start in range(0, len(boxes), block_size):
+        blk_boxes = boxes[start:start + block_size]
+        blk_labels = labels[start:start + block_size]
+        # labels which already got max_boxes can be skipped
+        alive = keep_cnt[blk_labels] < max_boxes
+        if not alive.any():
+            continue
+
+        # suppressed by the boxes kept in the previous blocks
+        if keep:
+            kept = np.asarray(keep)
+            ovr = box_overlaps(blk_boxes, boxes[kept], overlap)
+            alive &= ~np.any((ovr > iou_thresh) & (blk_labels[:, None] == labels[kept]), axis=1)
+
+        # [block_size, block_size], only the upper triangle is used
+        suppress = (box_overlaps(blk_boxes, blk_boxes, overlap) > iou_thresh) & (blk_labels[:, None] == blk_labels)
+
+        i = -1
+        while True:
+            # jump to the next box which survives
+            rest = np.flatnonzero(alive[i + 1:])
+            if len(rest) == 0:
+                break
+            i += 1 + rest[0]
+            keep.append(start + i)
+            alive[i + 1:] &= ~suppress[i, i + 1:]
+            keep_cnt[blk_labels[i]] += 1
+            if keep_cnt[blk_labels[i]] == max_boxes:
+                alive[i + 1:] &= blk_labels[i + 1:] != blk_labels[i]
+
+    return np.asarray(keep, dtype=np.int64)
+
+
+def soft_nms(boxes, scores, labels, max_boxes=50, iou_thresh=0.5, score_thresh=0.5, method='gaussian', sigma=0.5):
+    """
+    Soft-NMS: instead of removing the overlapping boxes of the same label, decay their scores.
+    Arguments: boxes: shape of [N, 4]
+               scores: shape of [N]
+               labels: shape of [N], non-negative integers
+               max_boxes: maximum of boxes to be kept for each label
+               iou_thresh: only used by the linear decay, boxes with iou > iou_thresh are decayed by (1 - iou)
+               score_thresh: boxes whose decayed score drops below score_thresh are removed
+               method: 'linear' or 'gaussian', the gaussian decay is exp(-iou^2 / sigma)
+    return: indices of the kept boxes and their decayed scores, in the order they are picked
+    """
+    scores = scores.copy()
+    remain = np.arange(len(boxes))
+    keep = []
+    keep_cnt = np.zeros(labels.max() + 1 if len(labels) else 0, dtype=np.int64)
+    while len(remain) > 0:
+        j = np.argmax(scores[remain])
+        i = remain[j]
+        keep.append(i)
+        remain = np.delete(remain, j)
+
+        ovr = box_overlaps(boxes[i:i + 1], boxes[remain])[0]
+        same_cls = labels[remain] == labels[i]
+        if method == 'linear':
+            decay = np.where(same_cls & (ovr > iou_thresh), 1 - ovr, 1.)
+        else:
+            decay = np.where(same_cls, np.exp(-ovr ** 2 / sigma), 1.)
+        scores[remain] *= decay.astype(scores.dtype)
+        remain = remain[scores[remain] >= score_thresh]
+
+        keep_cnt[labels[i]] += 1
+        if keep_cnt[labels[i]] == max_boxes:
+            remain = remain[labels[remain] != labels[i]]
+
+    keep = np.asarray(keep, dtype=np.int64)
+    return keep, scores[keep]
+
+
+def nms_kernel(boxes, scores, labels, max_boxes=50, iou_thresh=0.5, score_thresh=0.5, method='nms', sigma=0.5):
+    """
+    Run one of the NMS methods on the candidates of an image.
+    Arguments: boxes: shape of [N, 4], already sorted by descending score
+               scores: shape of [N]
+               labels: shape of [N], the boxes with different labels never suppress each other
+               method: 'nms', 'diou', 'linear' (linear soft-NMS) or 'gaussian' (gaussian soft-NMS)
+               sigma: the sigma of the gaussian soft-NMS
+    return: indices of the kept boxes and their scores
+    """
+    if method == 'nms' or method == 'diou':
+        keep = greedy_nms(boxes, labels, max_boxes=max_boxes, iou_thresh=iou_thresh,
+                          overlap='iou' if method == 'nms' else 'diou')
+        return keep, scores[keep]
+    elif method == 'linear' or method == 'gaussian':
+        return soft_nms(boxes, scores, labels, max_boxes=max_boxes, iou_thresh=iou_thresh,
+                        score_thresh=score_thresh, method=method, sigma=sigma)
+    else:
+        raise ValueError('Unsupported NMS method!')
+
+
+def batched_nms(boxes, scores, num_classes, max_boxes=50, score_thresh=0.5, iou_thresh=0.5, pre_nms_topk=None,
+                method='nms', class_agnostic=False, sigma=0.5):
+    """
+    Perform multi-class NMS on CPU for a whole batch, all classes of an image in one pass.
+    Gives the same kept boxes as calling `cpu_nms` on every image.
+    Arguments:
+        boxes: shape [B, 10647, 4]
+        scores: shape [B, 10647, num_classes]
+        pre_nms_topk: only the top pre_nms_topk candidates of each class are fed into NMS, None to keep all
+        method: 'nms', 'diou', 'linear' or 'gaussian', see `nms_kernel`
+        class_agnostic: if True, boxes of different classes also suppress each other,
+                        and max_boxes is the maximum for all the classes
+        sigma: the sigma of the gaussian soft-NMS
+    return:
+        boxes: shape [B, num_classes * max_boxes, 4], padded with 0
+        scores: shape [B, num_classes * max_boxes], padded with 0
+        labels: shape [B, num_classes * max_boxes], padded with -1
+        counts: shape [B], number of valid detections of each image
+    """
+    batch_size = scores.shape[0]
+    boxes = boxes.reshape(batch_size, -1, 4)
+    scores = scores.reshape(batch_size, -1, num_classes)
+
+    max_dets = num_classes * max_boxes
+    out_boxes = np.zeros((batch_size, max_dets, 4), dtype=boxes.dtype)
+    out_scores = np.zeros((batch_size, max_dets), dtype=scores.dtype)
+    out_labels = np.full((batch_size, max_dets), -1, dtype='int32')
+    counts = np.zeros(batch_size, dtype='int32')
+
+    for b in range(batch_size):
+        # [K] candidates passing the threshold, for all classes
+        box_idx, label, score = preselect(scores[b], score_thresh, pre_nms_topk)
+        if len(box_idx) == 0:
+            continue
+
+        # descending score, ties broken by descending box index like `py_nms`
+        order = np.lexsort((-box_idx, -score))
+        box_idx, label, score = box_idx[order], label[order], score[order]
+
+        nms_label = np.zeros_like(label) if class_agnostic else label
+        keep, keep_score = nms_kernel(boxes[b][box_idx], score, nms_label, max_boxes=max_boxes, iou_thresh=iou_thresh,
+                                      score_thresh=score_thresh, method=method, sigma=sigma)
+        # group by class like `cpu_nms`, stable so the scores stay descending
+        order = np.argsort(label[keep], kind='stable')
+        keep, keep_score = keep[order], keep_score[order]
+
+        n = len(keep)
+        out_boxes[b, :n] = boxes[b][box_idx[keep]]
+        out_scores[b, :n] = keep_score
+        out_labels[b, :n] = label[keep]
+        counts[b] = n
+
+    return out_boxes, out_scores, out_labels, counts
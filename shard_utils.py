@@ -0,0 +1,180 @@
+import os
+import argparse
+import numpy as np
+
+from utils.anno_utils import open_annotation_store
+from utils.data_utils import parse_data, get_y_true_layout, split_y_true
+from utils.misc_utils import parse_anchors
+
+# the validation size of train_GIOU, the only size of the shards by default
+VAL_IMG_SIZE = [416, 416]
+
+
+def size_dir(shard_dir, img_size):
+    return os.path.join(shard_dir, '{}x{}'.format(img_size[0], img_size[1]))
+
+
+def shard_meta(anno_path, letterbox_resize, class_num):
+    '''
+    The settings of the samples of a shard, int64 [letterbox_resize, class_num, mtime in ns, size] of the annotation
+    file (of the offsets of the store for a store directory), so that the shards of an edited annotation file are rejected.
+    '''
+    if isinstance(anno_path, bytes):
+        anno_path = anno_path.decode('utf-8')
+    if os.path.isdir(anno_path):
+        anno_path = os.path.join(anno_path, 'offsets.npy')
+    stat = os.stat(anno_path)
+    return np.array([int(letterbox_resize), int(class_num), stat.st_mtime_ns, stat.st_size], np.int64)
+
+
+def build_shards(anno_path, class_num, anchors, img_sizes=None, shard_dir=None, letterbox_resize=True):
+    '''
+    Write the samples of the 'val' mode of `data_utils.parse_data` (resize with interp=1, no augmentation) for every
+    image of an annotation file and every size of img_sizes, so that they are read instead of computed again.
+    Every size has its own directory '<width>x<height>' of .npy files which can be memory-mapped:
+        images: [I, height, width, 3] uint8 RGB
+        y_true: [I, R, 6 + class_num] float32, the y_true buffers of `data_utils.get_y_true_buffer`
+        img_idx: [I] int64
+        anchors: the anchors of the y_true
+        meta: the letterbox_resize, class_num and annotation file of the samples, see `shard_meta`
+    The arrays are written with np.lib.format.open_memmap, one image at a time.
+    param:
+        anno_path: path of the annotation txt file or store, see `anno_utils`
+        img_sizes: list of [width, height], only the validation size VAL_IMG_SIZE by default
+    return: the shard directory, anno_path + '.shards' by default
+    '''
+    if isinstance(anno_path, bytes):
+        anno_path = anno_path.decode('utf-8')
+    if shard_dir is None:
+        shard_dir = anno_path.rstrip('/\\') + '.shards'
+    if img_sizes is None:
+        img_sizes = [VAL_IMG_SIZE]
+    store = open_annotation_store(anno_path)
+    img_cnt = len(store)
+    meta = shard_meta(anno_path, letterbox_resize, class_num)
+
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    for img_size in img_sizes:
+        out_dir = size_dir(shard_dir, img_size)
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        # a shard being rewritten is not complete
+        for name in ['img_idx.npy', 'anchors.npy', 'meta.npy']:
+            if os.path.exists(os.path.join(out_dir, name)):
+                os.remove(os.path.join(out_dir, name))
+        template = get_y_true_layout(img_size, class_num)[0]
+        images = np.lib.format.open_memmap(os.path.join(out_dir, 'images.npy'), mode='w+', dtype=np.uint8,
+                                           shape=(img_cnt, img_size[1], img_size[0], 3))
+        y_true = np.lib.format.open_memmap(os.path.join(out_dir, 'y_true.npy'), mode='w+', dtype=np.float32,
+                                           shape=(img_cnt,) + template.shape)
+        img_idx = np.empty(img_cnt, np.int64)
+        for i in range(img_cnt):
+            y_true[i] = template
+            img_idx[i], images[i] = parse_data(i, class_num, img_size, anchors, b'val', letterbox_resize,
+                                               store.store_dir, y_true[i], uint8=True)[:2]
+        images.flush()
+        y_true.flush()
+        del images, y_true
+        np.save(os.path.join(out_dir, 'anchors.npy'), np.asarray(anchors, np.float32))
+        np.save(os.path.join(out_dir, 'meta.npy'), meta)
+        # img_idx is written last, so that its existence tells the shard is complete
+        np.save(os.path.join(out_dir, 'img_idx.npy'), img_idx)
+    return shard_dir
+
+
+class ShardStore(object):
+    '''
+    Read-only access to the shards written by `build_shards`, all the arrays are memory-mapped.
+    '''
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        self.shards = {}  # key: (width, height), value: (img_idx, images, y_true)
+
+    def shard(self, img_size):
+        img_size = tuple(int(x) for x in img_size)
+        if img_size not in self.shards:
+            out_dir = size_dir(self.shard_dir, img_size)
+            if not os.path.exists(os.path.join(out_dir, 'img_idx.npy')):
+                raise ValueError('No complete shard of size {} in {}!'.format(img_size, self.shard_dir))
+            # np.asarray drops the slow np.memmap subclass, see `anno_utils.AnnotationStore`
+            load = lambda name: np.asarray(np.load(os.path.join(out_dir, name), mmap_mode='r'))
+            self.shards[img_size] = (load('img_idx.npy'), load('images.npy'), load('y_true.npy'))
+        return self.shards[img_size]
+
+    def check(self, img_size, anchors=None, class_num=None, anno_path=None, letterbox_resize=None):
+        '''
+        Raise a ValueError if the shard of img_size is not built with the given anchors, class_num, annotation file and
+        letterbox_resize, the ones which are None are not checked. Every size has its own settings, as the sizes can be
+        built by different `build_shards` calls.
+        '''
+        self.shard(img_size)
+        out_dir = size_dir(self.shard_dir, [int(x) for x in img_size])
+        if anchors is not None and not np.allclose(np.load(os.path.join(out_dir, 'anchors.npy')), anchors):
+            raise ValueError('The shards of {} are built with other anchors!'.format(self.shard_dir))
+        meta = np.load(os.path.join(out_dir, 'meta.npy'))
+        if letterbox_resize is not None and meta[0] != int(letterbox_resize):
+            raise ValueError('The shards of {} are built with letterbox_resize={}!'.format(self.shard_dir, bool(meta[0])))
+        if class_num is not None and meta[1] != int(class_num):
+            raise ValueError('The shards of {} are built for {} classes!'.format(self.shard_dir, meta[1]))
+        if anno_path is not None and np.any(meta[2:] != shard_meta(anno_path, False, 0)[2:]):
+            raise ValueError('The shards of {} are not built from the current {}!'.format(self.shard_dir, anno_path))
+
+    def get_batch(self, indices, img_size, class_num, uint8=False):
+        '''
+        The batch of the images indices at img_size, with the return values of `data_utils.get_batch_data`:
+            img_idx, img, y_true_13, y_true_26, y_true_52
+        A batch of consecutive indices is a sequential read of the shard.
+        '''
+        img_idx, images, y_true = self.shard(img_size)
+        if y_true.shape[-1] != 6 + class_num:
+            raise ValueError('The shards of {} are built for {} classes!'.format(self.shard_dir, y_true.shape[-1] - 6))
+        indices = np.asarray(indices, np.int64)
+        if len(indices) > 0 and np.all(np.diff(indices) == 1):
+            # views of the mapped arrays
+            batch = slice(indices[0], indices[-1] + 1)
+        else:
+            batch = indices
+        img_batch = images[batch] if uint8 else images[batch].astype(np.float32) / 255.
+        y_true_13, y_true_26, y_true_52 = split_y_true(y_true[batch], [int(x) for x in img_size], class_num)
+        return img_idx[batch], img_batch, y_true_13, y_true_26, y_true_52
+
+
+shard_cache = {}  # key: shard directory, value: ShardStore
+def open_shard_store(shard_dir, img_size=None, **kwargs):
+    '''
+    Open the shards written by `build_shards`, the stores are cached like the annotation stores.
+    If img_size is given, the shard of img_size is checked against kwargs, see `ShardStore.check`.
+    '''
+    if isinstance(shard_dir, bytes):
+        shard_dir = shard_dir.decode('utf-8')
+    if shard_dir not in shard_cache:
+        shard_cache[shard_dir] = ShardStore(shard_dir)
+    if img_size is not None:
+        shard_cache[shard_dir].check(img_size, **kwargs)
+    return shard_cache[shard_dir]
+
+
+def get_shard_batch_data(batch_line, shard_dir, img_size, class_num, uint8=False):
+    '''
+    Drop-in for `data_utils.get_batch_data` in 'val' mode, for tf.py_func: batch_line is a batch of image indices.
+    '''
+    return open_shard_store(shard_dir).get_batch(batch_line, img_size, class_num, uint8)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write the letterboxed images and y_true of annotation files into memory-mapped shards.')
+    parser.add_argument('anno_paths', nargs='+', help='Path to the annotation txt files.')
+    parser.add_argument('--anchor_path', type=str, default='./data/yolo_anchors.txt', help='The path of the anchor txt file.')
+    parser.add_argument('--class_num', type=int, required=True, help='The number of classes.')
+    parser.add_argument('--img_sizes', type=int, nargs='+', default=[VAL_IMG_SIZE[0]],
+                        help='Square image sizes, the validation size 416 by default.')
+    parser.add_argument('--letterbox_resize', type=lambda x: (str(x).lower() == 'true'), default=True,
+                        help='Whether to use the letterbox resize.')
+    args = parser.parse_args()
+
+    anchors = parse_anchors(args.anchor_path)
+    img_sizes = [[x, x] for x in args.img_sizes]
+    for anno_path in args.anno_paths:
+        shard_dir = build_shards(anno_path, args.class_num, anchors, img_sizes, letterbox_resize=args.letterbox_resize)
+        print('{}: shards of sizes {} in {}'.format(anno_path, args.img_sizes, shard_dir))
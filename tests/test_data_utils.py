@@ -0,0 +1,109 @@
+import numpy as np
+
+from utils.data_utils import process_box, get_y_true_buffer, split_y_true
+
+ANCHORS = np.array([[10, 13], [16, 30], [33, 23], [30, 61], [62, 45], [59, 119], [116, 90], [156, 198], [373, 326]],
+                   np.float32)
+
+
+def loop_process_box(boxes, labels, img_size, class_num, anchors):
+    '''
+    The reference encoder: the boxes written one by one, the centers on or beyond the image edges
+    going to the edge cells like `tf_data_utils.tf_process_box`.
+    '''
+    anchors_mask = [[6, 7, 8], [3, 4, 5], [0, 1, 2]]
+    box_centers = (boxes[:, 0:2] + boxes[:, 2:4]) / 2
+    box_sizes = boxes[:, 2:4] - boxes[:, 0:2]
+    y_true = [np.zeros((img_size[1] // ratio, img_size[0] // ratio, 3, 6 + class_num), np.float32)
+              for ratio in [32, 16, 8]]
+    for y in y_true:
+        y[..., -1] = 1.
+
+    mins = np.maximum(- box_sizes[:, None] / 2, - anchors / 2)
+    maxs = np.minimum(box_sizes[:, None] / 2, anchors / 2)
+    whs = maxs - mins
+    iou = (whs[:, :, 0] * whs[:, :, 1]) / (box_sizes[:, None, 0] * box_sizes[:, None, 1] + anchors[:, 0] * anchors[:, 1]
+                                           - whs[:, :, 0] * whs[:, :, 1] + 1e-10)
+    for i, idx in enumerate(np.argmax(iou, axis=1)):
+        group = 2 - idx // 3
+        ratio = [32., 16., 8.][group]
+        grid_h, grid_w = y_true[group].shape[:2]
+        x = min(max(int(np.floor(box_centers[i, 0] / ratio)), 0), grid_w - 1)
+        y = min(max(int(np.floor(box_centers[i, 1] / ratio)), 0), grid_h - 1)
+        k = anchors_mask[group].index(idx)
+        y_true[group][y, x, k, :2] = box_centers[i]
+        y_true[group][y, x, k, 2:4] = box_sizes[i]
+        y_true[group][y, x, k, 4] = 1.
+        y_true[group][y, x, k, 5 + labels[i]] = 1.
+        y_true[group][y, x, k, -1] = boxes[i, -1]
+    return y_true
+
+
+def random_boxes(rng, box_num, img_size, margin=0.):
+    '''
+    [box_num, 5] boxes whose centers can be up to margin * img_size beyond the image, with a mix up weight.
+    '''
+    size = np.array(img_size, np.float32)
+    centers = rng.uniform(-margin, 1 + margin, (box_num, 2)) * size
+    wh = rng.uniform(4, 300, (box_num, 2))
+    weights = rng.uniform(0, 1, (box_num, 1))
+    return np.concatenate([centers - wh / 2, centers + wh / 2, weights], axis=1).astype(np.float32)
+
+
+def check_parity(boxes, labels, img_size, class_num):
+    ref = loop_process_box(boxes, labels, img_size, class_num, ANCHORS)
+    for out, y in zip(process_box(boxes, labels, img_size, class_num, ANCHORS), ref):
+        assert out.dtype == y.dtype
+        np.testing.assert_array_equal(out, y)
+
+
+def test_process_box_matches_loop():
+    rng = np.random.RandomState(0)
+    for img_size in [[416, 416], [320, 608]]:
+        for box_num in [1, 3, 10, 50]:
+            boxes = random_boxes(rng, box_num, img_size)
+            check_parity(boxes, rng.randint(0, 5, box_num), img_size, 5)
+
+
+def test_process_box_colliding_cells():
+    rng = np.random.RandomState(1)
+    # many boxes of the same size in a few cells, the last box of a cell wins and the classes add up
+    for _ in range(20):
+        boxes = np.repeat(random_boxes(rng, 4, [416, 416]), 10, axis=0)
+        boxes[:, -1] = rng.uniform(0, 1, len(boxes))
+        check_parity(boxes, rng.randint(0, 3, len(boxes)), [416, 416], 3)
+
+
+def test_process_box_edge_centers():
+    rng = np.random.RandomState(2)
+    for img_size in [[416, 416], [608, 320]]:
+        boxes = random_boxes(rng, 200, img_size, margin=0.2)
+        check_parity(boxes, rng.randint(0, 3, 200), img_size, 3)
+        # centers exactly on the right and bottom edges
+        wh = rng.uniform(4, 300, (20, 2)).astype(np.float32)
+        centers = np.tile(np.array(img_size, np.float32), (20, 1))
+        boxes = np.concatenate([centers - wh / 2, centers + wh / 2, np.ones((20, 1), np.float32)], axis=1)
+        check_parity(boxes, rng.randint(0, 3, 20), img_size, 3)
+
+
+def test_process_box_into_batch_buffer():
+    rng = np.random.RandomState(3)
+    buffer = get_y_true_buffer([416, 416], 4, batch_size=2)
+    boxes = random_boxes(rng, 10, [416, 416])
+    labels = rng.randint(0, 4, 10)
+    process_box(boxes, labels, [416, 416], 4, ANCHORS, out=buffer[1])
+    ref = loop_process_box(boxes, labels, [416, 416], 4, ANCHORS)
+    empty = loop_process_box(boxes[:0], labels[:0], [416, 416], 4, ANCHORS)
+    for y_batch, y, y_empty in zip(split_y_true(buffer, [416, 416], 4), ref, empty):
+        np.testing.assert_array_equal(y_batch[1], y)
+        np.testing.assert_array_equal(y_batch[0], y_empty)
+
+
+def test_process_box_extra_labels():
+    rng = np.random.RandomState(4)
+    # the labels of the boxes dropped by the random crop are not dropped, the first labels are used
+    boxes = random_boxes(rng, 5, [416, 416])
+    labels = rng.randint(0, 3, 8)
+    for out, y in zip(process_box(boxes, labels, [416, 416], 3, ANCHORS),
+                      loop_process_box(boxes, labels[:5], [416, 416], 3, ANCHORS)):
+        np.testing.assert_array_equal(out, y)
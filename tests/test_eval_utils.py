@@ -0,0 +1,196 @@
+import numpy as np
+
+from utils.data_utils import process_box, get_y_true_buffer, split_y_true
+from utils.eval_utils import calc_iou, evaluate_on_cpu, evaluate_batch_preds, voc_ap, voc_eval, \
+    APAccumulator
+from utils.nms_utils import cpu_nms, batched_nms
+
+ANCHORS = np.array([[10, 13], [16, 30], [33, 23], [30, 61], [62, 45], [59, 119], [116, 90], [156, 198], [373, 326]],
+                   np.float32)
+
+
+def random_batch(rng, batch_size, num_classes, box_num=300, img_size=(416, 416)):
+    '''
+    The y_true of random gt boxes (the first image has none) and y_pred (boxes, confs, probs) made of jittered
+    copies of the gt boxes and of random boxes.
+    return: gt, a list of ([V, 4], [V]) per image, y_true and y_pred
+    '''
+    buffer = get_y_true_buffer(img_size, num_classes, batch_size)
+    gt, pred_boxes = [], []
+    for b in range(batch_size):
+        gt_num = 0 if b == 0 else rng.randint(1, 8)
+        centers = rng.uniform(40, 376, (gt_num, 2))
+        wh = rng.uniform(10, 150, (gt_num, 2))
+        boxes = np.concatenate([centers - wh / 2, centers + wh / 2], axis=1)
+        labels = rng.randint(0, num_classes, gt_num)
+        process_box(np.concatenate([boxes, np.ones((gt_num, 1))], axis=1).astype(np.float32), labels, img_size,
+                    num_classes, ANCHORS, out=buffer[b])
+        gt.append((boxes, labels))
+
+        copies = boxes[rng.randint(0, max(gt_num, 1), box_num // 2)] if gt_num else np.zeros((0, 4))
+        copies = copies + rng.normal(0, 8, copies.shape)
+        centers = rng.uniform(0, 416, (box_num - len(copies), 2))
+        wh = rng.uniform(10, 150, (box_num - len(copies), 2))
+        pred_boxes.append(np.concatenate([copies, np.concatenate([centers - wh / 2, centers + wh / 2], axis=1)]))
+    y_true = split_y_true(buffer, img_size, num_classes)
+    y_pred = (np.stack(pred_boxes).astype(np.float32), rng.uniform(0, 1, (batch_size, box_num, 1)).astype(np.float32),
+              rng.uniform(0, 1, (batch_size, box_num, num_classes)).astype(np.float32))
+    return gt, y_true, y_pred
+
+
+def loop_evaluate(y_pred, y_true, num_classes, max_boxes=50, score_thresh=0.5, iou_thresh=0.5):
+    '''
+    The reference of `evaluate_on_cpu`: the gt of every image pulled from the 3 feature maps, `cpu_nms` of the image,
+    and the matching of the predictions one by one.
+    '''
+    true_labels_dict = {i: 0 for i in range(num_classes)}
+    pred_labels_dict = {i: 0 for i in range(num_classes)}
+    true_positive_dict = {i: 0 for i in range(num_classes)}
+    for i in range(y_true[0].shape[0]):
+        true_labels_list, true_boxes_list = [], []
+        for j in range(3):
+            true_probs = y_true[j][i][..., 5:-1]
+            object_mask = true_probs.sum(axis=-1) > 0
+            true_labels_list += np.argmax(true_probs[object_mask], axis=-1).tolist()
+            true_boxes_list += y_true[j][i][..., 0:4][object_mask].tolist()
+        for label in true_labels_list:
+            true_labels_dict[label] += 1
+        true_boxes = np.array(true_boxes_list).reshape(-1, 4)
+        true_boxes[:, 0:2] = true_boxes[:, 0:2] - true_boxes[:, 2:4] / 2.
+        true_boxes[:, 2:4] = true_boxes[:, 0:2] + true_boxes[:, 2:4]
+
+        pred_boxes, pred_confs, pred_labels = cpu_nms(y_pred[0][i:i + 1], y_pred[1][i:i + 1] * y_pred[2][i:i + 1],
+                                                      num_classes, max_boxes=max_boxes, score_thresh=score_thresh,
+                                                      iou_thresh=iou_thresh)
+        if pred_labels is None:
+            continue
+        for label in pred_labels.tolist():
+            pred_labels_dict[label] += 1
+        if len(true_labels_list) == 0:
+            continue
+        iou_matrix = calc_iou(pred_boxes, true_boxes)
+        correct_idx = set()
+        for k, match_idx in enumerate(np.argmax(iou_matrix, axis=-1)):
+            if iou_matrix[k, match_idx] > iou_thresh and true_labels_list[match_idx] == pred_labels[k]:
+                correct_idx.add(match_idx)
+        for t in correct_idx:
+            true_positive_dict[true_labels_list[t]] += 1
+    return true_positive_dict, true_labels_dict, pred_labels_dict
+
+
+def test_evaluate_on_cpu_matches_loop():
+    rng = np.random.RandomState(0)
+    for num_classes in [1, 3]:
+        for _ in range(5):
+            _, y_true, y_pred = random_batch(rng, 6, num_classes)
+            for score_thresh in [0.3, 0.6]:
+                assert evaluate_on_cpu(y_pred, y_true, num_classes, calc_now=False, score_thresh=score_thresh) == \
+                    loop_evaluate(y_pred, y_true, num_classes, score_thresh=score_thresh)
+
+
+def test_evaluate_batch_preds_matches_evaluate_on_cpu():
+    rng = np.random.RandomState(1)
+    _, y_true, y_pred = random_batch(rng, 8, 3)
+    boxes, scores, labels, counts = batched_nms(y_pred[0], y_pred[1] * y_pred[2], 3, score_thresh=0.4)
+    for calc_now in [True, False]:
+        assert evaluate_batch_preds(y_true, boxes, scores, labels, counts, 3, calc_now=calc_now) == \
+            evaluate_on_cpu(y_pred, y_true, 3, calc_now=calc_now, score_thresh=0.4)
+
+
+def test_evaluate_on_cpu_without_detection():
+    rng = np.random.RandomState(2)
+    _, y_true, y_pred = random_batch(rng, 4, 2)
+    true_positive_dict, true_labels_dict, pred_labels_dict = evaluate_on_cpu(y_pred, y_true, 2, calc_now=False,
+                                                                             score_thresh=1.1)
+    assert true_positive_dict == pred_labels_dict == {0: 0, 1: 0}
+    assert true_labels_dict == loop_evaluate(y_pred, y_true, 2)[1]
+
+
+def random_gt_preds(rng, img_num, num_classes):
+    '''
+    A gt_dict of img_num images (some without gt) and the rows [image_id, x_min, y_min, x_max, y_max, score, label]
+    of the detections of every image, jittered copies of its gt and random boxes.
+    '''
+    gt_dict, preds = {}, []
+    for img_id in range(img_num):
+        gt_num = rng.randint(0, 6)
+        centers = rng.uniform(40, 376, (gt_num, 2))
+        wh = rng.uniform(10, 150, (gt_num, 2))
+        boxes = np.concatenate([centers - wh / 2, centers + wh / 2], axis=1)
+        labels = rng.randint(0, num_classes, gt_num)
+        gt_dict[img_id] = [list(box) + [label] for box, label in zip(boxes, labels)]
+
+        pred_num = rng.randint(0, 12)
+        if gt_num:
+            idx = rng.randint(0, gt_num, pred_num)
+            pred_boxes = boxes[idx] + rng.normal(0, 6, (pred_num, 4))
+            # most detections keep the class of their gt
+            pred_labels = np.where(rng.uniform(0, 1, pred_num) < 0.8, labels[idx], rng.randint(0, num_classes, pred_num))
+        else:
+            centers = rng.uniform(40, 376, (pred_num, 2))
+            pred_boxes = np.concatenate([centers - 20, centers + 20], axis=1)
+            pred_labels = rng.randint(0, num_classes, pred_num)
+        for box, score, label in zip(pred_boxes, rng.uniform(0, 1, pred_num), pred_labels):
+            preds.append([img_id] + list(box) + [score, label])
+    return gt_dict, preds
+
+
+def test_ap_accumulator_matches_voc_eval():
+    rng = np.random.RandomState(3)
+    for num_classes in [1, 4]:
+        gt_dict, preds = random_gt_preds(rng, 200, num_classes)
+        for iou_thres in [0.5, 0.75]:
+            accumulator = APAccumulator(gt_dict, num_classes, iou_thres)
+            # the detections of whole images, in batches of images in random order
+            img_order = rng.permutation(len(gt_dict))
+            for batch in np.array_split(img_order, 17):
+                accumulator.update([row for row in preds if row[0] in set(batch.tolist())])
+            for c in range(num_classes):
+                np.testing.assert_allclose(accumulator.evaluate(c), voc_eval(gt_dict, preds, c, iou_thres))
+
+
+def test_ap_accumulator_reset():
+    rng = np.random.RandomState(4)
+    gt_dict, preds = random_gt_preds(rng, 50, 2)
+    accumulator = APAccumulator(gt_dict, 2)
+    accumulator.update(preds)
+    first = [accumulator.evaluate(c) for c in range(2)]
+    accumulator.reset()
+    accumulator.update([])
+    accumulator.update(preds)
+    assert [accumulator.evaluate(c) for c in range(2)] == first
+
+
+def loop_voc_ap(rec, prec):
+    '''
+    The reference of `voc_ap`: the precision envelope computed point by point.
+    '''
+    mrec = np.concatenate(([0.], rec, [1.]))
+    mpre = np.concatenate(([0.], prec, [0.]))
+    for i in range(mpre.size - 1, 0, -1):
+        mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+    i = np.where(mrec[1:] != mrec[:-1])[0]
+    return np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
+
+
+def test_voc_ap_matches_loop():
+    rng = np.random.RandomState(5)
+    for nd in [1, 10, 500]:
+        tp = np.cumsum(rng.uniform(0, 1, nd) < 0.6)
+        rec = tp / float(nd + 5)
+        prec = tp / np.arange(1., nd + 1)
+        assert voc_ap(rec, prec) == loop_voc_ap(rec, prec)
+    assert voc_ap(np.zeros(0), np.zeros(0)) == loop_voc_ap(np.zeros(0), np.zeros(0))
+
+
+def test_ap_accumulator_coco_matches_voc_eval():
+    rng = np.random.RandomState(6)
+    gt_dict, preds = random_gt_preds(rng, 200, 3)
+    accumulator = APAccumulator(gt_dict, 3, coco_metric=True)
+    for batch in np.array_split(np.arange(len(gt_dict)), 9):
+        accumulator.update([row for row in preds if row[0] in set(batch.tolist())])
+    for c in range(3):
+        # the first column stays the one of iou_thres
+        np.testing.assert_allclose(accumulator.evaluate(c), voc_eval(gt_dict, preds, c))
+        aps = [voc_eval(gt_dict, preds, c, iou_thres)[-1] for iou_thres in np.linspace(0.5, 0.95, 10)]
+        np.testing.assert_allclose(accumulator.evaluate_coco(c), np.mean(aps))
@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+if not hasattr(tf, 'contrib'):
+    pytest.skip('the model is built with TensorFlow 1.x', allow_module_level=True)
+
+from utils.data_utils import process_box, get_y_true_buffer, split_y_true
+from yolo3.model_GIOU import yolov3
+
+ANCHORS = np.array([[10, 13], [16, 30], [33, 23], [30, 61], [62, 45], [59, 119], [116, 90], [156, 198], [373, 326]],
+                   np.float32)
+
+
+def random_feature_maps(rng, batch_size, class_num, img_size=(416, 416)):
+    '''
+    Random feature maps of the 3 scales for an image size [width, height].
+    '''
+    return [rng.normal(0, 1, (batch_size, img_size[1] // ratio, img_size[0] // ratio, 3 * (5 + class_num)))
+            .astype(np.float32) for ratio in [32, 16, 8]]
+
+
+def random_y_true(rng, batch_size, class_num, img_size=(416, 416)):
+    '''
+    The y_true of random boxes, the first image has none and the others have different counts.
+    '''
+    buffer = get_y_true_buffer(img_size, class_num, batch_size)
+    for b in range(1, batch_size):
+        box_num = rng.randint(1, 15)
+        centers = rng.uniform(0, 1, (box_num, 2)) * img_size
+        wh = rng.uniform(10, 200, (box_num, 2))
+        boxes = np.concatenate([centers - wh / 2, centers + wh / 2, rng.uniform(0.5, 1, (box_num, 1))], axis=1)
+        process_box(boxes.astype(np.float32), rng.randint(0, class_num, box_num), img_size, class_num, ANCHORS,
+                    out=buffer[b])
+    return split_y_true(buffer, img_size, class_num)
+
+
+@pytest.mark.parametrize('use_giou_loss', [False, True])
+def test_loss_of_batch_matches_images(use_giou_loss):
+    '''
+    The ignore mask of the batch pads the true boxes of every image to the max count of the batch: the loss and its
+    gradient must be the ones of the images computed one by one, like the per-image loop they replace.
+    '''
+    class_num, batch_size = 3, 5
+    rng = np.random.RandomState(0)
+    feature_maps = random_feature_maps(rng, batch_size, class_num)
+    y_true = random_y_true(rng, batch_size, class_num)
+
+    graph = tf.Graph()
+    with graph.as_default():
+        feature_map_flags = [tf.placeholder(tf.float32, [None, None, None, 3 * (5 + class_num)]) for _ in range(3)]
+        y_true_flags = [tf.placeholder(tf.float32, [None, None, None, 3, 6 + class_num]) for _ in range(3)]
+        model = yolov3(class_num, ANCHORS, use_giou_loss=use_giou_loss, use_static_shape=False)
+        model.img_size = tf.constant([416, 416])
+        loss = model.compute_loss(feature_map_flags, y_true_flags)
+        grads = tf.gradients(loss[0], feature_map_flags)
+        with tf.Session() as sess:
+            def run(batch):
+                feed = {flag: value[batch] for flag, value in zip(feature_map_flags + y_true_flags, feature_maps + y_true)}
+                return sess.run([loss, grads], feed_dict=feed)
+            batch_loss, batch_grads = run(slice(None))
+            image_results = [run(slice(b, b + 1)) for b in range(batch_size)]
+
+    # the losses are divided by the batch size
+    np.testing.assert_allclose(batch_loss, np.mean([result[0] for result in image_results], axis=0), rtol=1e-5)
+    for i in range(3):
+        image_grads = np.concatenate([result[1][i] for result in image_results]) / batch_size
+        np.testing.assert_allclose(batch_grads[i], image_grads, rtol=1e-4, atol=1e-7)
+
+
+@pytest.mark.parametrize('img_size', [[416, 416], [416, 320]])
+def test_predict_static_matches_predict(img_size):
+    class_num, batch_size = 2, 3
+    rng = np.random.RandomState(1)
+    # scaled up so that the scores pass the threshold of the NMS
+    feature_maps = [x * 3. for x in random_feature_maps(rng, batch_size, class_num, img_size)]
+
+    graph = tf.Graph()
+    with graph.as_default():
+        feature_map_flags = [tf.placeholder(tf.float32, (None,) + x.shape[1:]) for x in feature_maps]
+        model = yolov3(class_num, ANCHORS, use_static_shape=True)
+        model.img_size = tf.constant([img_size[1], img_size[0]])
+        outputs = [model.predict(feature_map_flags), model.predict_static(feature_map_flags, img_size),
+                   model.predict(feature_map_flags, nms=True, score_thresh=0.3),
+                   model.predict_static(feature_map_flags, img_size, nms=True, score_thresh=0.3)]
+        with tf.Session() as sess:
+            boxes, static_boxes, detections, static_detections = sess.run(
+                outputs, feed_dict=dict(zip(feature_map_flags, feature_maps)))
+
+    for x, y in zip(boxes, static_boxes):
+        np.testing.assert_allclose(x, y, rtol=1e-5, atol=1e-3)
+    assert np.all(detections[3] > 0)
+    np.testing.assert_array_equal(detections[3], static_detections[3])
+    np.testing.assert_array_equal(detections[2], static_detections[2])
+    for x, y in zip(detections[:2], static_detections[:2]):
+        np.testing.assert_allclose(x, y, rtol=1e-5, atol=1e-3)
+
+
+def test_predict_static_rejects_other_sizes():
+    graph = tf.Graph()
+    with graph.as_default():
+        feature_map_flags = [tf.placeholder(tf.float32, [None, 10, 10, 21]) for _ in range(3)]
+        with pytest.raises(ValueError):
+            yolov3(2, ANCHORS).predict_static(feature_map_flags, [330, 330])
@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+
+from utils.nms_utils import cpu_nms, batched_nms, preselect, numpy_nms, compiled_nms, njit
+
+
+def random_preds(rng, batch_size, box_num, num_classes, ties=False):
+    '''
+    Random boxes [B, box_num, 4] clustered around a few centers so that they overlap, and scores
+    [B, box_num, num_classes]. With ties, the scores are rounded so that many of them are equal.
+    '''
+    centers = rng.uniform(0, 416, (batch_size, 8, 2))[:, rng.randint(0, 8, box_num)]
+    centers += rng.normal(0, 10, centers.shape)
+    sizes = rng.uniform(10, 100, (batch_size, box_num, 2))
+    boxes = np.concatenate([centers - sizes / 2, centers + sizes / 2], axis=-1).astype(np.float32)
+    scores = rng.uniform(0, 1, (batch_size, box_num, num_classes)).astype(np.float32)
+    if ties:
+        scores = np.round(scores * 10) / 10
+    return boxes, scores
+
+
+def check_parity(boxes, scores, num_classes, **kwargs):
+    '''
+    `batched_nms` of the batch against `cpu_nms` of every image.
+    '''
+    out_boxes, out_scores, out_labels, counts = batched_nms(boxes, scores, num_classes, **kwargs)
+    for b in range(len(boxes)):
+        ref_boxes, ref_scores, ref_labels = cpu_nms(boxes[b:b + 1], scores[b:b + 1], num_classes, **kwargs)
+        if ref_boxes is None:
+            assert counts[b] == 0
+            continue
+        n = counts[b]
+        assert n == len(ref_labels)
+        np.testing.assert_array_equal(out_boxes[b, :n], ref_boxes)
+        np.testing.assert_array_equal(out_scores[b, :n], ref_scores)
+        np.testing.assert_array_equal(out_labels[b, :n], ref_labels)
+        # padding
+        assert np.all(out_labels[b, n:] == -1)
+
+
+def test_batched_nms_matches_cpu_nms():
+    rng = np.random.RandomState(0)
+    for num_classes in [1, 2, 5]:
+        for box_num in [50, 500, 3000]:
+            boxes, scores = random_preds(rng, 3, box_num, num_classes)
+            check_parity(boxes, scores, num_classes, max_boxes=50, score_thresh=0.5, iou_thresh=0.5,
+                         pre_nms_topk=None)
+
+
+def test_batched_nms_matches_cpu_nms_with_ties():
+    rng = np.random.RandomState(1)
+    for num_classes in [1, 3]:
+        boxes, scores = random_preds(rng, 3, 1000, num_classes, ties=True)
+        check_parity(boxes, scores, num_classes, max_boxes=20, score_thresh=0.3, iou_thresh=0.45, pre_nms_topk=None)
+
+
+def test_batched_nms_matches_cpu_nms_with_max_boxes():
+    rng = np.random.RandomState(2)
+    boxes, scores = random_preds(rng, 2, 2000, 3)
+    check_parity(boxes, scores, 3, max_boxes=5, score_thresh=0.1, iou_thresh=0.7, pre_nms_topk=None)
+
+
+def test_batched_nms_matches_cpu_nms_with_pre_nms_topk():
+    rng = np.random.RandomState(4)
+    boxes, scores = random_preds(rng, 2, 3000, 3)
+    check_parity(boxes, scores, 3, max_boxes=50, score_thresh=0.2, iou_thresh=0.5, pre_nms_topk=100)
+
+
+def test_preselect_keeps_top_k_per_class():
+    rng = np.random.RandomState(5)
+    # the class 0 has many more candidates than the others
+    scores = rng.uniform(0, 1, (3000, 3)).astype(np.float32) * np.array([1., .4, .35], np.float32)
+    box_idx, labels, cand_scores = preselect(scores, score_thresh=0.3, pre_nms_topk=50)
+    assert np.all(np.diff(box_idx * 3 + labels) > 0)
+    for i in range(3):
+        cls_idx = np.flatnonzero(scores[:, i] >= 0.3)
+        top = cls_idx[np.argsort(-scores[cls_idx, i], kind='stable')[:50]]
+        np.testing.assert_array_equal(box_idx[labels == i], np.sort(top))
+    np.testing.assert_array_equal(cand_scores, scores[box_idx, labels])
+
+
+def test_batched_nms_empty():
+    rng = np.random.RandomState(3)
+    boxes, scores = random_preds(rng, 2, 100, 3)
+    # no score above the threshold
+    out_boxes, out_scores, out_labels, counts = batched_nms(boxes, scores * 0.1, 3, score_thresh=0.5)
+    assert out_boxes.shape == (2, 150, 4) and np.all(counts == 0) and np.all(out_labels == -1)
+    assert cpu_nms(boxes[:1], scores[:1] * 0.1, 3, score_thresh=0.5) == (None, None, None)
+    check_parity(boxes, scores * 0.1, 3, score_thresh=0.5)
+
+    # no box at all
+    out_boxes, out_scores, out_labels, counts = batched_nms(np.zeros((2, 0, 4), np.float32),
+                                                            np.zeros((2, 0, 3), np.float32), 3)
+    assert np.all(counts == 0)
+    check_parity(np.zeros((2, 0, 4), np.float32), np.zeros((2, 0, 3), np.float32), 3)
+
+
+@pytest.mark.skipif(njit is None, reason='numba is not installed')
+def test_compiled_nms_matches_numpy_nms():
+    rng = np.random.RandomState(6)
+    for box_num in [1, 100, 1000]:
+        boxes, scores = random_preds(rng, 1, box_num, 1)
+        boxes, scores = boxes[0], scores[0, :, 0]
+        # integer boxes must not truncate iou_thresh
+        for dtype in [np.float32, np.float64, np.int32, np.int64]:
+            for max_boxes in [50, 3, None]:
+                for iou_thresh in [0.3, 0.5, 0.45]:
+                    assert compiled_nms(boxes.astype(dtype), scores, max_boxes, iou_thresh) == \
+                        numpy_nms(boxes.astype(dtype), scores, max_boxes, iou_thresh)
+    assert compiled_nms(boxes, scores, 0) == numpy_nms(boxes, scores, 0) == []
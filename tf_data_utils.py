@@ -0,0 +1,385 @@
+import time
+import argparse
+
+import numpy as np
+import tensorflow as tf
+
+from utils.anno_utils import open_annotation_store
+from utils.data_utils import scale_schedule
+
+
+class GraphAnnotationStore(object):
+    '''
+    The arrays of an annotation store (see `anno_utils`) as graph constants, to look up the annotations
+    of an image index inside the tf.data pipeline.
+    '''
+    def __init__(self, anno_store):
+        store = open_annotation_store(anno_store)
+        self.img_cnt = len(store)
+        self.offsets = tf.constant(store.offsets)
+        self.boxes = tf.constant(store.boxes)
+        self.labels = tf.constant(store.labels)
+        self.line_idx = tf.constant(store.line_idx)
+        self.paths = tf.constant(store.paths)
+
+    def parse(self, i):
+        '''
+        Same as `AnnotationStore.parse` for an int64 image index tensor:
+            line_idx, pic_path, boxes [N, 4] float32, labels [N] int64
+        '''
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.line_idx[i], self.paths[i], self.boxes[start: end], self.labels[start: end]
+
+
+def tf_decode(pic_path):
+    '''
+    Decode an image file to a [h, w, 3] uint8 tensor, RGB order.
+    '''
+    img = tf.image.decode_jpeg(tf.read_file(pic_path), channels=3)
+    img.set_shape([None, None, 3])
+    return img
+
+
+def tf_bbox_iou(bbox_a, bbox_b):
+    '''
+    IoU of the boxes in the last 2 dims of bbox_a [..., M, 4] and bbox_b [N, 4], same as `data_aug.bbox_iou`.
+    return: [..., M, N]
+    '''
+    bbox_a = tf.expand_dims(bbox_a, -2)
+    tl = tf.maximum(bbox_a[..., :2], bbox_b[:, :2])
+    br = tf.minimum(bbox_a[..., 2:4], bbox_b[:, 2:4])
+    area_i = tf.reduce_prod(br - tl, axis=-1) * tf.cast(tf.reduce_all(tl < br, axis=-1), tf.float32)
+    area_a = tf.reduce_prod(bbox_a[..., 2:4] - bbox_a[..., :2], axis=-1)
+    area_b = tf.reduce_prod(bbox_b[:, 2:4] - bbox_b[:, :2], axis=-1)
+    return area_i / (area_a + area_b - area_i)
+
+
+def tf_random_expand(img, boxes, max_ratio=4, fill=0):
+    '''
+    Graph version of `data_aug.random_expand`, keeping the aspect ratio.
+    img: [h, w, 3] tensor, boxes: [N, 5] float32, x_min, y_min, x_max, y_max, mixup_weight
+    '''
+    h, w = tf.shape(img)[0], tf.shape(img)[1]
+    ratio = tf.random_uniform([], 1., max_ratio)
+    oh = tf.cast(tf.cast(h, tf.float32) * ratio, tf.int32)
+    ow = tf.cast(tf.cast(w, tf.float32) * ratio, tf.int32)
+    off_y = tf.random_uniform([], 0, oh - h + 1, dtype=tf.int32)
+    off_x = tf.random_uniform([], 0, ow - w + 1, dtype=tf.int32)
+    img = tf.pad(img, [[off_y, oh - h - off_y], [off_x, ow - w - off_x], [0, 0]], constant_values=tf.cast(fill, img.dtype))
+    offset = tf.cast(tf.stack([off_x, off_y, off_x, off_y, 0]), tf.float32)
+    return img, boxes + offset
+
+
+def tf_random_crop_with_constraints(boxes, labels, size, min_scale=0.3, max_scale=1, max_aspect_ratio=2, constraints=None, max_trial=50):
+    '''
+    Graph version of `data_aug.random_crop_with_constraints`, all the trials are sampled at once.
+    Each constraint keeps its first valid trial, then one of the candidates whose crop keeps at least a box is
+    picked at random, the same distribution as the python version.
+    Unlike the python version, the labels of the dropped boxes are dropped too.
+    params:
+        boxes: [N, 5] float32, x_min, y_min, x_max, y_max, mixup_weight
+        labels: [N] int64
+        size: (w, h), int32 tensors
+    return: boxes and labels in the crop, crop: [4] int32, (x0, y0, w, h)
+    '''
+    if constraints is None:
+        constraints = ((0.1, None), (0.3, None), (0.5, None), (0.7, None), (0.9, None), (None, 1))
+    min_ious = np.array([[-np.inf if c[0] is None else c[0]] for c in constraints], np.float32)
+    max_ious = np.array([[np.inf if c[1] is None else c[1]] for c in constraints], np.float32)
+
+    w, h = tf.cast(size[0], tf.float32), tf.cast(size[1], tf.float32)
+    shape = [len(constraints), max_trial]
+    scale = tf.random_uniform(shape, min_scale, max_scale)
+    min_ar = tf.maximum(1. / max_aspect_ratio, scale * scale)
+    max_ar = tf.minimum(float(max_aspect_ratio), 1. / (scale * scale))
+    aspect_ratio = min_ar + tf.random_uniform(shape) * (max_ar - min_ar)
+    crop_h = tf.floor(h * scale / tf.sqrt(aspect_ratio))
+    crop_w = tf.floor(w * scale * tf.sqrt(aspect_ratio))
+    crop_t = tf.floor(tf.random_uniform(shape) * tf.maximum(h - crop_h, 1.))
+    crop_l = tf.floor(tf.random_uniform(shape) * tf.maximum(w - crop_w, 1.))
+    # [C, T, 4]
+    crops = tf.stack([crop_l, crop_t, crop_l + crop_w, crop_t + crop_h], axis=-1)
+
+    # [C, T, N]
+    iou = tf_bbox_iou(crops, boxes[:, :4])
+    valid = tf.logical_and(tf.reduce_min(iou, axis=-1) >= min_ious, tf.reduce_max(iou, axis=-1) <= max_ious)
+    first = tf.argmax(tf.cast(valid, tf.int32), axis=1, output_type=tf.int32)
+    # [C + 1, 4], the whole image is always a candidate
+    candidates = tf.concat([[tf.stack([0., 0., w, h])], tf.gather_nd(crops, tf.stack([tf.range(len(constraints)), first], axis=1))], axis=0)
+    candidate_valid = tf.concat([[True], tf.reduce_any(valid, axis=1)], axis=0)
+
+    # same as `data_aug.bbox_crop(allow_outside_center=False)` for every candidate, [C + 1, N]
+    centers = (boxes[:, 0:2] + boxes[:, 2:4]) / 2
+    crop_tl = tf.expand_dims(candidates[:, 0:2], 1)
+    crop_br = tf.expand_dims(candidates[:, 2:4], 1)
+    inside = tf.reduce_all(tf.logical_and(crop_tl <= centers, centers < crop_br), axis=-1)
+    tl = tf.maximum(boxes[:, 0:2], crop_tl) - crop_tl
+    br = tf.minimum(boxes[:, 2:4], crop_br) - crop_tl
+    keep = tf.logical_and(inside, tf.reduce_all(tl < br, axis=-1))
+
+    usable = tf.logical_and(candidate_valid, tf.reduce_any(keep, axis=1))
+    choice = tf.argmax(tf.where(usable, tf.random_uniform([len(constraints) + 1]), -tf.ones([len(constraints) + 1])), output_type=tf.int32)
+
+    def crop_fn():
+        mask = keep[choice]
+        new_boxes = tf.concat([tl[choice], br[choice], boxes[:, 4:]], axis=-1)
+        crop = candidates[choice]
+        return tf.boolean_mask(new_boxes, mask), tf.boolean_mask(labels, mask), tf.cast(tf.concat([crop[:2], crop[2:] - crop[:2]], 0), tf.int32)
+
+    return tf.cond(tf.reduce_any(usable), crop_fn, lambda: (boxes, labels, tf.cast(tf.stack([0., 0., w, h]), tf.int32)))
+
+
+def tf_resize(img, size, interp=1):
+    '''
+    Resize img to size (h, w), return float32.
+    interp: int or int32 tensor, the cv2 interpolation code, 0: nearest, 1: linear, 2: cubic, 3: area, 4: lanczos4.
+        lanczos4 is not available in TF, cubic is used instead.
+    '''
+    methods = [tf.image.ResizeMethod.NEAREST_NEIGHBOR, tf.image.ResizeMethod.BILINEAR, tf.image.ResizeMethod.BICUBIC,
+               tf.image.ResizeMethod.AREA, tf.image.ResizeMethod.BICUBIC]
+    resize_fn = lambda method: lambda: tf.cast(tf.image.resize_images(img, size, method=method), tf.float32)
+    if isinstance(interp, int):
+        img = resize_fn(methods[interp])()
+    else:
+        img = tf.case([(tf.equal(interp, i), resize_fn(method)) for i, method in enumerate(methods)], exclusive=True)
+    # cv2 saturates the cubic overshoot for uint8 images
+    return tf.clip_by_value(img, 0., 255.)
+
+
+def tf_resize_with_bbox(img, boxes, new_width, new_height, interp=1, letterbox=False):
+    '''
+    Graph version of `data_aug.resize_with_bbox`.
+    new_width, new_height: int or int32 tensors
+    return: [new_height, new_width, 3] float32 image, boxes
+    '''
+    h, w = tf.cast(tf.shape(img)[0], tf.float32), tf.cast(tf.shape(img)[1], tf.float32)
+    new_width_f, new_height_f = tf.cast(new_width, tf.float32), tf.cast(new_height, tf.float32)
+    if letterbox:
+        resize_ratio = tf.minimum(new_width_f / w, new_height_f / h)
+        resize_w = tf.cast(resize_ratio * w, tf.int32)
+        resize_h = tf.cast(resize_ratio * h, tf.int32)
+        img = tf_resize(img, tf.stack([resize_h, resize_w]), interp)
+        dw = (new_width - resize_w) // 2
+        dh = (new_height - resize_h) // 2
+        img = tf.pad(img, [[dh, new_height - resize_h - dh], [dw, new_width - resize_w - dw], [0, 0]], constant_values=128.)
+        scale = tf.stack([resize_ratio, resize_ratio, resize_ratio, resize_ratio, 1.])
+        offset = tf.cast(tf.stack([dw, dh, dw, dh, 0]), tf.float32)
+        boxes = boxes * scale + offset
+    else:
+        img = tf_resize(img, tf.stack([new_height, new_width]), interp)
+        boxes = boxes * tf.stack([new_width_f / w, new_height_f / h, new_width_f / w, new_height_f / h, 1.])
+    return img, boxes
+
+
+def tf_random_flip(img, boxes, px=0.5):
+    '''
+    Graph version of `data_aug.random_flip`, horizontal flip with probability px.
+    '''
+    width = tf.cast(tf.shape(img)[1], tf.float32)
+    flip = tf.random_uniform([]) < px
+    flipped_boxes = tf.stack([width - boxes[:, 2], boxes[:, 1], width - boxes[:, 0], boxes[:, 3], boxes[:, 4]], axis=1)
+    return tf.cond(flip, lambda: (tf.reverse(img, [1]), flipped_boxes), lambda: (img, boxes))
+
+
+def tf_random_hsv_jitter(img, hue=.1, sat=1.5, val=1.5):
+    '''
+    Graph version of `color_utils.random_hsv_jitter`, on the uint8 RGB image of `tf_decode`.
+    '''
+    def random_scale(m):
+        scale = tf.random_uniform([], 1., m)
+        return tf.where(tf.random_uniform([]) < .5, scale, 1. / scale)
+    x = tf.image.rgb_to_hsv(tf.cast(img, tf.float32) / 255.)
+    h = tf.mod(x[..., 0] + tf.random_uniform([], -hue, hue), 1.)
+    s = tf.clip_by_value(x[..., 1] * random_scale(sat), 0., 1.)
+    v = tf.clip_by_value(x[..., 2] * random_scale(val), 0., 1.)
+    return tf.cast(tf.round(tf.image.hsv_to_rgb(tf.stack([h, s, v], axis=-1)) * 255.), tf.uint8)
+
+
+def tf_process_box(boxes, labels, img_size, class_num, anchors):
+    '''
+    Vectorized graph version of `data_utils.process_box`, with the same y_true for the boxes in the image:
+    when several boxes fall in the same cell and anchor, the last one writes the coords and the mixup weight,
+    and the class one-hot keeps the classes of all of them.
+    params:
+        boxes: [N, 5] float32, x_min, y_min, x_max, y_max, mixup_weight
+        labels: [N] int64
+        img_size: [2] int32 tensor, [width, height]
+        class_num: int
+        anchors: [9, 2] numpy array
+    '''
+    anchors = tf.constant(anchors, tf.float32)
+    box_cnt = tf.shape(boxes)[0]
+
+    box_centers = (boxes[:, 0:2] + boxes[:, 2:4]) / 2
+    box_sizes = boxes[:, 2:4] - boxes[:, 0:2]
+
+    # [N, 9]
+    box_sizes_ = tf.expand_dims(box_sizes, 1)
+    mins = tf.maximum(- box_sizes_ / 2, - anchors / 2)
+    maxs = tf.minimum(box_sizes_ / 2, anchors / 2)
+    whs = maxs - mins
+    iou = (whs[:, :, 0] * whs[:, :, 1]) / (
+        box_sizes_[:, :, 0] * box_sizes_[:, :, 1] + anchors[:, 0] * anchors[:, 1] - whs[:, :, 0] * whs[:, :, 1] + 1e-10)
+    # [N]
+    best_match_idx = tf.argmax(iou, axis=1, output_type=tf.int32)
+    # 0,1,2 ==> 2; 3,4,5 ==> 1; 6,7,8 ==> 0
+    feature_map_group = 2 - best_match_idx // 3
+    k = best_match_idx % 3
+    # 0,1,2 ==> 8; 3,4,5 ==> 16; 6,7,8 ==> 32
+    ratio = tf.gather(tf.constant([8., 16., 32.]), best_match_idx // 3)
+    grid_size = tf.stack([img_size[0] // tf.gather([32, 16, 8], feature_map_group),
+                          img_size[1] // tf.gather([32, 16, 8], feature_map_group)], axis=1)
+    xy = tf.cast(tf.floor(box_centers / tf.expand_dims(ratio, 1)), tf.int32)
+    xy = tf.minimum(tf.maximum(xy, 0), grid_size - 1)
+    # [N, 4], feature_map_group, y, x, k
+    cells = tf.stack([feature_map_group, xy[:, 1], xy[:, 0], k], axis=1)
+
+    # the last box of each cell wins
+    same_cell = tf.reduce_all(tf.equal(tf.expand_dims(cells, 1), tf.expand_dims(cells, 0)), axis=-1)
+    later = tf.expand_dims(tf.range(box_cnt), 1) < tf.expand_dims(tf.range(box_cnt), 0)
+    is_last = tf.logical_not(tf.reduce_any(tf.logical_and(same_cell, later), axis=1))
+
+    values = tf.concat([box_centers, box_sizes, tf.ones_like(box_sizes[:, :1])], axis=-1)
+    class_values = tf.one_hot(labels, class_num, dtype=tf.float32)
+
+    y_true = []
+    for group, stride in enumerate([32, 16, 8]):
+        shape = tf.stack([img_size[1] // stride, img_size[0] // stride, 3])
+        in_group = tf.equal(feature_map_group, group)
+        written = tf.logical_and(in_group, is_last)
+        indices = tf.boolean_mask(cells[:, 1:], written)
+        coords = tf.scatter_nd(indices, tf.boolean_mask(values, written), tf.concat([shape, [5]], 0))
+        classes = tf.minimum(tf.scatter_nd(tf.boolean_mask(cells[:, 1:], in_group), tf.boolean_mask(class_values, in_group),
+                                           tf.concat([shape, [class_num]], 0)), 1.)
+        # mix up weight default to 1.
+        occupied = tf.scatter_nd(indices, tf.ones_like(indices[:, 0]), shape) > 0
+        weight = tf.where(occupied, tf.scatter_nd(indices, tf.boolean_mask(boxes[:, 4], written), shape), tf.ones(shape))
+        y_true.append(tf.concat([coords, classes, tf.expand_dims(weight, -1)], axis=-1))
+
+    return y_true
+
+
+def tf_parse_data(i, annotations, class_num, img_size, anchors, mode, letterbox_resize, uint8=False, color_distort=False):
+    '''
+    Graph version of `data_utils.parse_data`.
+    param:
+        i: int64 tensor, the index of the image in the annotation store
+        annotations: GraphAnnotationStore
+        img_size: [2] int32 tensor, [width, height]
+        mode: 'train' or 'val'
+        uint8: return the image as uint8 in range 0~255, the model normalizes it, see `yolov3.forward`.
+        color_distort: random HSV color jittering in 'train' mode.
+    '''
+    img_idx, pic_path, boxes, labels = annotations.parse(i)
+    img = tf_decode(pic_path)
+    # expand the 2nd dimension, mix up weight default to 1.
+    boxes = tf.concat([boxes, tf.ones_like(boxes[:, :1])], axis=-1)
+
+    if mode == 'train':
+        # random color jittering
+        if color_distort:
+            img = tf_random_hsv_jitter(img)
+
+        # random expansion with prob 0.5
+        img, boxes = tf.cond(tf.random_uniform([]) > 0.5, lambda: tf_random_expand(img, boxes, 4), lambda: (img, boxes))
+
+        # random cropping
+        boxes, labels, crop = tf_random_crop_with_constraints(boxes, labels, (tf.shape(img)[1], tf.shape(img)[0]))
+        img = img[crop[1]: crop[1] + crop[3], crop[0]: crop[0] + crop[2]]
+
+        # resize with random interpolation
+        interp = tf.random_uniform([], 0, 5, dtype=tf.int32)
+        img, boxes = tf_resize_with_bbox(img, boxes, img_size[0], img_size[1], interp=interp, letterbox=letterbox_resize)
+
+        # random horizontal flip
+        img, boxes = tf_random_flip(img, boxes, px=0.5)
+    else:
+        img, boxes = tf_resize_with_bbox(img, boxes, img_size[0], img_size[1], interp=1, letterbox=letterbox_resize)
+
+    if uint8:
+        img = tf.cast(tf.round(img), tf.uint8)
+    else:
+        # the input of yolo_v3 should be in range 0~1
+        img = img / 255.
+
+    y_true_13, y_true_26, y_true_52 = tf_process_box(boxes, labels, img_size, class_num, anchors)
+
+    return img_idx, img, y_true_13, y_true_26, y_true_52
+
+
+def get_graph_dataset(anno_store, class_num, img_size, anchors, mode, batch_size, shuffle=False, multi_scale=False,
+                      letterbox_resize=True, interval=10, num_threads=10, uint8=False, color_distort=False, schedule=None):
+    '''
+    A tf.data pipeline in which the whole sample preparation of `data_utils.get_batch_data` runs as TF ops,
+    so that the samples are processed in parallel without holding the GIL.
+    The elements are the same as the ones of the tf.py_func(get_batch_data) pipeline:
+        img_idx [B] int64, img [B, h, w, 3] float32 RGB in 0~1, y_true_13, y_true_26, y_true_52
+    param:
+        anno_store: path of the annotation txt file or store, see `anno_utils`
+        img_size: [width, height]
+        mode: 'train' or 'val'. if set to 'train', data augmentation will be applied.
+        multi_scale: whether to use multi_scale training, with the scale schedule of `data_utils.scale_schedule`.
+            Note that it will take effect only when mode is set to 'train'.
+        interval: change the scale of image every interval batches.
+        schedule: [batch_num, 2] int32 tensor, the size of every batch, e.g. a placeholder fed with a new
+            `scale_schedule` at each initialization of the iterator. The schedule of seed 0 by default.
+        uint8: uint8 images in range 0~255 instead of float32, see `tf_parse_data`.
+        color_distort: random HSV color jittering, see `tf_parse_data`.
+    '''
+    annotations = GraphAnnotationStore(anno_store)
+    img_cnt = annotations.img_cnt
+
+    if multi_scale and mode == 'train':
+        if schedule is None:
+            schedule = tf.constant(scale_schedule((img_cnt + batch_size - 1) // batch_size, img_size, True, interval, 0))
+        size_fn = lambda pos: schedule[pos // batch_size]
+    else:
+        size_fn = lambda pos: tf.constant(img_size, tf.int32)
+
+    dataset = tf.data.Dataset.range(img_cnt)
+    if shuffle:
+        dataset = dataset.shuffle(img_cnt)
+    # zip with the position in the epoch, all the images of a batch have the same size
+    dataset = tf.data.Dataset.zip((tf.data.Dataset.range(img_cnt), dataset))
+    dataset = dataset.map(
+        lambda pos, i: tf_parse_data(i, annotations, class_num, size_fn(pos), anchors, mode, letterbox_resize, uint8, color_distort),
+        num_parallel_calls=num_threads
+    )
+    return dataset.batch(batch_size)
+
+
+if __name__ == '__main__':
+    from utils.data_utils import get_batch_data
+    from utils.misc_utils import parse_anchors
+
+    parser = argparse.ArgumentParser(description='Compare the batch throughput of the tf.py_func and the graph pipelines.')
+    parser.add_argument('--anno_path', type=str, default='./data/my_data/train.txt', help='Path of the annotation txt file.')
+    parser.add_argument('--anchor_path', type=str, default='./data/yolo_anchors.txt', help='Path of the anchor file.')
+    parser.add_argument('--class_num', type=int, default=80, help='Number of classes.')
+    parser.add_argument('--img_size', nargs='*', type=int, default=[416, 416], help='Resize the input image to [width, height].')
+    parser.add_argument('--batch_size', type=int, default=6, help='Batch size.')
+    parser.add_argument('--num_threads', type=int, default=10, help='num_parallel_calls of the map.')
+    parser.add_argument('--batch_num', type=int, default=50, help='Number of batches to time.')
+    args = parser.parse_args()
+
+    anchors = parse_anchors(args.anchor_path)
+    anno_store = open_annotation_store(args.anno_path).store_dir
+    img_cnt = len(open_annotation_store(anno_store))
+
+    py_dataset = tf.data.Dataset.range(img_cnt).shuffle(img_cnt).batch(args.batch_size).map(
+        lambda x: tf.py_func(get_batch_data,
+                             inp=[x, args.class_num, args.img_size, anchors, 'train', False, True, anno_store],
+                             Tout=[tf.int64, tf.float32, tf.float32, tf.float32, tf.float32]),
+        num_parallel_calls=args.num_threads)
+    graph_dataset = get_graph_dataset(anno_store, args.class_num, args.img_size, anchors, 'train', args.batch_size,
+                                      shuffle=True, num_threads=args.num_threads)
+
+    with tf.Session() as sess:
+        for name, dataset in [('tf.py_func', py_dataset), ('graph', graph_dataset)]:
+            next_element = dataset.repeat().prefetch(2).make_one_shot_iterator().get_next()
+            sess.run(next_element)
+            start = time.time()
+            for _ in range(args.batch_num):
+                sess.run(next_element)
+            batch_per_sec = args.batch_num / (time.time() - start)
+            print('{}: {:.2f} batches/s, {:.1f} images/s'.format(name, batch_per_sec, batch_per_sec * args.batch_size))
@@ -2,6 +2,9 @@
 Retrain the YOLO model for your own dataset.
 """
 
+import os
+from functools import partial
+
 import numpy as np
 import keras.backend as K
 from keras.layers import Input, Lambda
@@ -10,7 +13,10 @@ from keras.optimizers import Adam
 from keras.callbacks import TensorBoard, ModelCheckpoint, ReduceLROnPlateau, EarlyStopping
 
 from yolo3.model import preprocess_true_boxes, yolo_body, tiny_yolo_body, yolo_loss
-from yolo3.utils import get_random_data
+from yolo3.utils import get_random_data, get_random_batch
+from utils.anno_utils import open_annotation_store
+from utils.cache_utils import configure_image_cache
+from utils.loader_utils import ProcessPoolLoader, epoch_batches
 
 
 def _main():
@@ -24,6 +30,9 @@ def _main():
     anchors = get_anchors(anchors_path)
 
     input_shape = (416,416) # multiple of 32, hw
+    workers = min(8, os.cpu_count() or 1) # data augmentation processes, 0 to augment in the main process
+    uint8_transport = False # True: the workers send uint8 images, 8 times smaller than float64
+    batch_aug = False # True: augment the whole batch at once, see `get_random_batch`
 
     is_tiny_version = len(anchors)==6 # default setting
     if is_tiny_version:
@@ -44,8 +53,11 @@ def _main():
         len_val=len(lines)
 
     val_split = 0.1
-    with open(annotation_path) as f:
-        lines = f.readlines()
+    # the annotations are compiled once into a binary store, the generators only pass the image indices
+    anno_store = open_annotation_store(annotation_path).store_dir
+    # decode every image only once, the data augmentation workers share the decoded images through /dev/shm
+    image_cache = configure_image_cache(max_bytes=1 << 30, cache_dir='/dev/shm/yolo_image_cache' if workers > 0 else None)
+    lines = np.arange(len(open_annotation_store(anno_store)))
     np.random.seed(10101)
     np.random.shuffle(lines)
     np.random.seed(None)
@@ -61,14 +73,15 @@ def _main():
 
         batch_size = 10
         print('Train on {} samples, val on {} samples, with batch size {}.'.format(num_train, num_val, batch_size))
-        model.fit_generator(data_generator_wrapper(lines[:num_train], batch_size, input_shape, anchors, num_classes),
+        model.fit_generator(data_generator_wrapper(lines[:num_train], batch_size, input_shape, anchors, num_classes, anno_store, workers, uint8=uint8_transport, batch_aug=batch_aug),
                 steps_per_epoch=max(1, num_train//batch_size),
-                validation_data=data_generator_wrapper(lines[num_train:], batch_size, input_shape, anchors, num_classes),
+                validation_data=data_generator_wrapper(lines[num_train:], batch_size, input_shape, anchors, num_classes, anno_store, workers, uint8=uint8_transport, batch_aug=batch_aug),
                 validation_steps=max(1, num_val//batch_size),
                 epochs=100,
                 initial_epoch=0,
                 callbacks=[logging, checkpoint])
         model.save_weights(log_dir + 'trained_weights_stage_2.h5')
+        if workers == 0: print('Image cache: {}'.format(image_cache.stats()))
 
     # Unfreeze and continue training, to fine-tune.
     # Train longer if the result is not good.
@@ -80,14 +93,15 @@ def _main():
 
         batch_size = 2 # note that more GPU memory is required after unfreezing the body
         print('Train on {} samples, val on {} samples, with batch size {}.'.format(num_train, num_val, batch_size))
-        model.fit_generator(data_generator_wrapper(lines[:num_train], batch_size, input_shape, anchors, num_classes),
+        model.fit_generator(data_generator_wrapper(lines[:num_train], batch_size, input_shape, anchors, num_classes, anno_store, workers, uint8=uint8_transport, batch_aug=batch_aug),
             steps_per_epoch=max(1, num_train//batch_size),
-            validation_data=data_generator_wrapper(lines[num_train:], batch_size, input_shape, anchors, num_classes),
+            validation_data=data_generator_wrapper(lines[num_train:], batch_size, input_shape, anchors, num_classes, anno_store, workers, uint8=uint8_transport, batch_aug=batch_aug),
             validation_steps=max(1, num_val//batch_size),
             epochs=100,
             initial_epoch=50,
             callbacks=[logging, checkpoint, reduce_lr, early_stopping])
         model.save_weights(log_dir + 'trained_weights_final.h5')
+        if workers == 0: print('Image cache: {}'.format(image_cache.stats()))
 
     # Further training if needed.
 
@@ -168,29 +182,58 @@ def create_tiny_model(input_shape, anchors, num_classes, load_pretrained=True, f
 
     return model
 
-def data_generator(annotation_lines, batch_size, input_shape, anchors, num_classes):
-    '''data generator for fit_generator'''
-    n = len(annotation_lines)
-    i = 0
-    while True:
+def get_batch(annotation_lines, input_shape, anchors, num_classes, anno_store=None, uint8=False, batch_aug=False):
+    '''augment the images of annotation_lines and build their y_true, the inputs of fit_generator
+    uint8: uint8 images in range 0~255, see `normalize_batches`
+    batch_aug: augment the whole batch at once with `get_random_batch`'''
+    if batch_aug:
+        image_data, box_data = get_random_batch(annotation_lines, input_shape, anno_store=anno_store, uint8=uint8)
+    else:
         image_data = []
         box_data = []
-        for b in range(batch_size):
-            if i==0:
-                np.random.shuffle(annotation_lines)
-            image, box = get_random_data(annotation_lines[i], input_shape, random=True)
+        for annotation_line in annotation_lines:
+            image, box = get_random_data(annotation_line, input_shape, random=True, anno_store=anno_store, uint8=uint8)
             image_data.append(image)
             box_data.append(box)
-            i = (i+1) % n
         image_data = np.array(image_data)
         box_data = np.array(box_data)
-        y_true = preprocess_true_boxes(box_data, input_shape, anchors, num_classes)
-        yield [image_data, *y_true], np.zeros(batch_size)
+    y_true = preprocess_true_boxes(box_data, input_shape, anchors, num_classes)
+    return [image_data, *y_true], np.zeros(len(annotation_lines))
 
-def data_generator_wrapper(annotation_lines, batch_size, input_shape, anchors, num_classes):
+def data_generator(annotation_lines, batch_size, input_shape, anchors, num_classes, anno_store=None, uint8=False, batch_aug=False):
+    '''data generator for fit_generator
+    annotation_lines are image indices in anno_store if anno_store is given'''
+    n = len(annotation_lines)
+    i = 0
+    while True:
+        batch = []
+        for b in range(batch_size):
+            if i==0:
+                np.random.shuffle(annotation_lines)
+            batch.append(annotation_lines[i])
+            i = (i+1) % n
+        yield get_batch(batch, input_shape, anchors, num_classes, anno_store, uint8, batch_aug)
+
+def normalize_batches(batches):
+    '''convert the uint8 images of the batches to float32 in range 0~1, the input of the model'''
+    for inputs, dummy in batches:
+        yield [inputs[0].astype(np.float32)/255., *inputs[1:]], dummy
+
+def data_generator_wrapper(annotation_lines, batch_size, input_shape, anchors, num_classes, anno_store=None,
+        workers=0, ordered=True, prefetch=None, seed=None, uint8=False, batch_aug=False):
+    '''workers > 0: build the batches in a pool of worker processes, see `loader_utils.ProcessPoolLoader`
+    uint8: the images are built and sent as uint8, then converted to float32 in the main process
+    batch_aug: see `get_batch`'''
     n = len(annotation_lines)
     if n==0 or batch_size<=0: return None
-    return data_generator(annotation_lines, batch_size, input_shape, anchors, num_classes)
+    if workers > 0:
+        batch_fn = partial(get_batch, input_shape=input_shape, anchors=anchors, num_classes=num_classes, anno_store=anno_store, uint8=uint8, batch_aug=batch_aug)
+        rng = np.random.RandomState(seed) if seed is not None else np.random
+        batches = ProcessPoolLoader(batch_fn, epoch_batches(annotation_lines, batch_size, rng),
+            workers=workers, ordered=ordered, prefetch=prefetch, seed=seed)
+    else:
+        batches = data_generator(annotation_lines, batch_size, input_shape, anchors, num_classes, anno_store, uint8, batch_aug)
+    return normalize_batches(batches) if uint8 else batches
 
 if __name__ == '__main__':
     _main()
\ No newline at end of file
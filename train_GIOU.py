@@ -1,14 +1,19 @@
 import tensorflow as tf
 import numpy as np
 import logging
+import time
 from tqdm import trange
 
 import args
 
-from utils.data_utils import get_batch_data
-from utils.misc_utils import shuffle_and_overwrite, make_summary, config_learning_rate, config_optimizer, AverageMeter
-from utils.eval_utils import evaluate_on_cpu, evaluate_on_gpu, get_preds_gpu, voc_eval, parse_gt_rec
-from utils.nms_utils import gpu_nms
+from utils.data_utils import get_batch_data, scale_schedule, get_y_true_layout
+from utils.tf_data_utils import get_graph_dataset
+from utils.shard_utils import open_shard_store, get_shard_batch_data
+from utils.anno_utils import open_annotation_store
+from utils.cache_utils import configure_image_cache
+from utils.misc_utils import shuffle_and_overwrite, make_summary, config_learning_rate, config_optimizer, AverageMeter, \
+    StepScheduler
+from utils.eval_utils import evaluate_on_cpu, evaluate_batch_preds, get_batch_preds, parse_gt_rec, APAccumulator
 
 from yolo3.model_GIOU import yolov3
 
@@ -19,41 +24,99 @@ logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s %(mes
 # setting placeholders
 is_training = tf.placeholder(tf.bool, name="phase_train")
 handle_flag = tf.placeholder(tf.string, [], name='iterator_handle_flag')
-# register the gpu nms operation here for the following evaluation scheme
-pred_boxes_flag = tf.placeholder(tf.float32, [1, None, None])
-pred_scores_flag = tf.placeholder(tf.float32, [1, None, None])
-gpu_nms_op = gpu_nms(pred_boxes_flag, pred_scores_flag, args.class_num, args.nms_topk, args.score_threshold, args.nms_threshold)
+# the [width, height] of every training batch of the epoch, fed with `scale_schedule` at each train_init_op
+scale_schedule_flag = tf.placeholder(tf.int32, [None, 2], name='scale_schedule_flag')
 
 ##################
 # tf.data pipeline
 ##################
-train_dataset = tf.data.TextLineDataset(args.train_file)
-train_dataset = train_dataset.shuffle(args.train_img_cnt)
-train_dataset = train_dataset.batch(args.batch_size)
-train_dataset = train_dataset.map(
-    lambda x: tf.py_func(get_batch_data,
-                         inp=[x, args.class_num, args.img_size, args.anchors, 'train', args.multi_scale_train, args.use_mix_up, args.letterbox_resize],
-                         Tout=[tf.int64, tf.float32, tf.float32, tf.float32, tf.float32]),
-    num_parallel_calls=args.num_threads
-)
+# keep the decoded images in memory, the dataset is small enough to be decoded only once
+image_cache = configure_image_cache(max_bytes=1 << 30)
+# the annotations are compiled once into binary stores, the pipeline only passes the image indices
+train_store = open_annotation_store(args.train_file).store_dir
+val_store = open_annotation_store(args.val_file).store_dir
+
+# use_graph_pipeline: run the whole sample preparation as TF ops instead of tf.py_func, see `tf_data_utils`
+use_graph_pipeline = getattr(args, 'use_graph_pipeline', False)
+# use_uint8_transport: keep the images uint8 in the pipeline, they are normalized in `yolov3.forward`
+use_uint8_transport = getattr(args, 'use_uint8_transport', False)
+image_dtype = tf.uint8 if use_uint8_transport else tf.float32
+# use_color_distort: random HSV color jittering of the training images, see `color_utils`
+use_color_distort = getattr(args, 'use_color_distort', False)
+# use_batch_aug: warp every image of a batch once into a preallocated batch, see `data_utils.parse_batch_data`
+use_batch_aug = getattr(args, 'use_batch_aug', False)
+# use_mosaic: mosaic of 4 training images, drawn from the image cache like the use_mix_up images
+use_mosaic = getattr(args, 'use_mosaic', False)
+# the probability of the mix up / mosaic of a training image
+mix_up_prob = getattr(args, 'mix_up_prob', 0.5)
+mosaic_prob = getattr(args, 'mosaic_prob', 0.5)
+# val_batch_size: the val images are letterboxed to args.img_size, so they are batched like the training images
+val_batch_size = getattr(args, 'val_batch_size', args.batch_size)
+val_batch_cnt = (args.val_img_cnt + val_batch_size - 1) // val_batch_size
+# the multi-scale sizes change every scale_interval batches, in a schedule set per epoch, see `scale_schedule`
+scale_interval = getattr(args, 'scale_interval', 10)
+train_batch_cnt = (args.train_img_cnt + args.batch_size - 1) // args.batch_size
+# every batch comes with its [width, height]
+schedule_dataset = tf.data.Dataset.from_tensor_slices(scale_schedule_flag)
+if use_graph_pipeline:
+    # the mix up and mosaic (and their probabilities) are stages of the tf.py_func batch augmentation only
+    if args.use_mix_up or use_mosaic:
+        raise ValueError('use_mix_up and use_mosaic are not supported by the graph pipeline!')
+    if use_batch_aug:
+        info = 'use_batch_aug is ignored by the graph pipeline.'
+        print(info)
+        logging.warning(info)
+    train_dataset = get_graph_dataset(train_store, args.class_num, args.img_size, args.anchors, 'train', args.batch_size,
+                                      shuffle=True, multi_scale=args.multi_scale_train, letterbox_resize=args.letterbox_resize,
+                                      interval=scale_interval, num_threads=args.num_threads, uint8=use_uint8_transport,
+                                      color_distort=use_color_distort, schedule=scale_schedule_flag)
+    train_dataset = tf.data.Dataset.zip((train_dataset, schedule_dataset)).map(lambda x, size: x + (size,))
+    val_dataset = get_graph_dataset(val_store, args.class_num, args.img_size, args.anchors, 'val', val_batch_size,
+                                    letterbox_resize=args.letterbox_resize, num_threads=args.num_threads, uint8=use_uint8_transport)
+else:
+    train_dataset = tf.data.Dataset.range(args.train_img_cnt)
+    train_dataset = train_dataset.shuffle(args.train_img_cnt)
+    train_dataset = train_dataset.batch(args.batch_size)
+    train_dataset = tf.data.Dataset.zip((train_dataset, schedule_dataset))
+    train_dataset = train_dataset.map(
+        lambda x, size: tuple(tf.py_func(get_batch_data,
+                                         inp=[x, args.class_num, size, args.anchors, 'train', args.use_mix_up, args.letterbox_resize, train_store, use_uint8_transport, use_color_distort, use_batch_aug, use_mosaic, mix_up_prob, mosaic_prob],
+                                         Tout=[tf.int64, image_dtype, tf.float32, tf.float32, tf.float32])) + (size,),
+        num_parallel_calls=args.num_threads
+    )
+
+    val_dataset = tf.data.Dataset.range(args.val_img_cnt)
+    val_dataset = val_dataset.batch(val_batch_size)
+    val_dataset = val_dataset.map(
+        lambda x: tf.py_func(get_batch_data,
+                             inp=[x, args.class_num, args.img_size, args.anchors, 'val', False, args.letterbox_resize, val_store, use_uint8_transport, False, use_batch_aug],
+                             Tout=[tf.int64, image_dtype, tf.float32, tf.float32, tf.float32]),
+        num_parallel_calls=args.num_threads
+    )
+# val_shard_dir: read the val samples from the shards of `shard_utils.build_shards`, built with the same anchors,
+# class_num, letterbox_resize and val_file
+val_shard_dir = getattr(args, 'val_shard_dir', None)
+if val_shard_dir:
+    open_shard_store(val_shard_dir, args.img_size, anchors=args.anchors, class_num=args.class_num, anno_path=args.val_file,
+                     letterbox_resize=args.letterbox_resize)
+    val_dataset = tf.data.Dataset.range(args.val_img_cnt)
+    val_dataset = val_dataset.batch(val_batch_size)
+    val_dataset = val_dataset.map(
+        lambda x: tf.py_func(get_shard_batch_data,
+                             inp=[x, val_shard_dir, args.img_size, args.class_num, use_uint8_transport],
+                             Tout=[tf.int64, image_dtype, tf.float32, tf.float32, tf.float32]),
+        num_parallel_calls=args.num_threads
+    )
+val_dataset = val_dataset.map(lambda *x: x + (tf.constant(args.img_size, tf.int32),))
 train_dataset = train_dataset.prefetch(args.prefetech_buffer)
-
-val_dataset = tf.data.TextLineDataset(args.val_file)
-val_dataset = val_dataset.batch(1)
-val_dataset = val_dataset.map(
-    lambda x: tf.py_func(get_batch_data,
-                         inp=[x, args.class_num, args.img_size, args.anchors, 'val', False, False, args.letterbox_resize],
-                         Tout=[tf.int64, tf.float32, tf.float32, tf.float32, tf.float32]),
-    num_parallel_calls=args.num_threads
-)
-val_dataset.prefetch(args.prefetech_buffer)
+val_dataset = val_dataset.prefetch(args.prefetech_buffer)
 
 iterator = tf.data.Iterator.from_structure(train_dataset.output_types, train_dataset.output_shapes)
 train_init_op = iterator.make_initializer(train_dataset)
 val_init_op = iterator.make_initializer(val_dataset)
 
 # get an element from the chosen dataset iterator
-image_ids, image, y_true_13, y_true_26, y_true_52 = iterator.get_next()
+image_ids, image, y_true_13, y_true_26, y_true_52, batch_img_size = iterator.get_next()
 y_true = [y_true_13, y_true_26, y_true_52]
 
 # tf.data pipeline will lose the data `static` shape, so we need to set it manually
@@ -72,7 +135,17 @@ yolo_model = yolov3(args.class_num, args.anchors, args.use_label_smooth,
 with tf.variable_scope('yolov3'):
     pred_feature_maps = yolo_model.forward(image, is_training=is_training)
 loss = yolo_model.compute_loss(pred_feature_maps, y_true)
-y_pred = yolo_model.predict(pred_feature_maps)
+# the NMS runs in the same sess.run as the model, the detections of the batch are padded:
+# boxes, scores, labels, num_detections
+# nms_method: 'nms' or 'gaussian' (soft-NMS) with soft_nms_sigma, nms_class_agnostic: one NMS for all the classes
+# pre_nms_topk: only the top pre_nms_topk scores of each class go into the NMS, None to keep all
+pre_nms_topk = getattr(args, 'pre_nms_topk', None)
+nms_method = getattr(args, 'nms_method', 'nms')
+soft_nms_sigma = getattr(args, 'soft_nms_sigma', 0.5)
+nms_class_agnostic = getattr(args, 'nms_class_agnostic', False)
+detections = yolo_model.predict(pred_feature_maps, nms=True, max_boxes=args.nms_topk, score_thresh=args.score_threshold,
+                                nms_thresh=args.nms_threshold, class_agnostic=nms_class_agnostic, method=nms_method,
+                                sigma=soft_nms_sigma, pre_nms_topk=pre_nms_topk)
 
 l2_loss = tf.losses.get_regularization_loss()
 
@@ -104,13 +177,17 @@ optimizer = config_optimizer(args.optimizer_name, learning_rate)
 
 # set dependencies for BN ops
 update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+# the gradients don't depend on the BN updates, only their apply does, so that the warm up below doesn't
+# update the moving mean and variance of the restored weights
+gvs = optimizer.compute_gradients(loss[0] + l2_loss, var_list=update_vars)
 with tf.control_dependencies(update_ops):
     # train_op = optimizer.minimize(loss[0] + l2_loss, var_list=update_vars, global_step=global_step)
     # apply gradient clip to avoid gradient exploding
-    gvs = optimizer.compute_gradients(loss[0] + l2_loss, var_list=update_vars)
     clip_grad_var = [gv if gv[0] is None else [
           tf.clip_by_norm(gv[0], 100.), gv[1]] for gv in gvs]
     train_op = optimizer.apply_gradients(clip_grad_var, global_step=global_step)
+# the forward and backward pass of a training step without the update, to warm up the kernels of an image size
+warm_up_op = [loss[0]] + [gv[0] for gv in gvs if gv[0] is not None]
 
 if args.save_optimizer:
     print('Saving optimizer parameters to checkpoint! Remember to restore the global_step in the fine-tuning afterwards.')
@@ -123,34 +200,59 @@ with tf.Session() as sess:
     merged = tf.summary.merge_all()
     writer = tf.summary.FileWriter(args.log_dir, sess.graph)
 
+    # the loss scalars are fetched on every step, the detections and the ground truth (~29 MB per batch of 8 at
+    # 416 with 80 classes) only on the train_evaluation_step steps, and the summaries every summary_step steps
+    summary_step = getattr(args, 'summary_step', 10)
+    step_scheduler = StepScheduler({'train_op': train_op, 'loss': loss, 'global_step': global_step, 'lr': learning_rate,
+                                    'img_size': batch_img_size, 'batch_size': tf.shape(image_ids)[0]},
+                                   eval=({'detections': detections, 'y_true': y_true}, args.train_evaluation_step),
+                                   summary=({'summary': merged}, summary_step))
+    step = int(sess.run(global_step))
+
     print('\n----------- start to train -----------\n')
 
     best_mAP = -np.Inf
 
+    # run every scheduled image size once on a blank batch, so the kernel selection of a new shape
+    # doesn't stall the training steps
+    warm_up_sizes = np.unique(np.concatenate([scale_schedule(train_batch_cnt, args.img_size, args.multi_scale_train, scale_interval, epoch)
+                                              for epoch in range(args.total_epoches)]), axis=0)
+    for width, height in warm_up_sizes:
+        start = time.time()
+        _, shapes, _, _ = get_y_true_layout([width, height], args.class_num)
+        sess.run(warm_up_op, feed_dict={is_training: True,
+                                        image: np.zeros([args.batch_size, height, width, 3], image_dtype.as_numpy_dtype),
+                                        **{y: np.zeros((args.batch_size,) + shape, np.float32) for y, shape in zip(y_true, shapes)}})
+        info = 'Warm up of the image size {}x{}: {:.2f}s'.format(width, height, time.time() - start)
+        print(info)
+        logging.info(info)
+
     for epoch in range(args.total_epoches):
 
-        sess.run(train_init_op)
+        sess.run(train_init_op, feed_dict={scale_schedule_flag: scale_schedule(train_batch_cnt, args.img_size, args.multi_scale_train, scale_interval, epoch)})
         loss_total, loss_iou, loss_conf, loss_class = AverageMeter(), AverageMeter(), AverageMeter(), AverageMeter()
 
         for i in trange(args.train_batch_num):
-            _, summary, __y_pred, __y_true, __loss, __global_step, __lr = sess.run(
-                [train_op, merged, y_pred, y_true, loss, global_step, learning_rate],
-                feed_dict={is_training: True})
+            # the global step after the update of this step
+            step += 1
+            fetched = step_scheduler.run(sess, step, feed_dict={is_training: True})
+            __loss, __global_step, __lr, __img_size = fetched['loss'], fetched['global_step'], fetched['lr'], fetched['img_size']
 
-            writer.add_summary(summary, global_step=__global_step)
+            if 'summary' in fetched:
+                writer.add_summary(fetched['summary'], global_step=__global_step)
 
-            loss_total.update(__loss[0], len(__y_pred[0]))
-            loss_iou.update(__loss[1], len(__y_pred[0]))
-            loss_conf.update(__loss[2], len(__y_pred[0]))
-            loss_class.update(__loss[3], len(__y_pred[0]))
+            loss_total.update(__loss[0], fetched['batch_size'])
+            loss_iou.update(__loss[1], fetched['batch_size'])
+            loss_conf.update(__loss[2], fetched['batch_size'])
+            loss_class.update(__loss[3], fetched['batch_size'])
 
-            if __global_step % args.train_evaluation_step == 0 and __global_step > 0:
-                # recall, precision = evaluate_on_cpu(__y_pred, __y_true, args.class_num, args.nms_topk, args.score_threshold, args.nms_threshold)
-                recall, precision = evaluate_on_gpu(sess, gpu_nms_op, pred_boxes_flag, pred_scores_flag, __y_pred, __y_true, args.class_num, args.nms_threshold)
+            if 'detections' in fetched:
+                __detections, __y_true = fetched['detections'], fetched['y_true']
+                recall, precision = evaluate_batch_preds(__y_true, *__detections, args.class_num, args.nms_threshold)
 
                 info = "Epoch: {}, global_step: {} | loss: total: {:.2f}, iou: {:.2f}, conf: {:.2f}, class: {:.2f} | ".format(
                         epoch, int(__global_step), loss_total.average, loss_iou.average, loss_conf.average, loss_class.average)
-                info += 'Last batch: rec: {:.3f}, prec: {:.3f} | lr: {:.5g}'.format(recall, precision, __lr)
+                info += 'Last batch: rec: {:.3f}, prec: {:.3f}, size: {}x{} | lr: {:.5g}'.format(recall, precision, __img_size[0], __img_size[1], __lr)
                 print(info)
                 logging.info(info)
 
@@ -162,6 +264,15 @@ with tf.Session() as sess:
                     raise ArithmeticError(
                         'Gradient exploded! Please train again and you may need modify some parameters.')
 
+        info = 'Epoch: {}, steps: {}'.format(epoch, step_scheduler.report())
+        print(info)
+        logging.info(info)
+        info = 'Epoch: {}, image cache: {}'.format(epoch, image_cache.stats())
+        print(info)
+        logging.info(info)
+        for key, value in image_cache.stats().items():
+            writer.add_summary(make_summary('image_cache/' + key, value), global_step=epoch)
+
         # NOTE: this is just demo. You can set the conditions when to save the weights.
         if epoch % args.save_epoch == 0 and epoch > 0:
             if loss_total.average <= 2.:
@@ -174,33 +285,38 @@ with tf.Session() as sess:
             val_loss_total, val_loss_iou, val_loss_conf, val_loss_class = \
                 AverageMeter(), AverageMeter(), AverageMeter(), AverageMeter()
 
-            val_preds = []
-
-            for j in trange(args.val_img_cnt):
-                __image_ids, __y_pred, __loss = sess.run([image_ids, y_pred, loss],
-                                                         feed_dict={is_training: False})
-                pred_content = get_preds_gpu(sess, gpu_nms_op, pred_boxes_flag, pred_scores_flag, __image_ids, __y_pred)
-                val_preds.extend(pred_content)
-                val_loss_total.update(__loss[0])
-                val_loss_iou.update(__loss[1])
-                val_loss_conf.update(__loss[2])
-                val_loss_class.update(__loss[3])
+            gt_dict = parse_gt_rec(args.val_file, args.img_size, args.letterbox_resize)
+            ap_accumulator = APAccumulator(gt_dict, args.class_num, iou_thres=args.eval_threshold,
+                                           use_07_metric=args.use_voc_07_metric, coco_metric=True)
+
+            for j in trange(val_batch_cnt):
+                __image_ids, __detections, __loss = sess.run([image_ids, detections, loss],
+                                                             feed_dict={is_training: False})
+                pred_content = get_batch_preds(__image_ids, *__detections)
+                ap_accumulator.update(pred_content)
+                # the losses are averaged over the images of the batch
+                val_loss_total.update(__loss[0], len(__image_ids))
+                val_loss_iou.update(__loss[1], len(__image_ids))
+                val_loss_conf.update(__loss[2], len(__image_ids))
+                val_loss_class.update(__loss[3], len(__image_ids))
 
             # calc mAP
-            rec_total, prec_total, ap_total = AverageMeter(), AverageMeter(), AverageMeter()
-            gt_dict = parse_gt_rec(args.val_file, args.img_size, args.letterbox_resize)
+            rec_total, prec_total, ap_total, coco_ap_total = AverageMeter(), AverageMeter(), AverageMeter(), AverageMeter()
 
             info = '======> Epoch: {}, global_step: {}, lr: {:.6g} <======\n'.format(epoch, __global_step, __lr)
 
             for ii in range(args.class_num):
-                npos, nd, rec, prec, ap = voc_eval(gt_dict, val_preds, ii, iou_thres=args.eval_threshold, use_07_metric=args.use_voc_07_metric)
-                info += 'EVAL: Class {}: Recall: {:.4f}, Precision: {:.4f}, AP: {:.4f}\n'.format(ii, rec, prec, ap)
+                npos, nd, rec, prec, ap = ap_accumulator.evaluate(ii)
+                coco_ap = ap_accumulator.evaluate_coco(ii)
+                info += 'EVAL: Class {}: Recall: {:.4f}, Precision: {:.4f}, AP: {:.4f}, AP@[.5:.95]: {:.4f}\n'.format(ii, rec, prec, ap, coco_ap)
                 rec_total.update(rec, npos)
                 prec_total.update(prec, nd)
                 ap_total.update(ap, 1)
+                coco_ap_total.update(coco_ap, 1)
 
             mAP = ap_total.average
-            info += 'EVAL: Recall: {:.4f}, Precison: {:.4f}, mAP: {:.4f}\n'.format(rec_total.average, prec_total.average, mAP)
+            info += 'EVAL: Recall: {:.4f}, Precison: {:.4f}, mAP: {:.4f}, mAP@[.5:.95]: {:.4f}\n'.format(
+                rec_total.average, prec_total.average, mAP, coco_ap_total.average)
             info += 'EVAL: loss: total: {:.2f}, iou: {:.2f}, conf: {:.2f}, class: {:.2f}\n'.format(
                 val_loss_total.average, val_loss_iou.average, val_loss_conf.average, val_loss_class.average)
             print(info)
@@ -212,6 +328,7 @@ with tf.Session() as sess:
                                    epoch, int(__global_step), best_mAP, val_loss_total.average, __lr))
 
             writer.add_summary(make_summary('evaluation/val_mAP', mAP), global_step=epoch)
+            writer.add_summary(make_summary('evaluation/val_mAP_50_95', coco_ap_total.average), global_step=epoch)
             writer.add_summary(make_summary('evaluation/val_recall', rec_total.average), global_step=epoch)
             writer.add_summary(make_summary('evaluation/val_precision', prec_total.average), global_step=epoch)
             writer.add_summary(make_summary('validation_statistics/total_loss', val_loss_total.average), global_step=epoch)
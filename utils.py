@@ -4,7 +4,12 @@ from functools import reduce
 
 from PIL import Image
 import numpy as np
-from matplotlib.colors import rgb_to_hsv, hsv_to_rgb
+import cv2
+
+from utils.anno_utils import open_annotation_store
+from utils.cache_utils import pil_open
+from utils.color_utils import random_hsv_params, random_hsv_jitter, hsv_jitter
+from utils.aug_utils import affine_matrices, transform_boxes, warp_image
 
 def compose(*funcs):
     """Compose arbitrarily many functions, evaluated left to right.
@@ -32,13 +37,20 @@ def letterbox_image(image, size):
 def rand(a=0, b=1):
     return np.random.rand()*(b-a) + a
 
-def get_random_data(annotation_line, input_shape, random=True, max_boxes=20, jitter=.3, hue=.1, sat=1.5, val=1.5, proc_img=True):
-    '''random preprocessing for real-time data augmentation'''
-    line = annotation_line.split()
-    image = Image.open(line[0])
+def get_random_data(annotation_line, input_shape, random=True, max_boxes=20, jitter=.3, hue=.1, sat=1.5, val=1.5, proc_img=True, anno_store=None, uint8=False):
+    '''random preprocessing for real-time data augmentation
+    annotation_line is the index of the image in anno_store if anno_store is given, see `anno_utils`
+    uint8: return the image as uint8 in range 0~255 instead of float64 in range 0~1'''
+    if anno_store is None:
+        line = annotation_line.split()
+        image = pil_open(line[0])
+        box = np.array([np.array(list(map(int,box.split(',')))) for box in line[1:]])
+    else:
+        _, pic_path, boxes, labels, _, _ = open_annotation_store(anno_store).parse(annotation_line)
+        image = pil_open(pic_path)
+        box = np.concatenate([boxes, labels[:, None]], axis=-1).astype(int)
     iw, ih = image.size
     h, w = input_shape
-    box = np.array([np.array(list(map(int,box.split(',')))) for box in line[1:]])
 
     if not random:
         # resize image
@@ -52,7 +64,7 @@ def get_random_data(annotation_line, input_shape, random=True, max_boxes=20, jit
             image = image.resize((nw,nh), Image.BICUBIC)
             new_image = Image.new('RGB', (w,h), (128,128,128))
             new_image.paste(image, (dx, dy))
-            image_data = np.array(new_image)/255.
+            image_data = np.array(new_image) if uint8 else np.array(new_image)/255.
 
         # correct boxes
         box_data = np.zeros((max_boxes,5))
@@ -87,19 +99,9 @@ def get_random_data(annotation_line, input_shape, random=True, max_boxes=20, jit
     flip = rand()<.5
     if flip: image = image.transpose(Image.FLIP_LEFT_RIGHT)
 
-    # distort image
-    hue = rand(-hue, hue)
-    sat = rand(1, sat) if rand()<.5 else 1/rand(1, sat)
-    val = rand(1, val) if rand()<.5 else 1/rand(1, val)
-    x = rgb_to_hsv(np.array(image)/255.)
-    x[..., 0] += hue
-    x[..., 0][x[..., 0]>1] -= 1
-    x[..., 0][x[..., 0]<0] += 1
-    x[..., 1] *= sat
-    x[..., 2] *= val
-    x[x>1] = 1
-    x[x<0] = 0
-    image_data = hsv_to_rgb(x) # numpy array, 0 to 1
+    # distort image, on uint8 with lookup tables, see `color_utils`
+    image_data = random_hsv_jitter(np.asarray(image), hue, sat, val)
+    if not uint8: image_data = image_data/255. # numpy array, 0 to 1
 
     # correct boxes
     box_data = np.zeros((max_boxes,5))
@@ -117,4 +119,60 @@ def get_random_data(annotation_line, input_shape, random=True, max_boxes=20, jit
         if len(box)>max_boxes: box = box[:max_boxes]
         box_data[:len(box)] = box
 
-    return image_data, box_data
\ No newline at end of file
+    return image_data, box_data
+
+
+def get_random_batch(annotation_lines, input_shape, max_boxes=20, jitter=.3, hue=.1, sat=1.5, val=1.5, anno_store=None, uint8=False):
+    '''batch version of get_random_data(random=True): the random parameters of the whole batch are sampled first,
+    then every image is resized, placed and flipped at once into the preallocated batch, see `aug_utils`
+    return: image_data [n, h, w, 3], box_data [n, max_boxes, 5]'''
+    n = len(annotation_lines)
+    h, w = input_shape
+    images, boxes = [], []
+    for annotation_line in annotation_lines:
+        if anno_store is None:
+            line = annotation_line.split()
+            image = pil_open(line[0])
+            box = np.array([np.array(list(map(int,box.split(',')))) for box in line[1:]]).reshape(-1, 5)
+        else:
+            _, pic_path, box, labels, _, _ = open_annotation_store(anno_store).parse(annotation_line)
+            image = pil_open(pic_path)
+            box = np.concatenate([box, labels[:, None]], axis=-1).astype(int)
+        images.append(np.asarray(image if image.mode == 'RGB' else image.convert('RGB')))
+        boxes.append(box)
+    iw, ih = np.array([image.shape[1] for image in images]), np.array([image.shape[0] for image in images])
+
+    # sample the resize, the placement and the flip of all the images, like get_random_data
+    new_ar = w/h * np.random.uniform(1-jitter, 1+jitter, n)/np.random.uniform(1-jitter, 1+jitter, n)
+    scale = np.random.uniform(.25, 2, n)
+    nh = np.where(new_ar<1, np.floor(scale*h), np.floor(np.floor(scale*w)/new_ar))
+    nw = np.where(new_ar<1, np.floor(nh*new_ar), np.floor(scale*w))
+    dx = np.trunc(np.random.uniform(0, 1, n)*(w-nw))
+    dy = np.trunc(np.random.uniform(0, 1, n)*(h-nh))
+    flip = np.random.uniform(0, 1, n)<.5
+    hsv = [random_hsv_params(hue, sat, val) for _ in range(n)]
+    M = affine_matrices(nw/iw, nh/ih, dx, dy, flip, w)
+
+    image_data = np.empty((n, h, w, 3), np.uint8)
+    box_data = np.zeros((n, max_boxes, 5))
+    for b in range(n):
+        # area interpolation when shrinking, it doesn't alias like the bicubic of cv2 (the PIL one is antialiased)
+        warp_image(images[b], M[b], image_data[b], cv2.INTER_AREA if nw[b]<iw[b] else cv2.INTER_CUBIC, (128,128,128))
+        hsv_jitter(image_data[b], *hsv[b], dst=image_data[b])
+
+        # correct boxes
+        box = boxes[b]
+        if len(box)>0:
+            np.random.shuffle(box)
+            box = transform_boxes(box, M[b])
+            box[:, 0:2][box[:, 0:2]<0] = 0
+            box[:, 2][box[:, 2]>w] = w
+            box[:, 3][box[:, 3]>h] = h
+            box_w = box[:, 2] - box[:, 0]
+            box_h = box[:, 3] - box[:, 1]
+            box = box[np.logical_and(box_w>1, box_h>1)] # discard invalid box
+            if len(box)>max_boxes: box = box[:max_boxes]
+            box_data[b, :len(box)] = box
+
+    if not uint8: image_data = image_data/255. # numpy array, 0 to 1
+    return image_data, box_data
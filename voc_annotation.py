@@ -2,6 +2,8 @@
 import xml.etree.ElementTree as ET
 from os import getcwd
 
+from utils.anno_utils import compile_annotation
+
 sets=[('2020', 'train'), ('2020', 'val'), ('2020', 'test')]
 
 classes = ["facewithoutmask", "facewithmask"]
@@ -35,4 +37,6 @@ for year, image_set in sets:
         list_file.write('%s/VOC%s/JPEGImages/%s.jpg'%(wd, year, image_id))
         convert_annotation(year, image_id, list_file)
         list_file.write('\n')
-    list_file.close()
\ No newline at end of file
+    list_file.close()
+    # pre-parse the annotations once for the data pipelines
+    compile_annotation('%s_%s.txt'%(year, image_set))
\ No newline at end of file